@@ -1,5 +1,5 @@
 from pm_monitor import run
-from pm_monitor.metrics import Metric, MetricFilter, MetricDescription
+from pm_monitor.metrics import Sample, MetricFilter, MetricDescription, Histogram, series
 
 def degc2f(x):
     return x * 9.0/5.0 + 32.0
@@ -10,16 +10,30 @@ class PmMonitor(MetricFilter):
         # The `_match` property will be used to determine which sensor records
         # this filter will be applied to
         self._match = {"model": "PM-Monitor", "id" : self.id}
+        # The series (metric name plus labels) are looked up once, every scrape
+        # only pairs them with the values of the record
+        labels = {'sensor_id': "PM-Monitor_%s" % (str(self.id))}
+        self.series = [
+            (series('temperature', labels), 'temperature_C'),
+            (series('humidity', labels), 'humidity'),
+            (series('pm2_5', labels), 'pm2_5'),
+            (series('pm1_0', labels), 'pm1_0'),
+            (series('pm10', labels), 'pm10'),
+        ]
+        # Distribution of all PM2.5 values, not only the latest one
+        self.pm2_5_distribution = Histogram('pm2_5_distribution', [5, 10, 15, 25, 35, 50, 75, 100], labels)
+
+    def observe(self, r):
+        """Called for every stored record of this sensor
+        """
+        self.pm2_5_distribution.observe(r['pm2_5'])
         
     def process(self, r):
         """Takes a single sensor record, and converts it to 0 or more metrics
         """
-        sensor_id = "PM-Monitor_%s" % (str(self.id)) 
-        yield Metric('temperature', r['temperature_C'], labels={'sensor_id': sensor_id})
-        yield Metric('humidity', r['humidity'], labels={'sensor_id': sensor_id})
-        yield Metric('pm2_5', r['pm2_5'], labels={'sensor_id': sensor_id})
-        yield Metric('pm1_0', r['pm1_0'], labels={'sensor_id': sensor_id})
-        yield Metric('pm10', r['pm10'], labels={'sensor_id': sensor_id})
+        for s, field in self.series:
+            yield Sample(s, r[field])
+        yield from self.pm2_5_distribution.samples()
 
 class OutdoorHumidity(MetricFilter):
     def __init__(self, id):
@@ -27,12 +41,20 @@ class OutdoorHumidity(MetricFilter):
         # The `_match` property will be used to determine which sensor records
         # this filter will be applied to
         self._match = {"model": "Outdoor Humidity", "id" : self.id}
+        labels = {'sensor_id': "OutdoorHumidity_%s" % (str(self.id))}
+        self.humidity = series('humidity', labels)
+        self.temperature = series('temperature', labels)
+        self.pressure = series('pressure', labels)
         
     def process(self, r):
         """Takes a single sensor record, and converts it to 0 or more metrics
         """
-        sensor_id = "OutdoorHumidity_%s" % (str(self.id)) 
-        yield Metric('humidity', r['humidity'], labels={'sensor_id': sensor_id})
+        yield Sample(self.humidity, r['humidity'])
+        # Only if the Buienradar station measures them
+        if 'temperature_C' in r:
+            yield Sample(self.temperature, r['temperature_C'])
+        if 'pressure_hPa' in r:
+            yield Sample(self.pressure, r['pressure_hPa'])
 
 class AcuriteTower(MetricFilter):
     def __init__(self, id):
@@ -44,18 +66,22 @@ class AcuriteTower(MetricFilter):
     def process(self, r):
         """Takes a single sensor record, and converts it to 0 or more metrics
         """
-        sensor_id = "%s%s" % (str(self.id), r['channel']) 
-        yield Metric('temperature', degc2f(r['temperature_C']), labels={'sensor_id': sensor_id})
-        yield Metric('humidity', r['humidity'], labels={'sensor_id': sensor_id})
-        yield Metric('battery_warning', r['battery_low'], labels={'sensor_id': sensor_id})
+        # The label depends on the record, the registry returns the same series every scrape
+        labels = {'sensor_id': "%s%s" % (str(self.id), r['channel'])}
+        yield Sample(series('temperature', labels), degc2f(r['temperature_C']))
+        yield Sample(series('humidity', labels), r['humidity'])
+        yield Sample(series('battery_warning', labels), r['battery_low'])
 
 class LaCrosse(MetricFilter):
     def __init__(self, id):
         self.id = id
         self._match = {"model": "TX141TH-Bv2 sensor", "id": self.id}
+        labels = {'sensor_id': "LaCross_%s" % (str(self.id))}
+        self.temperature = series('temperature', labels)
+        self.humidity = series('humidity', labels)
+        self.battery_warning = series('battery_warning', labels)
 
     def process(self, r):
-        sensor_id = "LaCross_%s" % (str(self.id))
         battery_warning = 0
         if r['battery'] == "OK":
             battery_warning = 0
@@ -64,9 +90,9 @@ class LaCrosse(MetricFilter):
         else:
             battery_warning = 99 # Unrecognized. (I'm not sure right now what all the battery field options are)
 
-        yield Metric('temperature', degc2f(r['temperature_C']), labels={'sensor_id': sensor_id})
-        yield Metric('humidity', r['humidity'], labels={'sensor_id': sensor_id})
-        yield Metric('battery_warning', battery_warning, labels={'sensor_id': sensor_id})
+        yield Sample(self.temperature, degc2f(r['temperature_C']))
+        yield Sample(self.humidity, r['humidity'])
+        yield Sample(self.battery_warning, battery_warning)
 
 def main():
     # List all metric names that we will expose
@@ -76,6 +102,8 @@ def main():
         MetricDescription("pm2_5", "gauge", "particulate matter of size 2.5 um in μg/m3"),
         MetricDescription("pm1_0", "gauge", "particulate matter of size 1 um in μg/m3"),
         MetricDescription("pm10", "gauge", "particulate matter of size 10 um in μg/m3"),
+        MetricDescription("pressure", "gauge", "Air pressure in hPa"),
+        MetricDescription("pm2_5_distribution", "histogram", "distribution of particulate matter of size 2.5 um in μg/m3"),
     ]
     # For each sensor that we want to convert to metrics, create a MetricFilter class that will do that
     metric_filters = [
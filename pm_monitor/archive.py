@@ -0,0 +1,373 @@
+"""Compressed, memory-mapped columnar archive for long-term sensor history
+
+Samples are collected per series (one sensor) in memory and written as a chunk of
+`chunk_size` samples into fixed-size segment files:
+
+- timestamps are stored as delta-of-delta, zigzag encoded, at the smallest fixed
+  width (1, 2, 4 or 8 bytes) that fits the chunk; regular 5 second sampling costs
+  one byte per sample,
+- values with at most 4 decimals (all PM Detector values) are scaled to integers and
+  delta encoded the same way; columns without any value (a field the sensor does not
+  have) take no space; other values (e.g. some NaN, or too large to scale) are stored
+  as raw float64.
+
+Segment files are read through `mmap`. Fixed width columns are decoded with NumPy
+when it is installed (no Python object per sample), otherwise with `array`, mapping a
+lookup table over whole columns; only the requested fields are decoded.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SEGMENT_HEADER = struct.Struct('<8sQ')          # magic, used bytes
+SEGMENT_MAGIC = b'PMSEG001'
+CHUNK_HEADER = struct.Struct('<4sIIHqq')        # magic, length, count, fields, first and last timestamp
+CHUNK_MAGIC = b'PMCK'
+
+TYPECODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+assert all(array(t).itemsize == w for w, t in TYPECODES.items())
+
+MODE_SCALED = 0
+MODE_RAW = 1
+MODE_EMPTY = 2
+
+
+def series_name(record, hash_keys=('model', 'id', 'channel')):
+    """Stable name of the series of a record, e.g. 'model=PM-Monitor,id=100'"""
+    return ",".join("%s=%s" % (k, record[k]) for k in hash_keys if k in record)
+
+
+def _zigzag(v):
+    return (v << 1) ^ (v >> 63)
+
+
+def _encode_ints(values):
+    zz = [_zigzag(v) for v in values]
+    m = max(zz, default=0)
+    width = 1 if m < 1 << 8 else 2 if m < 1 << 16 else 4 if m < 1 << 32 else 8
+    a = array(TYPECODES[width], zz)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return bytes([width]) + a.tobytes()
+
+
+# Zigzag decoded value of every 1 and 2 byte code, built on first use; without NumPy a
+# lookup per sample (map over the whole column) is much faster than the arithmetic.
+_unzigzag = {}
+
+
+def _unzigzag_table(width):
+    table = _unzigzag.get(width)
+    if table is None:
+        table = _unzigzag[width] = [(x >> 1) ^ -(x & 1) for x in range(1 << 8 * width)]
+    return table
+
+
+def _skip_ints(buf, offset, count):
+    """Return the offset after a zigzag column, without decoding it"""
+    return offset + 1 + buf[offset] * count
+
+
+def _decode_ints(buf, offset, count):
+    """Decode a zigzag column and return (cumulative sum, new offset)"""
+    width = buf[offset]
+    offset += 1
+    end = offset + width * count
+    if numpy is not None:
+        u = numpy.frombuffer(buf, dtype='<u%d' % width, count=count, offset=offset).astype(numpy.uint64)
+        v = (u >> numpy.uint64(1)).astype(numpy.int64) ^ -(u & numpy.uint64(1)).astype(numpy.int64)
+        return numpy.cumsum(v), end
+    a = array(TYPECODES[width])
+    a.frombytes(buf[offset:end])
+    if sys.byteorder == 'big':
+        a.byteswap()
+    if width <= 2:
+        return array('q', accumulate(map(_unzigzag_table(width).__getitem__, a))), end
+    return array('q', accumulate((x >> 1) ^ -(x & 1) for x in a)), end
+
+
+def _decimals(values):
+    """Smallest number of decimals (0-4) that represents all values exactly, or None"""
+    for decimals in range(5):
+        scale = 10 ** decimals
+        if all(v == v and abs(v * scale - round(v * scale)) < 1e-6 for v in values):
+            return decimals
+    return None
+
+
+def encode_chunk(name, timestamps, columns):
+    """Encode one chunk: `timestamps` (ints) and `columns` (dict of field to floats)"""
+    n = len(timestamps)
+    deltas = [timestamps[i] - timestamps[i - 1] for i in range(1, n)]
+    parts = []
+    key = name.encode('utf-8')
+    parts.append(struct.pack('<H', len(key)) + key)
+    parts.append(_encode_ints([d - p for d, p in zip(deltas, [0] + deltas[:-1])]))
+    for field, values in columns.items():
+        f = field.encode('utf-8')
+        parts.append(struct.pack('<H', len(f)) + f)
+        decimals = _decimals(values)
+        ints = None
+        if decimals is not None:
+            scale = 10 ** decimals
+            ints = [round(v * scale) for v in values]
+            # The deltas must fit in 64 bits
+            if max(abs(i) for i in ints) >= 1 << 62:
+                ints = None
+        if all(v != v for v in values):
+            parts.append(bytes([MODE_EMPTY]))
+        elif ints is not None:
+            parts.append(bytes([MODE_SCALED, decimals]) + _encode_ints([i - p for i, p in zip(ints, [0] + ints[:-1])]))
+        else:
+            parts.append(bytes([MODE_RAW]) + array('d', values).tobytes())
+    body = b''.join(parts)
+    header = CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_HEADER.size + len(body), n, len(columns), timestamps[0], timestamps[-1])
+    return header + body
+
+
+def decode_chunk(buf, offset, fields=None):
+    """Decode the chunk at `offset` of `buf`, return (name, timestamps, dict of field to values)
+
+    Only the fields in `fields` are decoded (all if None).
+    """
+    magic, length, n, nfields, first, last = CHUNK_HEADER.unpack_from(buf, offset)
+    o = offset + CHUNK_HEADER.size
+    (key_len,) = struct.unpack_from('<H', buf, o)
+    name = bytes(buf[o + 2:o + 2 + key_len]).decode('utf-8')
+    o += 2 + key_len
+    deltas, o = _decode_ints(buf, o, n - 1)
+    if numpy is not None:
+        timestamps = numpy.empty(n, dtype=numpy.int64)
+        timestamps[0] = first
+        numpy.cumsum(deltas, out=timestamps[1:])
+        timestamps[1:] += first
+    else:
+        timestamps = array('q', accumulate(deltas, initial=first))
+    columns = {}
+    for i in range(nfields):
+        (field_len,) = struct.unpack_from('<H', buf, o)
+        field = bytes(buf[o + 2:o + 2 + field_len]).decode('utf-8')
+        o += 2 + field_len
+        mode = buf[o]
+        if mode == MODE_SCALED:
+            scale = 10 ** buf[o + 1]
+            if fields is not None and field not in fields:
+                o = _skip_ints(buf, o + 2, n)
+                continue
+            ints, o = _decode_ints(buf, o + 2, n)
+            columns[field] = ints / scale if numpy is not None else array('d', map(scale.__rtruediv__, ints))
+        elif mode == MODE_EMPTY:
+            o += 1
+            if fields is None or field in fields:
+                columns[field] = numpy.full(n, numpy.nan) if numpy is not None else array('d', [float('nan')]) * n
+        else:
+            o += 1
+            if fields is None or field in fields:
+                columns[field] = numpy.frombuffer(buf, dtype='<f8', count=n, offset=o) if numpy is not None \
+                    else array('d', bytes(buf[o:o + 8 * n]))
+            o += 8 * n
+    return name, timestamps, columns
+
+
+class Segment(object):
+    """One fixed-size, memory-mapped segment file"""
+    def __init__(self, path, size):
+        exists = os.path.exists(path)
+        self.path = path
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if exists:
+            magic, self.used = SEGMENT_HEADER.unpack_from(self.map, 0)
+            if magic != SEGMENT_MAGIC:
+                raise ValueError("%s is not an archive segment" % path)
+        else:
+            self.used = SEGMENT_HEADER.size
+            SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, self.used)
+
+    def free(self):
+        return len(self.map) - self.used
+
+    def append(self, chunk):
+        offset = self.used
+        self.map[offset:offset + len(chunk)] = chunk
+        self.used += len(chunk)
+        SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, self.used)
+        return offset
+
+    def chunks(self):
+        """Yield (offset, name, first timestamp, last timestamp) of every chunk"""
+        offset = SEGMENT_HEADER.size
+        while offset < self.used:
+            magic, length, n, nfields, first, last = CHUNK_HEADER.unpack_from(self.map, offset)
+            if magic != CHUNK_MAGIC:
+                break
+            o = offset + CHUNK_HEADER.size
+            (key_len,) = struct.unpack_from('<H', self.map, o)
+            name = bytes(self.map[o + 2:o + 2 + key_len]).decode('utf-8')
+            yield offset, name, first, last
+            offset += length
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Archive(object):
+    """Long-term history of numeric sensor fields in compressed segment files
+
+    `append()` collects samples per series, a chunk is written when it holds
+    `chunk_size` samples or its first sample is older than `max_chunk_age` seconds.
+    A background thread checks the age every `flush_interval` seconds, so the chunk of an
+    idle series is written too, and flushes the segments to disk. Call `close()` at
+    shutdown to write the pending samples.
+
+    Samples at or before the last archived sample of their series are ignored, so the
+    records replayed from the write-ahead log at startup only add what the archive lost
+    (the pending samples of a crash). Only `fields` are archived, missing values are
+    stored as NaN.
+    """
+    def __init__(self, directory, fields, segment_size=8 << 20, chunk_size=1024, max_chunk_age=3600,
+                 flush_interval=60):
+        self.directory = directory
+        self.fields = list(fields)
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.max_chunk_age = max_chunk_age
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        # name -> list of (segment, offset, first, last)
+        self._index = {}
+        # name -> timestamp of the last sample, archived or pending
+        self._last = {}
+        self.segments = []
+        os.makedirs(directory, exist_ok=True)
+        for filename in sorted(os.listdir(directory)):
+            if filename.startswith('segment-') and filename.endswith('.dat'):
+                segment = Segment(os.path.join(directory, filename), segment_size)
+                self.segments.append(segment)
+                for offset, name, first, last in segment.chunks():
+                    self._index.setdefault(name, []).append((segment, offset, first, last))
+                    self._last[name] = max(last, self._last.get(name, last))
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def append(self, name, timestamp, record):
+        timestamp = int(timestamp)
+        with self._lock:
+            last = self._last.get(name)
+            if last is not None and timestamp <= last:
+                return
+            self._last[name] = timestamp
+            pending = self._pending.get(name)
+            if pending is None:
+                pending = self._pending[name] = (time.monotonic(), array('q'), {f: array('d') for f in self.fields})
+            started, timestamps, columns = pending
+            timestamps.append(timestamp)
+            for f in self.fields:
+                try:
+                    value = float(record[f])
+                except (KeyError, TypeError, ValueError):
+                    value = float('nan')
+                columns[f].append(value)
+            if len(timestamps) >= self.chunk_size or time.monotonic() - started > self.max_chunk_age:
+                self._write(name)
+
+    def _write(self, name):
+        """Write the pending chunk of `name`, it stays pending when that fails"""
+        started, timestamps, columns = self._pending[name]
+        try:
+            chunk = encode_chunk(name, timestamps, columns)
+            if not self.segments or self.segments[-1].free() < len(chunk):
+                path = os.path.join(self.directory, 'segment-%06d.dat' % len(self.segments))
+                self.segments.append(Segment(path, max(self.segment_size, len(chunk) + SEGMENT_HEADER.size)))
+            segment = self.segments[-1]
+            offset = segment.append(chunk)
+        except Exception as e:
+            print("archive error, series %s:" % name, e)
+            return
+        del self._pending[name]
+        self._index.setdefault(name, []).append((segment, offset, timestamps[0], timestamps[-1]))
+
+    def flush(self, max_age=None):
+        """Write the pending samples (only chunks older than `max_age` seconds if given) and
+        flush the segments to disk
+        """
+        now = time.monotonic()
+        with self._lock:
+            for name, (started, timestamps, columns) in list(self._pending.items()):
+                if max_age is None or now - started > max_age:
+                    self._write(name)
+            for segment in self.segments:
+                segment.flush()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush(self.max_chunk_age)
+            except Exception as e:
+                print("archive error:", e)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+
+    def names(self):
+        return sorted(set(self._index) | set(self._pending))
+
+    def query(self, name, field, since=None, until=None):
+        """Return (timestamps, values) of series `name` with `since <= timestamp <= until`
+
+        Without NumPy the results are `array`s, with NumPy they are NumPy arrays.
+        """
+        since = -(1 << 63) if since is None else since
+        until = (1 << 63) - 1 if until is None else until
+        ts_parts, value_parts = [], []
+        for segment, offset, first, last in list(self._index.get(name, ())):
+            if last < since or first > until:
+                continue
+            chunk_name, timestamps, columns = decode_chunk(segment.map, offset, (field,))
+            ts_parts.append(timestamps)
+            value_parts.append(columns[field])
+        with self._lock:
+            pending = self._pending.get(name)
+            if pending is not None:
+                ts_parts.append(array('q', pending[1]))
+                value_parts.append(array('d', pending[2][field]))
+        if numpy is not None:
+            timestamps = numpy.concatenate([numpy.asarray(p, dtype=numpy.int64) for p in ts_parts]) if ts_parts else numpy.empty(0, numpy.int64)
+            values = numpy.concatenate([numpy.asarray(p, dtype=numpy.float64) for p in value_parts]) if value_parts else numpy.empty(0)
+            mask = (timestamps >= since) & (timestamps <= until)
+            return timestamps[mask], values[mask]
+        # The samples of a series are in time order, the range of every part is found by bisection
+        timestamps, values = array('q'), array('d')
+        for ts_part, value_part in zip(ts_parts, value_parts):
+            lo = bisect_left(ts_part, since)
+            hi = bisect_right(ts_part, until)
+            timestamps.extend(ts_part[lo:hi])
+            values.extend(value_part[lo:hi])
+        return timestamps, values
+
+    def nbytes(self):
+        """Bytes used in the segment files"""
+        return sum(segment.used for segment in self.segments)
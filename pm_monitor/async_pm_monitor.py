@@ -0,0 +1,307 @@
+"""asyncio variant of the PMDcommunicator
+
+Instead of blocking reads with a timeout, the event loop watches the file descriptor of the serial port
+(loop.add_reader), and every time data arrives it is drained into the frame decoder.
+Command responses resolve the future of the command that waits for them, pushed datasets are put in a queue.
+This way one event loop can serve the PM Detector next to other sources, without a thread per source.
+
+Every method of the PMDcommunicator that talks to the PM Detector is overridden by a coroutine.
+readFrame() and dumpHistory() read the serial port themselves, which conflicts with the reader of the
+event loop; they raise NotImplementedError. run_async() backfills with a PMDcommunicator before it opens
+the port with the AsyncPMDcommunicator.
+
+Only supported where the serial port has a file descriptor that can be selected (Linux, macOS).
+
+Usage:
+    receiver = AsyncPMDcommunicator(find_ch340_comport())
+    await receiver.setStoreTime("000")
+    async for message, error_message in receiver.iter_messages("005"):
+        ...
+"""
+
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from .pm_monitor import PMDcommunicator
+
+
+class AsyncPMDcommunicator(PMDcommunicator):
+    def __init__(self, comPort, id=100, parameterTtl=30):
+        '''
+        Parameters
+        ----------
+        comPort : string, e.g. "/dev/ttyUSB0" the com port used by the USB to Serial CH340 driver.
+        id : int or string, the id of the PM Detector in the messages.
+        parameterTtl : int, seconds before the cached WritePoint is requested again, see PMDstate.
+
+            DESCRIPTION:
+                Same functions as the PMDcommunicator, but all methods that talk to the PM Detector are coroutines
+                (including the getters that may request the parameters). Must be used from a running event loop.
+        '''
+        super().__init__(comPort, id, parameterTtl)
+        # Non-blocking reads, the event loop tells us when data is available.
+        self.serialPort.timeout = 0
+        self.loop = None
+        self.fd = None
+        # Set when a read failed (e.g. the PM Detector was unplugged), the port has to be reopened.
+        self.readError = None
+        self.pending = {}
+        self.datasets = asyncio.Queue(maxsize=100)
+
+    def startReader(self):
+        if self.readError is not None:
+            raise self.readError
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.fd = self.serialPort.fileno()
+            self.loop.add_reader(self.fd, self.onReadable)
+
+    def stopReader(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop = None
+
+    def closePort(self):
+        self.stopReader()
+        self.serialPort.close()
+
+    def onReadable(self):
+        '''
+        DESCRIPTION:
+            Called by the event loop when data is available. Drains the read buffer and dispatches complete frames.
+        '''
+        try:
+            data = self.serialPort.read(self.serialPort.in_waiting or 1)
+        except Exception as e:
+            # Stop watching the fd, a closed pty stays readable and the loop would spin on it.
+            self.stopReader()
+            self.readError = IOError("ErrorType : {}, Error : {}".format(type(e).__name__, e))
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(self.readError)
+            # Wake up readDataset(), it raises the error.
+            if self.datasets.full():
+                self.datasets.get_nowait()
+            self.datasets.put_nowait(self.readError)
+            return
+        self.decoder.feed(data)
+        frames = self.decoder.frames
+        while frames:
+            PMData = frames.popleft()
+            try:
+                data_dict = self.decodeFrame(PMData)
+            except ValueError:
+                self.decodeErrors += 1
+                continue
+            if 'res' in data_dict:
+                future = self.pending.pop(int(data_dict['res']), None)
+                if future is not None and not future.done():
+                    future.set_result(data_dict)
+                continue
+            if self.datasets.full():
+                # Keep the most recent datasets.
+                self.datasets.get_nowait()
+            self.datasets.put_nowait(data_dict)
+
+    async def sendCommand(self, commandString, timeout=30):
+        '''
+        DESCRIPTION:
+            Send a command and wait for the response with the matching "res", see PMDcommunicator.sendCommand().
+
+        Returns
+        -------
+        dict, the response, or None if no matching response was received.
+        string, error message, or None if the response was received.
+        '''
+        if self.readError is not None:
+            return None, str(self.readError)
+        self.startReader()
+        fun = int(json.loads(commandString)['fun'])
+        future = self.loop.create_future()
+        self.pending[fun] = future
+        sent = time.monotonic()
+        try:
+            self.serialPort.write(commandString.encode('Ascii'))
+            response = await asyncio.wait_for(future, timeout)
+            self.observeCommand(fun, time.monotonic() - sent)
+            return response, None
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None, "Serial read: timeout" + " read buffer:" + str(self.getReadBuffer()) + " write buffer:" + str(self.getWriteBuffer())
+        except Exception as e:
+            error_message = "Serial: ErrorType : {}, Error : {}".format(type(e).__name__, e)
+            return None, error_message
+        finally:
+            if self.pending.get(fun) is future:
+                del self.pending[fun]
+
+    def readFrame(self, timeout=30):
+        raise NotImplementedError("the event loop reads the serial port, use readDataset() or sendCommand()")
+
+    def dumpHistory(self, timeout=30, idleTimeout=2):
+        raise NotImplementedError("dumpHistory() is not supported from the event loop, use a PMDcommunicator")
+
+    async def readDataset(self, timeout=30):
+        '''
+        Returns
+        -------
+        dict, the next pushed dataset, or None if no dataset was received.
+        string, error message, or None if a dataset was received.
+
+        Raises
+        ------
+        IOError if reading the serial port failed, the port has to be reopened.
+        '''
+        self.startReader()
+        try:
+            data_dict = await asyncio.wait_for(self.datasets.get(), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None, "timeout"
+        if isinstance(data_dict, Exception):
+            raise data_dict
+        return data_dict, None
+
+    async def setSendTime(self, sendTime, timeout=30):
+        if int(sendTime) > 999 or len(sendTime) != 3:
+            raise ValueError('Only string lengths of 3 are supported with a value between "000" to "999".')
+        sendTimeString = '{"fun":"01","sendtime":"' + sendTime.zfill(3) + '"}\n'
+        response, error_message = await self.sendCommand(sendTimeString, timeout)
+        if response is None:
+            return None
+        self.state.set(SendInteralTime=int(sendTime))
+
+    async def setStoreTime(self, storeTime, timeout=30):
+        if int(storeTime) > 999 or len(storeTime) != 3:
+            raise ValueError('Only string lengths of 3 are supported with a value between "000" to "999".')
+        storeTimeString = '{"fun":"02","storetime":"' + storeTime.zfill(3) + '"}\n'
+        response, error_message = await self.sendCommand(storeTimeString, timeout)
+        if response is None:
+            return None
+        self.state.set(StoreInteralTime=int(storeTime))
+
+    async def pushStartPMdetector(self, timeout=30):
+        initStartString = '{"fun":"05","flag":"1"}\n'
+        response, error_message = await self.sendCommand(initStartString, timeout)
+        if response is None:
+            return False, error_message
+        self.SendInteralFlag = True
+        return True, ''
+
+    async def pushStopPMdetector(self):
+        initStopString = '{"fun":"05","flag":"0"}\n'
+        self.serialPort.write(initStopString.encode('Ascii'))
+        self.SendInteralFlag = False
+
+    async def getPMdetectorParameters(self, timeout=30):
+        dumpString = '{"fun":"80"}\n'
+        jsonExport, error_message = await self.sendCommand(dumpString, timeout)
+        if jsonExport is None:
+            return None
+        self.storeParameters(jsonExport)
+        return jsonExport
+
+    async def getParameters(self, timeout=30):
+        if not self.state.isFresh():
+            await self.getPMdetectorParameters(timeout)
+        return self.state.asDict()
+
+    async def getSendTime(self):
+        if self.SendInteralTime == None:
+            await self.getPMdetectorParameters()
+        return self.SendInteralTime
+
+    async def getStoreTime(self):
+        if self.StoreInteralTime == None:
+            await self.getPMdetectorParameters()
+        return self.StoreInteralTime
+
+    async def getWritePoint(self):
+        if self.WritePoint == None or (self.StoreInteralTime and not self.state.isFresh()):
+            await self.getPMdetectorParameters()
+        return self.WritePoint
+
+    async def getReadPoint(self):
+        if self.ReadPoint == None:
+            await self.getPMdetectorParameters()
+        return self.ReadPoint
+
+    async def getSendFlag(self):
+        if self.SendInteralFlag == None:
+            await self.getPMdetectorParameters()
+        return self.SendInteralFlag
+
+    async def deletePMdetectorData(self, timeout=30):
+        deleteString = '{"fun":"06"}\n'
+        response, error_message = await self.sendCommand(deleteString, timeout)
+        if response is None:
+            return False
+        self.state.invalidate()
+        return True
+
+    async def readPMdetector(self, timeout=30):
+        error_message2 = ''
+        if not self.SendInteralFlag:
+            result, error_message2 = await self.pushStartPMdetector(timeout)
+        jsonExport, error_message = await self.readDataset(timeout)
+        if jsonExport is None:
+            return None, error_message, error_message2
+        return jsonExport, None, error_message2
+
+    async def setClock(self, timeout=30):
+        currentClock = datetime.now()
+        setClockString = '{"fun":"03","clock":"' + currentClock.strftime("%y-%m-%d %H:%M:%S") + '"}\n'
+        response, error_message = await self.sendCommand(setClockString, timeout)
+        if response is None:
+            return error_message
+        return "successfull setting clock"
+
+    async def get_message(self, timeout=30):
+        error_message2 = ''
+        if not self.SendInteralFlag:
+            result, error_message2 = await self.pushStartPMdetector(timeout)
+        data_dict, error_message = await self.readDataset(timeout)
+        if isinstance(data_dict, dict) and len(data_dict) == 16:
+            message_dict, error_message = self.toMessage(data_dict)
+            return message_dict, error_message, ''
+        if error_message is None:
+            error_message = "Lenght data_dict = " + str(len(data_dict)) + " data_dict = " + str(data_dict)
+        return None, error_message, error_message2
+
+    async def iter_messages(self, sendTime="005", timeout=30):
+        '''
+        DESCRIPTION:
+            Async iterator over the pushed messages, see PMDcommunicator.iter_messages().
+
+        Yields
+        ------
+        Message as a dict, or None if no valid message was received.
+        Error message as a string, '' if a message is yielded.
+
+        Raises
+        ------
+        IOError if reading the serial port failed, the caller should reopen the port.
+        '''
+        await self.setSendTime(sendTime, timeout)
+        result, error_message = await self.pushStartPMdetector(timeout)
+        if not result:
+            yield None, error_message
+        try:
+            while True:
+                data_dict, error_message = await self.readDataset(timeout)
+                if data_dict is None:
+                    yield None, error_message
+                    # No data within timeout, the PM Detector might have left push mode.
+                    result, error_message = await self.pushStartPMdetector(timeout)
+                    if not result:
+                        yield None, error_message
+                    continue
+                if len(data_dict) != 16:
+                    yield None, "Lenght data_dict = " + str(len(data_dict)) + " data_dict = " + str(data_dict)
+                    continue
+                yield self.toMessage(data_dict)
+        finally:
+            if self.readError is None:
+                await self.pushStopPMdetector()
@@ -0,0 +1,115 @@
+"""Backfill the SensorDatabase with the historical data stored in the PM Detector (function 04)
+
+After the host has been down, the PM Detector still stores a record every storetime seconds (up to 172800 records).
+The records are dumped in one stream, converted to messages and stored in batches.
+
+Progress is saved in a checkpoint file as the ReadPoint of the next record to store, together with the ReadPoint
+the dump started at. If the dump gets interrupted, the next backfill skips the records that were already stored.
+When the amount of records in the PM Detector (from its ReadPoint up to its WritePoint) has not grown since the
+checkpoint, nothing is dumped. Otherwise all records are dumped again: function 04 always starts at the ReadPoint,
+the protocol has no way to dump a range. Use `delete` to not dump records again.
+Records at or before the latest stored record of the sensor (e.g. replayed from the write-ahead log) are
+skipped by the SensorDatabase.
+"""
+
+import json
+import os
+
+from .pm_monitor import HISTORY_SIZE
+
+
+def load_checkpoint(checkpoint_path):
+    """Return the checkpoint as a dict, or None if there is no (valid) checkpoint."""
+    if checkpoint_path is None:
+        return None
+    try:
+        with open(checkpoint_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(checkpoint_path, start, read_point):
+    """Atomically replace the checkpoint file."""
+    if checkpoint_path is None:
+        return
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"start": start, "ReadPoint": read_point}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def has_new_records(receiver, checkpoint, attempts=3):
+    """Return False if the PM Detector holds no more records than the checkpoint says are stored.
+
+    The records stored are the ones from the checkpointed start up to its ReadPoint, the PM Detector holds
+    the records from its ReadPoint up to its WritePoint (function 80). The parameters are requested again
+    when a point can not be read (e.g. "ReadPoint":"y15455"), if they stay unreadable the records are dumped.
+    """
+    for attempt in range(attempts):
+        if not isinstance(receiver.getPMdetectorParameters(), dict):
+            continue
+        try:
+            read_point = int(receiver.ReadPoint)
+            count = (int(receiver.WritePoint) - read_point) % HISTORY_SIZE
+            stored = (int(checkpoint["ReadPoint"]) - int(checkpoint["start"])) % HISTORY_SIZE
+        except (KeyError, TypeError, ValueError):
+            receiver.state.invalidate()
+            continue
+        return checkpoint["start"] != read_point or count > stored
+    return True
+
+
+def backfill(receiver, db, checkpoint_path=None, batch_size=500, delete=False):
+    """Store the historical data of the PM Detector in the SensorDatabase.
+
+    Parameters
+    ----------
+    receiver : PMDcommunicator, the PM Detector to dump.
+    db : SensorDatabase, the database to store the messages in.
+    checkpoint_path : string, file to save the progress in, or None to always store all records.
+    batch_size : int, amount of messages per store_many() call and checkpoint.
+    delete : bool, delete the historical data in the PM Detector after a complete dump (function 06).
+
+    Returns
+    -------
+    int, the amount of stored messages (not counting the messages the SensorDatabase skipped).
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is not None and not has_new_records(receiver, checkpoint):
+        return 0
+    skipped = db.skipped
+    start = None
+    skip = None
+    stored = 0
+    batch = []
+    point = None
+    for point, data_dict in receiver.dumpHistory():
+        if start is None:
+            start = point
+            if checkpoint is not None and checkpoint.get("start") == start:
+                # Records from start up to the checkpointed ReadPoint are already stored.
+                skip = checkpoint["ReadPoint"]
+        if skip is not None:
+            if point != skip:
+                continue
+            skip = None
+        if len(data_dict) != 16:
+            continue
+        message, error_message = receiver.toMessage(data_dict)
+        if message is not None:
+            batch.append(message)
+        if len(batch) >= batch_size:
+            db.store_many(batch)
+            stored += len(batch)
+            batch = []
+            save_checkpoint(checkpoint_path, start, (point + 1) % HISTORY_SIZE)
+    if batch:
+        db.store_many(batch)
+        stored += len(batch)
+    stored -= db.skipped - skipped
+    if point is not None:
+        save_checkpoint(checkpoint_path, start, (point + 1) % HISTORY_SIZE)
+        if delete and receiver.deletePMdetectorData() and checkpoint_path is not None:
+            os.remove(checkpoint_path)
+    return stored
@@ -0,0 +1,110 @@
+"""Benchmarks of the serial path of the PMDcommunicator against the PMDsimulator
+
+No PM Detector needed, Linux only. Reports:
+    - the latency per command (functions 01, 02, 03, 05 and 80),
+    - the amount of pushed datasets per second that iter_messages() sustains,
+    - the CPU time per dataset,
+    - the throughput of the history dump (function 04).
+
+Usage:
+    python -m pm_monitor.benchmark
+    python -m pm_monitor.benchmark --max-latency-ms 50 --min-frames-per-second 500
+    The process exits with 1 if one of the given limits is not met, so it can be used as a regression test.
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+from .pm_monitor import PMDcommunicator
+from .simulator import PMDsimulator
+
+
+def command_latency(receiver, repeat):
+    """Return a dict of command name to a list of latencies in seconds."""
+    commands = {
+        "setSendTime (01)": lambda: receiver.sendCommand('{"fun":"01","sendtime":"000"}\n'),
+        "setStoreTime (02)": lambda: receiver.sendCommand('{"fun":"02","storetime":"000"}\n'),
+        "setClock (03)": receiver.setClock,
+        "pushStartPMdetector (05)": receiver.pushStartPMdetector,
+        "getPMdetectorParameters (80)": receiver.getPMdetectorParameters,
+    }
+    latencies = {}
+    for name, command in commands.items():
+        latencies[name] = []
+        for i in range(repeat):
+            startTime = time.perf_counter()
+            command()
+            latencies[name].append(time.perf_counter() - startTime)
+            if name.startswith("pushStart"):
+                receiver.pushStopPMdetector()
+    return latencies
+
+
+def push_throughput(receiver, frames):
+    """Return (datasets per second, CPU seconds per dataset, errors) for iter_messages()."""
+    errors = 0
+    messages = receiver.iter_messages("001")
+    # The first dataset includes the setup of push mode.
+    next(messages)
+    startTime = time.perf_counter()
+    startCpu = time.process_time()
+    for i in range(frames):
+        message, error_message = next(messages)
+        if message is None:
+            errors += 1
+    elapsed = time.perf_counter() - startTime
+    cpu = time.process_time() - startCpu
+    messages.close()
+    return frames / elapsed, cpu / frames, errors
+
+
+def dump_throughput(receiver):
+    """Return (records per second, records) for dumpHistory()."""
+    startTime = time.perf_counter()
+    records = sum(1 for point, data_dict in receiver.dumpHistory(idleTimeout=0.5))
+    return records / (time.perf_counter() - startTime), records
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("--repeat", type=int, default=50, help="repetitions per command")
+    argparser.add_argument("--frames", type=int, default=2000, help="pushed datasets to read")
+    argparser.add_argument("--push-interval", type=float, default=0.0005, help="seconds between pushed datasets")
+    argparser.add_argument("--history", type=int, default=5000, help="records in the simulated history")
+    argparser.add_argument("--garbage", type=float, default=0.0, help="probability of garbage per frame")
+    argparser.add_argument("--max-latency-ms", type=float, help="fail if a median command latency is higher")
+    argparser.add_argument("--min-frames-per-second", type=float, help="fail if fewer datasets per second are read")
+    args = argparser.parse_args(argv)
+
+    failed = False
+    with PMDsimulator(pushInterval=args.push_interval, historyRecords=args.history, garbage=args.garbage, seed=1) as simulator:
+        receiver = PMDcommunicator(simulator.port)
+
+        print("Command latency (ms)           median      p95      max")
+        for name, latencies in command_latency(receiver, args.repeat).items():
+            latencies = sorted(latencies)
+            median = statistics.median(latencies) * 1000
+            p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+            print("%-28s %9.2f %8.2f %8.2f" % (name, median, p95, latencies[-1] * 1000))
+            if args.max_latency_ms is not None and median > args.max_latency_ms:
+                failed = True
+
+        frames_per_second, cpu_per_frame, errors = push_throughput(receiver, args.frames)
+        print("Push datasets/s: %.0f, CPU per dataset: %.1f us, errors: %d" % (frames_per_second, cpu_per_frame * 1e6, errors))
+        if args.min_frames_per_second is not None and frames_per_second < args.min_frames_per_second:
+            failed = True
+
+        records_per_second, records = dump_throughput(receiver)
+        print("History dump: %d records, %.0f records/s" % (records, records_per_second))
+        receiver.closePort()
+
+    if failed:
+        print("Benchmark limits not met")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,351 @@
+"""Collectors (the sources of records) and the scheduler that runs them
+
+A Collector is polled: `collect()` returns the new records of the source. The Scheduler
+keeps all collectors in one hashed timer wheel, served by a single thread, and runs the
+due collectors on a small pool of worker threads, so adding a source does not add a thread.
+
+Per collector:
+- `interval` seconds between runs, plus a random `jitter` (fraction of the interval) so
+  sources with the same interval do not all fire at once,
+- or with `fixed_rate` runs at exact multiples of `interval` on time.monotonic() deadlines,
+  independent of how long a run takes (no drift, no jitter). A run that starts late is
+  reported, deadlines that passed during a long run are skipped and reported as missed,
+- `timeout`: a run that takes longer is reported, counted as a failure, and the scheduler
+  calls `interrupt()` of the collector. Python threads can not be interrupted, so
+  `interrupt()` must make the blocked run fail (the PM Detector collector closes its serial
+  port, setup() opens it again). That way a hung run holds a worker only until it
+  is interrupted, not forever. Every read and write of a PM Detector has its own timeout,
+  and so does every HTTP request of the outdoor humidity,
+- exponential backoff after failures, up to `max_backoff` seconds,
+- isolation: an exception only fails that run of that collector, it is reported and the
+  collector is set up again before its next run.
+A collector never runs concurrently with itself.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import math
+import random
+import threading
+import time
+import traceback
+
+from .backfill import backfill
+from .outdoor_humidity import get_message2
+
+
+class Collector(object):
+    """Base class of the sources, override `collect()` and optionally `setup()` and `close()`"""
+    name = None
+    interval = 30
+    jitter = 0.0
+    fixed_rate = False
+    timeout = 60
+    max_backoff = 600
+
+    def setup(self):
+        """Called before the first run, and again after a failed run"""
+        pass
+
+    def collect(self):
+        """Return a list of new records (dicts), may be empty"""
+        raise RuntimeError("collect method must be provided by sub-class")
+
+    def interrupt(self):
+        """Called from the scheduler thread when a run takes longer than `timeout`, should
+        make the blocked run fail (e.g. close its connection)
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class PMDetectorCollector(Collector):
+    """Records of one PM Detector in push mode
+
+    setup() sets the storetime, backfills the history the PM Detector stored while we were not
+    running (if it stores), sets the sendtime and starts push mode. collect() returns the
+    datasets that arrived since the previous run without waiting for new ones; push mode is
+    restarted when nothing arrived for three intervals. The clock is set every `clockInterval`
+    seconds of elapsed time.
+
+    Runs at a fixed rate of one sendtime, in step with the datasets of the PM Detector.
+    """
+    fixed_rate = True
+
+    def __init__(self, receiver, db, sendTime="005", storeTime="000", checkpoint_path=None, clockInterval=86400):
+        self.receiver = receiver
+        self.db = db
+        self.sendTime = sendTime
+        self.storeTime = storeTime
+        self.checkpoint_path = checkpoint_path
+        self.name = "PM Detector %s" % receiver.id
+        self.interval = int(sendTime)
+        if self.interval <= 0:
+            raise ValueError('sendTime must be "001" or more, push mode sends a dataset every sendtime seconds')
+        self.timeout = 30
+        self.clockInterval = clockInterval
+        self.last_dataset = None
+        self.last_clock = time.monotonic()
+        self.backfilled = False
+
+    def setup(self):
+        receiver = self.receiver
+        # Closed by interrupt() after a hung run
+        receiver.openPort()
+        receiver.setStoreTime(self.storeTime)
+        if not self.backfilled and receiver.getStoreTime():
+            # Store the data the PM Detector collected while we were not running.
+            print("backfilled messages:", backfill(receiver, self.db, self.checkpoint_path))
+        self.backfilled = True
+        receiver.setSendTime(self.sendTime)
+        result, error_message = receiver.pushStartPMdetector(self.timeout)
+        if not result:
+            raise IOError(error_message)
+        self.last_dataset = time.monotonic()
+
+    def collect(self):
+        receiver = self.receiver
+        messages = []
+        # Only read what is already there, a partial frame completes within milliseconds
+        while receiver.pushQueue or receiver.decoder.frames or receiver.getReadBuffer():
+            data_dict, error_message = receiver.readDataset(self.timeout)
+            if data_dict is None:
+                raise IOError(error_message)
+            if len(data_dict) != 16:
+                print("Lenght data_dict = " + str(len(data_dict)) + " data_dict = " + str(data_dict))
+                continue
+            message, error_message = receiver.toMessage(data_dict)
+            if message is None:
+                print("error =", error_message)
+                continue
+            print("message %s=" % receiver.id, message)
+            messages.append(message)
+        now = time.monotonic()
+        if messages:
+            self.last_dataset = now
+        elif now - self.last_dataset > 3 * self.interval:
+            # The PM Detector might have left push mode.
+            result, error_message = receiver.pushStartPMdetector(self.timeout)
+            if not result:
+                raise IOError(error_message)
+            self.last_dataset = now
+        if now - self.last_clock >= self.clockInterval:
+            self.last_clock = now
+            print("clock return:", receiver.setClock(self.timeout))
+        return messages
+
+    def interrupt(self):
+        # A blocked read or write fails on the closed port
+        self.receiver.closePort()
+
+    def close(self):
+        if self.receiver.serialPort.is_open:
+            self.receiver.pushStopPMdetector()
+
+
+class OutdoorHumidityCollector(Collector):
+    """The outdoor humidity (and temperature and pressure) of the Buienradar station"""
+    name = "Outdoor Humidity"
+    interval = 30
+    fixed_rate = True
+    timeout = 30
+
+    def collect(self):
+        message = get_message2()
+        print("message 110=", message)
+        if message is None:
+            return []
+        return [message]
+
+
+class CollectorState(object):
+    """Scheduling state of one collector"""
+    def __init__(self, collector):
+        self.collector = collector
+        self.name = collector.name or type(collector).__name__
+        self.ready = False
+        self.running = False
+        self.started = None
+        self.timed_out = False
+        self.tick = None
+        self.deadline = None
+        self.late = 0
+        self.missed = 0
+        self.max_lateness = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.records = 0
+        self.last_error = None
+        self.last_duration = None
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'interval': self.collector.interval,
+            'running': self.running,
+            'runs': self.runs,
+            'late': self.late,
+            'missed': self.missed,
+            'max_lateness': self.max_lateness,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'records': self.records,
+            'last_error': self.last_error,
+            'last_duration': self.last_duration,
+        }
+
+
+class Scheduler(object):
+    """Runs collectors from a hashed timer wheel on a pool of worker threads
+
+    The wheel has `slots` lists and advances one slot every `tick` seconds. A collector due
+    at tick T is kept in slot T % slots and fires when the wheel reaches tick T, so adding,
+    firing and rescheduling are O(1) regardless of the number of collectors.
+    Records returned by the collectors are stored in `db` with store_many().
+    """
+    def __init__(self, db, workers=4, tick=0.05, slots=512):
+        self.db = db
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        self.collectors = []
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="collector")
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._start = time.monotonic()
+        self._current = 0
+
+    def add(self, collector, delay=0):
+        """Add a collector, its first run is after `delay` seconds"""
+        if not collector.interval > 0:
+            raise ValueError("collector %s: interval must be more than 0" % (collector.name or type(collector).__name__))
+        state = CollectorState(collector)
+        with self._lock:
+            self.collectors.append(state)
+        self._schedule(state, time.monotonic() + delay)
+        return state
+
+    def status(self):
+        return [state.as_dict() for state in self.collectors]
+
+    def _now_tick(self):
+        return int((time.monotonic() - self._start) / self.tick)
+
+    def _schedule(self, state, deadline):
+        """Put the collector in the slot of the first tick at or after the monotonic `deadline`"""
+        with self._lock:
+            tick = max(self._current + 1, math.ceil((deadline - self._start) / self.tick))
+            state.deadline = deadline
+            state.tick = tick
+            self.slots[tick % len(self.slots)].append(state)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.executor.shutdown(wait=True)
+        for state in self.collectors:
+            try:
+                state.collector.close()
+            except Exception as e:
+                print("collector %s: close failed: %s" % (state.name, e))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            target = self._now_tick()
+            while self._current < target:
+                self._current += 1
+                self._fire(self._current)
+            self._check_timeouts()
+            next_time = self._start + (self._current + 1) * self.tick
+            self._stopped.wait(max(0, next_time - time.monotonic()))
+
+    def _fire(self, tick):
+        with self._lock:
+            slot = self.slots[tick % len(self.slots)]
+            due = [state for state in slot if state.tick <= tick]
+            if not due:
+                return
+            slot[:] = [state for state in slot if state.tick > tick]
+        now = time.monotonic()
+        for state in due:
+            lateness = now - state.deadline
+            state.max_lateness = max(state.max_lateness, lateness)
+            if lateness > max(2 * self.tick, 0.1 * state.collector.interval):
+                state.late += 1
+                print("collector %s: started %.3f seconds late" % (state.name, lateness))
+            state.running = True
+            state.timed_out = False
+            state.started = now
+            self.executor.submit(self._execute, state)
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+        for state in self.collectors:
+            started = state.started
+            if state.running and not state.timed_out and started is not None and now - started > state.collector.timeout:
+                state.timed_out = True
+                print("collector %s: no result within %s seconds, interrupting it" % (state.name, state.collector.timeout))
+                try:
+                    state.collector.interrupt()
+                except Exception as e:
+                    print("collector %s: interrupt failed: %s" % (state.name, e))
+
+    def _execute(self, state):
+        collector = state.collector
+        try:
+            if not state.ready:
+                # Setup (e.g. a backfill) may take long, the timeout applies to collect()
+                state.started = None
+                collector.setup()
+                state.ready = True
+                state.started = time.monotonic()
+            records = collector.collect()
+            if state.timed_out:
+                raise TimeoutError("run took %.1f seconds" % (time.monotonic() - state.started))
+            if records:
+                self.db.store_many(records)
+                state.records += len(records)
+            state.consecutive_failures = 0
+            state.last_error = None
+        except Exception as e:
+            state.failures += 1
+            state.consecutive_failures += 1
+            state.last_error = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+            state.ready = False
+            print("collector %s failed: %s" % (state.name, state.last_error))
+            traceback.print_exc()
+        finally:
+            state.runs += 1
+            if state.started is not None:
+                state.last_duration = time.monotonic() - state.started
+            state.running = False
+            try:
+                deadline = self._next_deadline(state)
+            except Exception as e:
+                # The collector must be scheduled again in any case
+                print("collector %s: scheduling failed: %s" % (state.name, e))
+                traceback.print_exc()
+                deadline = time.monotonic() + collector.max_backoff
+            self._schedule(state, deadline)
+
+    def _next_deadline(self, state):
+        collector = state.collector
+        now = time.monotonic()
+        if state.consecutive_failures:
+            # Backoff, a fixed rate collector continues on a new phase afterwards
+            return now + min(collector.max_backoff, collector.interval * 2 ** (state.consecutive_failures - 1)) * random.uniform(0.5, 1)
+        if collector.fixed_rate:
+            deadline = state.deadline + collector.interval
+            if deadline <= now:
+                missed = int((now - deadline) / collector.interval) + 1
+                state.missed += missed
+                deadline += missed * collector.interval
+                print("collector %s: missed %d tick(s)" % (state.name, missed))
+            return deadline
+        return now + collector.interval + random.uniform(0, collector.jitter * collector.interval)
@@ -0,0 +1,243 @@
+"""Push export of the stored records to a Prometheus remote-write endpoint or a Pushgateway
+
+The Exporter is registered as an observer of the SensorDatabase. Storing only appends the
+records to a bounded in-memory buffer; a background thread converts them to metrics
+(with the MetricMaker filters), batches them and uploads them, so a slow or unreachable
+endpoint never delays the serial ingest.
+
+Batches that could not be uploaded are written to a bounded on-disk queue and retried,
+oldest first, with exponential backoff. When the queue exceeds `max_queue_bytes` the
+oldest batches are dropped.
+"""
+from collections import deque
+import os
+import random
+import struct
+import threading
+import time
+
+import requests
+
+from .exposition import varint, field_bytes, field_string, field_double, field_varint, CONTENT_TYPES, FORMAT_TEXT
+from .sensor_database import parse_time
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+MODE_REMOTE_WRITE = 'remote_write'
+MODE_PUSHGATEWAY = 'pushgateway'
+
+
+def snappy_compress(data):
+    """Snappy block format, with python-snappy when installed, otherwise as literals only
+
+    A literal-only block is valid snappy (every receiver decodes it) but not smaller than
+    the input, the remote-write batches are small so that is acceptable.
+    """
+    if snappy is not None:
+        return snappy.compress(data)
+    out = [varint(len(data))]
+    for start in range(0, len(data), 1 << 16):
+        chunk = data[start:start + (1 << 16)]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(bytes([n << 2]))
+        elif n < 1 << 8:
+            out.append(bytes([60 << 2, n]))
+        else:
+            out.append(bytes([61 << 2]) + struct.pack('<H', n))
+        out.append(chunk)
+    return b"".join(out)
+
+
+def remote_write_request(samples):
+    """Encode a prometheus.WriteRequest of (labels dict, value, timestamp in ms) samples
+
+    Samples of the same series (equal labels) are combined into one TimeSeries.
+    """
+    series = {}
+    for labels, value, timestamp in samples:
+        key = tuple(sorted(labels.items()))
+        series.setdefault(key, []).append((value, timestamp))
+    data = []
+    for labels, points in series.items():
+        ts = b"".join(field_bytes(1, field_string(1, k) + field_string(2, v)) for k, v in labels)
+        ts += b"".join(field_bytes(2, field_double(1, value) + field_varint(2, timestamp)) for value, timestamp in points)
+        data.append(field_bytes(1, ts))
+    return b"".join(data)
+
+
+class Exporter(object):
+    """Background push exporter, see the module description
+
+    `mode` is MODE_REMOTE_WRITE (`url` is the remote-write endpoint) or MODE_PUSHGATEWAY
+    (`url` includes the grouping key, e.g. http://host:9091/metrics/job/pm_monitor).
+    """
+    def __init__(self, url, metric_maker, mode=MODE_REMOTE_WRITE, queue_directory="pm_monitor_export_queue",
+                 interval=15, batch_size=1000, max_pending=10000, max_queue_bytes=64 << 20,
+                 timeout=10, min_backoff=1, max_backoff=300):
+        if mode not in (MODE_REMOTE_WRITE, MODE_PUSHGATEWAY):
+            raise ValueError("Exporter mode %s not supported" % mode)
+        self.url = url
+        self.metric_maker = metric_maker
+        self.mode = mode
+        self.queue_directory = queue_directory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_queue_bytes = max_queue_bytes
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        # Records not yet converted, the oldest are dropped when the worker falls behind
+        self.pending = deque(maxlen=max_pending)
+        self.failures = 0
+        self.next_attempt = 0
+        self.sent = 0
+        self.dropped = 0
+        self._sequence = 0
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        os.makedirs(queue_directory, exist_ok=True)
+        queued = self.queued()
+        if queued:
+            self._sequence = int(queued[-1].split('.')[0]) + 1
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def observe(self, records):
+        """SensorDatabase observer, only buffers the records"""
+        self.pending.extend(records)
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def queued(self):
+        """File names in the retry queue, oldest first"""
+        return sorted(f for f in os.listdir(self.queue_directory) if f.endswith('.batch'))
+
+    def encode(self, records):
+        """Convert records to the request body of the mode, None if there is nothing to send"""
+        if self.mode == MODE_PUSHGATEWAY:
+            # The Pushgateway keeps only the latest value (without timestamp) per series
+            latest = {}
+            for r in records:
+                latest[tuple(sorted((k, str(v)) for k, v in r.items() if k in ('model', 'id', 'channel')))] = r
+            body = self.metric_maker.to_bytes(list(latest.values()))
+            return body if latest else None
+        samples = []
+        for r in records:
+            try:
+                timestamp = int(parse_time(r['time']) * 1000)
+            except (KeyError, TypeError, ValueError):
+                timestamp = int(time.time() * 1000)
+            for m in self.metric_maker.to_metrics([r]):
+                try:
+                    value = float(m.value)
+                except (TypeError, ValueError):
+                    continue
+                labels = dict(m.labels or {})
+                labels['__name__'] = m.name
+                samples.append((labels, value, timestamp))
+        if not samples:
+            return None
+        return snappy_compress(remote_write_request(samples))
+
+    def send(self, body):
+        """Upload one batch, return True when done (sent, or rejected as invalid)"""
+        if self.mode == MODE_PUSHGATEWAY:
+            headers = {'Content-Type': CONTENT_TYPES[FORMAT_TEXT]}
+        else:
+            headers = {
+                'Content-Type': 'application/x-protobuf',
+                'Content-Encoding': 'snappy',
+                'X-Prometheus-Remote-Write-Version': '0.1.0',
+            }
+        try:
+            response = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            print("export error:", e)
+            return False
+        if response.status_code < 300:
+            self.sent += 1
+            return True
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            # Retrying will not help, e.g. out of order samples
+            print("export rejected:", response.status_code, response.text[:200])
+            self.dropped += 1
+            return True
+        print("export error: HTTP", response.status_code)
+        return False
+
+    def _enqueue(self, body):
+        name = "%020d.batch" % self._sequence
+        self._sequence += 1
+        path = os.path.join(self.queue_directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+        # Keep the queue bounded, drop the oldest batches
+        files = self.queued()
+        sizes = [os.path.getsize(os.path.join(self.queue_directory, f)) for f in files]
+        total = sum(sizes)
+        for f, size in zip(files, sizes):
+            if total <= self.max_queue_bytes:
+                break
+            os.remove(os.path.join(self.queue_directory, f))
+            total -= size
+            self.dropped += 1
+
+    def _backoff(self):
+        self.failures += 1
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (self.failures - 1))
+        self.next_attempt = time.monotonic() + delay * random.uniform(0.5, 1)
+
+    def _drain_queue(self):
+        """Send the queued batches oldest first, return False if one failed"""
+        for name in self.queued():
+            path = os.path.join(self.queue_directory, name)
+            with open(path, 'rb') as f:
+                body = f.read()
+            if not self.send(body):
+                return False
+            os.remove(path)
+        return True
+
+    def flush(self):
+        """Convert and upload the pending records, queue them on failure"""
+        records = []
+        while self.pending and len(records) < self.batch_size:
+            records.append(self.pending.popleft())
+        body = self.encode(records) if records else None
+        if time.monotonic() < self.next_attempt:
+            if body is not None:
+                self._enqueue(body)
+            return
+        if not self._drain_queue():
+            if body is not None:
+                self._enqueue(body)
+            self._backoff()
+            return
+        if body is not None and not self.send(body):
+            self._enqueue(body)
+            self._backoff()
+            return
+        self.failures = 0
+
+    def _run(self):
+        while not self._closed.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                while len(self.pending) >= self.batch_size and not self.failures:
+                    self.flush()
+            except Exception as e:
+                print("exporter error:", e)
+
+    def close(self):
+        self._closed.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
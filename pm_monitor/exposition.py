@@ -0,0 +1,193 @@
+"""Exposition formats of the /metrics route besides the Prometheus text format
+
+- OpenMetrics text (application/openmetrics-text),
+- Prometheus protobuf, length-delimited io.prometheus.client.MetricFamily messages
+  (encoded by hand, the wire format is small and stable, no protobuf dependency).
+
+Plus the content negotiation of the Accept and Accept-Encoding headers.
+"""
+import struct
+
+FORMAT_TEXT = 'text'
+FORMAT_OPENMETRICS = 'openmetrics'
+FORMAT_PROTOBUF = 'protobuf'
+
+CONTENT_TYPES = {
+    FORMAT_TEXT: 'text/plain; version=0.0.4; charset=utf-8',
+    FORMAT_OPENMETRICS: 'application/openmetrics-text; version=1.0.0; charset=utf-8',
+    FORMAT_PROTOBUF: 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited',
+}
+
+# io.prometheus.client.MetricType
+PROTOBUF_TYPES = {'counter': 0, 'gauge': 1, 'summary': 2, 'untyped': 3, 'histogram': 4}
+
+
+def _parse_accept(header):
+    """Yield (media type, parameters dict, q) of an Accept style header"""
+    for item in header.split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for p in parts[1:]:
+            k, _, v = p.partition('=')
+            params[k.strip().lower()] = v.strip().strip('"')
+        try:
+            q = float(params.pop('q', 1))
+        except ValueError:
+            q = 0
+        yield parts[0].lower(), params, q
+
+
+def negotiate_format(accept):
+    """Return the best supported format for an Accept header, FORMAT_TEXT by default"""
+    best, best_q = FORMAT_TEXT, 0
+    for media_type, params, q in _parse_accept(accept or ''):
+        if media_type == 'application/vnd.google.protobuf':
+            if params.get('proto') != 'io.prometheus.client.MetricFamily' or params.get('encoding') != 'delimited':
+                continue
+            fmt = FORMAT_PROTOBUF
+        elif media_type == 'application/openmetrics-text':
+            fmt = FORMAT_OPENMETRICS
+        elif media_type in ('text/plain', 'text/*', '*/*'):
+            fmt = FORMAT_TEXT
+        else:
+            continue
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def accepts_gzip(accept_encoding):
+    for coding, params, q in _parse_accept(accept_encoding or ''):
+        if coding in ('gzip', '*') and q > 0:
+            return True
+    return False
+
+
+def openmetrics_header(description):
+    """The encoded '# HELP' and '# TYPE' lines of a MetricDescription in OpenMetrics
+
+    The family name of a counter is the metric name without the '_total' suffix, the
+    samples keep the suffix.
+    """
+    name = description.name
+    if description.type == 'counter' and name.endswith('_total'):
+        name = name[:-len('_total')]
+    help = description.help.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return ("# HELP %s %s\n# TYPE %s %s\n" % (name, help, name, description.type)).encode('utf-8')
+
+
+def openmetrics_text(headers, groups, eof=True):
+    """Render the families as OpenMetrics text
+
+    `headers` is a list of (metric name, encoded header from openmetrics_header()),
+    `groups` maps the metric name to its samples. The sample lines are the same as in the
+    Prometheus text format, there are no blank lines and the output ends with the
+    mandatory '# EOF' (leave it out with `eof=False` to append more families).
+    Counter names are expected to end in '_total'.
+    """
+    parts = []
+    for name, header in headers:
+        parts.append(header)
+        parts.extend(m.to_bytes() for m in groups[name])
+    if eof:
+        parts.append(b"# EOF\n")
+    return b"".join(parts)
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field_bytes(number, data):
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+def field_string(number, value):
+    return field_bytes(number, str(value).encode('utf-8'))
+
+
+def field_double(number, value):
+    return varint(number << 3 | 1) + struct.pack('<d', value)
+
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def _labels(m, exclude=None):
+    labels = m.labels or {}
+    return [(k, v) for k, v in labels.items() if k != exclude]
+
+
+def _metric(labels, body_field, body, timestamp):
+    data = b"".join(field_bytes(1, field_string(1, k) + field_string(2, v)) for k, v in labels)
+    data += field_bytes(body_field, body)
+    if timestamp is not None:
+        data += field_varint(6, int(timestamp) & 0xffffffffffffffff)
+    return data
+
+
+def protobuf_family(description, samples):
+    """Encode one MetricFamily, length-delimited
+
+    Histogram and summary samples (the _bucket/_sum/_count and quantile series) are
+    grouped by their labels into one Metric each. Samples with a value that is not a
+    number are left out.
+    """
+    type = description.type
+    family = description.name
+    metrics = []
+    if type in ('histogram', 'summary'):
+        # labels -> [buckets or quantiles, sum, count, timestamp]
+        grouped = {}
+        for m in samples:
+            exclude = 'le' if type == 'histogram' else 'quantile'
+            key = tuple(_labels(m, exclude))
+            entry = grouped.setdefault(key, [[], 0.0, 0, m.timestamp])
+            suffix = m.name[len(family):]
+            try:
+                value = float(m.value)
+            except (TypeError, ValueError):
+                continue
+            if suffix == '_sum':
+                entry[1] = value
+            elif suffix == '_count':
+                entry[2] = int(value)
+            elif suffix in ('_bucket', ''):
+                bound = (m.labels or {}).get(exclude)
+                if bound is not None and bound != '+Inf':
+                    entry[0].append((float(bound), value))
+        for labels, (points, total, count, timestamp) in grouped.items():
+            body = field_varint(1, count) + field_double(2, total)
+            for bound, value in points:
+                if type == 'histogram':
+                    body += field_bytes(3, field_varint(1, int(value)) + field_double(2, bound))
+                else:
+                    body += field_bytes(3, field_double(1, bound) + field_double(2, value))
+            metrics.append(_metric(labels, 7 if type == 'histogram' else 4, body, timestamp))
+    else:
+        body_field = {'counter': 3, 'gauge': 2}.get(type, 5)
+        for m in samples:
+            try:
+                value = float(m.value)
+            except (TypeError, ValueError):
+                continue
+            metrics.append(_metric(_labels(m), body_field, field_double(1, value), m.timestamp))
+    data = field_string(1, family) + field_string(2, description.help) + \
+        field_varint(3, PROTOBUF_TYPES.get(type, 3)) + b"".join(field_bytes(4, m) for m in metrics)
+    return varint(len(data)) + data
+
+
+def protobuf(descriptions, groups):
+    """Encode all families that have samples as length-delimited MetricFamily messages"""
+    return b"".join(protobuf_family(d, groups[d.name]) for d in descriptions if groups[d.name])
@@ -0,0 +1,198 @@
+"""Shared HTTP client of the external sources (outdoor humidity)
+
+One requests.Session per client keeps the connections to a host open between polls,
+every request has explicit connect and read timeouts.
+
+Responses are cached per URL (plus query parameters):
+- within the TTL the cached response is used without any request,
+- after the TTL the response is revalidated with If-None-Match / If-Modified-Since, an
+  unchanged feed then costs a 304 without a body and is not parsed again.
+The TTL is the max-age of the Cache-Control header of the response if it has one, otherwise
+the `ttl` of the request, which should match the update cadence of the feed.
+"""
+import json
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import Histogram
+
+# Buckets (seconds) of the request latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class CachedResponse(object):
+    """A cached response body with its validators
+
+    `version` is incremented every time a new body is received, so users can cache what
+    they derive from the body (see `json()`).
+    """
+    __slots__ = ('url', 'body', 'value', 'etag', 'last_modified', 'expires', 'version', '_json')
+
+    def __init__(self, url):
+        self.url = url
+        self.body = None
+        # What get_extracted() kept of the body, instead of the body
+        self.value = None
+        self.etag = None
+        self.last_modified = None
+        self.expires = 0
+        self.version = 0
+        self._json = None
+
+    def json(self):
+        """The body parsed as JSON, parsed once per version. Do not modify the result."""
+        if self._json is None or self._json[0] != self.version:
+            self._json = (self.version, json.loads(self.body))
+        return self._json[1]
+
+
+class CachedHttpClient(object):
+    def __init__(self, connect_timeout=3.05, read_timeout=10, pool_maxsize=4):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._cache = {}
+        # Counters, e.g. for monitoring the sources
+        self.requests = 0
+        self.not_modified = 0
+        self.cache_hits = 0
+        self.errors = 0
+        # Duration of the requests that were sent (not of the cache hits), including the body
+        self.latency = Histogram('pm_monitor_http_fetch_duration_seconds', LATENCY_BUCKETS)
+
+    def get(self, url, params=None, ttl=60):
+        """GET `url`, from the cache when possible
+
+        Returns
+        -------
+        CachedResponse, or None if no response was obtained and nothing is cached.
+        string, error message, or None on success. A cached response that could not be
+        revalidated is returned together with the error message.
+        """
+        key = (url, tuple(sorted(params.items())) if params else ())
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                entry = self._cache[key] = CachedResponse(url)
+        now = time.monotonic()
+        if entry.body is not None and now < entry.expires:
+            self.cache_hits += 1
+            return entry, None
+
+        headers = {}
+        if entry.body is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            self.requests += 1
+            response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.errors += 1
+            error_message = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+            return (entry if entry.body is not None else None), error_message
+        finally:
+            self.latency.observe(time.monotonic() - now)
+
+        if response.status_code == 304 and entry.body is not None:
+            self.not_modified += 1
+        elif response.status_code == 200:
+            entry.body = response.content
+            entry.etag = response.headers.get('ETag')
+            entry.last_modified = response.headers.get('Last-Modified')
+            entry.version += 1
+        else:
+            self.errors += 1
+            error_message = "HTTP status {}".format(response.status_code)
+            return (entry if entry.body is not None else None), error_message
+        entry.expires = now + max_age(response.headers.get('Cache-Control'), ttl)
+        return entry, None
+
+    def get_extracted(self, url, extract, cache_key, params=None, ttl=60):
+        """GET `url` as a stream and cache only what `extract` returns
+
+        `extract` is called with an iterator over the chunks of the body and may stop
+        reading early; the remainder is read without processing so the connection can be
+        reused. `cache_key` identifies the extraction, e.g. the station that is extracted.
+
+        Returns
+        -------
+        The value returned by `extract`, or None if there is no value.
+        string, error message, or None on success.
+        """
+        key = (url, tuple(sorted(params.items())) if params else (), cache_key)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                entry = self._cache[key] = CachedResponse(url)
+        now = time.monotonic()
+        if entry.version and now < entry.expires:
+            self.cache_hits += 1
+            return entry.value, None
+
+        headers = {}
+        if entry.version:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            self.requests += 1
+            with self.session.get(url, params=params, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code == 304 and entry.version:
+                    self.not_modified += 1
+                elif response.status_code == 200:
+                    chunks = response.iter_content(16 * 1024)
+                    try:
+                        value = extract(chunks)
+                    except ValueError as e:
+                        self.errors += 1
+                        return entry.value, "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+                    for chunk in chunks:
+                        pass
+                    entry.value = value
+                    entry.etag = response.headers.get('ETag')
+                    entry.last_modified = response.headers.get('Last-Modified')
+                    entry.version += 1
+                else:
+                    self.errors += 1
+                    return entry.value, "HTTP status {}".format(response.status_code)
+        except requests.RequestException as e:
+            self.errors += 1
+            return entry.value, "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+        finally:
+            self.latency.observe(time.monotonic() - now)
+        entry.expires = now + max_age(response.headers.get('Cache-Control'), ttl)
+        return entry.value, None
+
+    def get_json(self, url, params=None, ttl=60):
+        """Same as get(), returns the parsed JSON (shared, do not modify) instead of the response"""
+        entry, error_message = self.get(url, params, ttl)
+        if entry is None:
+            return None, error_message
+        try:
+            return entry.json(), error_message
+        except ValueError as e:
+            return None, "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+
+
+def max_age(cache_control, default):
+    """The max-age of a Cache-Control header, `default` if there is none (0 for no-cache)"""
+    if not cache_control:
+        return default
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return int(match.group(1)) if match else default
+
+
+# Shared by the sources in this process
+client = CachedHttpClient()
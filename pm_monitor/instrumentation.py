@@ -0,0 +1,127 @@
+"""Self-instrumentation: the internal metrics of pm_monitor, exposed on /metrics
+
+The hot paths only update plain counters and unlocked histograms of the object that owns
+them: the frame decoder and PMDcommunicator of a serial port (used by one thread at a
+time), the HTTP client, the scheduler and the exporter. Nothing on those paths is shared or
+locked for the instrumentation; the counters are read here, at scrape time, and converted
+to samples.
+"""
+from . import exposition
+from .metrics import MetricDescription, MetricMaker, Histogram, Sample, registry
+
+# Buckets (seconds) of the /metrics render time
+RENDER_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+DESCRIPTIONS = [
+    MetricDescription('pm_monitor_serial_bytes_total', 'counter', 'Bytes read from the serial port of the PM Detector'),
+    MetricDescription('pm_monitor_serial_frames_total', 'counter', 'Complete frames decoded from the serial data'),
+    MetricDescription('pm_monitor_serial_skipped_bytes_total', 'counter', 'Bytes outside of a frame or not ASCII, skipped by the decoder'),
+    MetricDescription('pm_monitor_serial_resyncs_total', 'counter', 'Incomplete frames dropped because a new frame started'),
+    MetricDescription('pm_monitor_serial_timeouts_total', 'counter', 'Reads and commands without a result within their timeout'),
+    MetricDescription('pm_monitor_serial_decode_errors_total', 'counter', 'Frames that were not valid JSON'),
+    MetricDescription('pm_monitor_command_duration_seconds', 'histogram', 'Time from sending a command to the PM Detector to its response, per function'),
+    MetricDescription('pm_monitor_http_fetch_duration_seconds', 'histogram', 'Duration of the requests of the outdoor humidity sources'),
+    MetricDescription('pm_monitor_http_requests_total', 'counter', 'Requests of the outdoor humidity sources'),
+    MetricDescription('pm_monitor_http_not_modified_total', 'counter', 'Requests answered with 304 Not Modified'),
+    MetricDescription('pm_monitor_http_cache_hits_total', 'counter', 'Fetches served from the cache without a request'),
+    MetricDescription('pm_monitor_http_errors_total', 'counter', 'Requests that failed'),
+    MetricDescription('pm_monitor_db_sensors', 'gauge', 'Sensors in the SensorDatabase'),
+    MetricDescription('pm_monitor_db_stores_total', 'counter', 'Stores (batches of records) in the SensorDatabase'),
+    MetricDescription('pm_monitor_db_history_samples', 'gauge', 'Samples in the in-memory history of all sensors'),
+    MetricDescription('pm_monitor_db_history_bytes', 'gauge', 'Memory of the in-memory history of all sensors'),
+    MetricDescription('pm_monitor_wal_records', 'gauge', 'Records in the write-ahead log'),
+    MetricDescription('pm_monitor_archive_bytes', 'gauge', 'Bytes used in the archive segment files'),
+    MetricDescription('pm_monitor_collector_runs_total', 'counter', 'Runs of the collector'),
+    MetricDescription('pm_monitor_collector_failures_total', 'counter', 'Failed runs of the collector'),
+    MetricDescription('pm_monitor_collector_records_total', 'counter', 'Records returned by the collector'),
+    MetricDescription('pm_monitor_collector_late_total', 'counter', 'Runs that started late'),
+    MetricDescription('pm_monitor_collector_missed_total', 'counter', 'Fixed rate ticks skipped because a run took too long'),
+    MetricDescription('pm_monitor_collector_up', 'gauge', '1 if the last run of the collector succeeded'),
+    MetricDescription('pm_monitor_collector_duration_seconds', 'gauge', 'Duration of the last run of the collector'),
+    MetricDescription('pm_monitor_export_sent_total', 'counter', 'Batches uploaded by the exporter'),
+    MetricDescription('pm_monitor_export_dropped_total', 'counter', 'Batches dropped by the exporter (rejected, or queue full)'),
+    MetricDescription('pm_monitor_export_pending', 'gauge', 'Records waiting to be exported'),
+    MetricDescription('pm_monitor_export_consecutive_failures', 'gauge', 'Failed uploads since the last successful one'),
+    MetricDescription('pm_monitor_render_duration_seconds', 'histogram', 'Time to render /metrics'),
+]
+
+
+class Instrumentation(object):
+    """Collects the internal metrics of the parts that are given, all are optional
+
+    `receivers` are the PMDcommunicators, `http_client` the CachedHttpClient of the outdoor
+    sources. The server observes `render_duration` for every /metrics request.
+    """
+    def __init__(self, db=None, receivers=(), scheduler=None, exporter=None, http_client=None):
+        self.db = db
+        self.receivers = list(receivers)
+        self.scheduler = scheduler
+        self.exporter = exporter
+        self.http_client = http_client
+        self.render_duration = Histogram('pm_monitor_render_duration_seconds', RENDER_BUCKETS)
+        self.metric_maker = MetricMaker(DESCRIPTIONS, [])
+
+    def samples(self):
+        samples = []
+        for receiver in self.receivers:
+            labels = {'pm_detector': str(receiver.id)}
+            decoder = receiver.decoder
+            for name, value in (('pm_monitor_serial_bytes_total', decoder.bytesFed),
+                                ('pm_monitor_serial_frames_total', decoder.frameCount),
+                                ('pm_monitor_serial_skipped_bytes_total', decoder.skippedBytes),
+                                ('pm_monitor_serial_resyncs_total', decoder.resyncs),
+                                ('pm_monitor_serial_timeouts_total', receiver.timeouts),
+                                ('pm_monitor_serial_decode_errors_total', receiver.decodeErrors)):
+                samples.append(Sample(registry.get(name, labels), value))
+            for fun, histogram in sorted(receiver.commandLatency.items()):
+                samples.extend(histogram.samples())
+
+        client = self.http_client
+        if client is not None:
+            samples.extend(client.latency.samples())
+            for name, value in (('pm_monitor_http_requests_total', client.requests),
+                                ('pm_monitor_http_not_modified_total', client.not_modified),
+                                ('pm_monitor_http_cache_hits_total', client.cache_hits),
+                                ('pm_monitor_http_errors_total', client.errors)):
+                samples.append(Sample(registry.get(name), value))
+
+        db = self.db
+        if db is not None:
+            snapshot = db.snapshot()
+            histories = list(db.histories.values())
+            samples.append(Sample(registry.get('pm_monitor_db_sensors'), len(snapshot.sensors)))
+            samples.append(Sample(registry.get('pm_monitor_db_stores_total'), snapshot.generation))
+            samples.append(Sample(registry.get('pm_monitor_db_history_samples'), sum(len(h) for h in histories)))
+            samples.append(Sample(registry.get('pm_monitor_db_history_bytes'), sum(h.nbytes() for h in histories)))
+            if db.wal is not None:
+                samples.append(Sample(registry.get('pm_monitor_wal_records'), db.wal.records))
+            if db.archive is not None:
+                samples.append(Sample(registry.get('pm_monitor_archive_bytes'), db.archive.nbytes()))
+
+        if self.scheduler is not None:
+            for state in self.scheduler.collectors:
+                labels = {'collector': state.name}
+                for name, value in (('pm_monitor_collector_runs_total', state.runs),
+                                    ('pm_monitor_collector_failures_total', state.failures),
+                                    ('pm_monitor_collector_records_total', state.records),
+                                    ('pm_monitor_collector_late_total', state.late),
+                                    ('pm_monitor_collector_missed_total', state.missed),
+                                    ('pm_monitor_collector_up', int(state.runs > 0 and not state.consecutive_failures))):
+                    samples.append(Sample(registry.get(name, labels), value))
+                if state.last_duration is not None:
+                    samples.append(Sample(registry.get('pm_monitor_collector_duration_seconds', labels), state.last_duration))
+
+        exporter = self.exporter
+        if exporter is not None:
+            for name, value in (('pm_monitor_export_sent_total', exporter.sent),
+                                ('pm_monitor_export_dropped_total', exporter.dropped),
+                                ('pm_monitor_export_pending', len(exporter.pending)),
+                                ('pm_monitor_export_consecutive_failures', exporter.failures)):
+                samples.append(Sample(registry.get(name), value))
+
+        samples.extend(self.render_duration.samples())
+        return samples
+
+    def render(self, format=exposition.FORMAT_TEXT):
+        """The internal metrics in `format`, to be passed as `extra` to MetricMaker.encode()"""
+        return self.metric_maker.render(self.samples(), format)
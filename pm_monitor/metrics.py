@@ -1,4 +1,11 @@
 from functools import reduce
+from array import array
+from bisect import bisect_left
+import math
+import threading
+import zlib
+
+from . import exposition
 
 class MetricDescription(object):
     ALLOWED_TYPES = ['counter', 'gauge', 'histogram', 'summary']
@@ -28,6 +35,12 @@ class MetricFilter(object):
 
     def process(self, sensor_record):
         raise RuntimeError("process method must be provided by sub-class")
+
+    def observe(self, sensor_record):
+        """Called for every stored record that matches, e.g. to update a Histogram or Summary.
+        process() is only called for the latest record of a sensor at scrape time.
+        """
+        pass
     
     def filter(self, record):
         if not self.match(record):
@@ -42,50 +55,460 @@ class Metric(object):
         self.timestamp = timestamp
         self.labels = labels
 
+    @property
+    def family(self):
+        return self.name
+
     def to_string(self):
-        s = self.name
+        parts = [self.name]
         if self.labels is not None:
-            s += '{' + ",".join(["%s=\"%s\"" % (k,v) for k,v in self.labels.items()]) + '}'
-        s += " " + str(self.value)
+            parts.append('{' + ",".join(['%s="%s"' % kv for kv in self.labels.items()]) + '}')
+        parts.append(" ")
+        parts.append(str(self.value))
         if self.timestamp is not None:
-            self += " " + str(self.timestamp)
-        s += "\n"
-        return s
+            parts.append(" ")
+            parts.append(str(self.timestamp))
+        parts.append("\n")
+        return "".join(parts)
+
+    def to_bytes(self):
+        return self.to_string().encode('utf-8')
+
+def escape_label_value(value):
+    """Escape a label value for the exposition format (backslash, double quote and newline)"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Series(object):
+    """Interned identity of one time series: a metric name plus a label set
+
+    Created once by the SeriesRegistry. `prefix` is the pre-escaped, pre-encoded start of
+    every sample line of the series, e.g. b'pm2_5{sensor_id="PM-Monitor_100"} '.
+    """
+    __slots__ = ('name', 'labels', 'prefix', 'family')
+
+    def __init__(self, name, labels, family=None):
+        self.name = name
+        self.labels = labels
+        # The MetricDescription name, e.g. 'latency' for the series 'latency_bucket'
+        self.family = name if family is None else family
+        s = name
+        if labels:
+            s += '{' + ",".join(['%s="%s"' % (k, escape_label_value(v)) for k, v in labels]) + '}'
+        self.prefix = (s + " ").encode('utf-8')
+
+class SeriesRegistry(object):
+    """Interns (metric name, labels) pairs, so every series is formatted only once"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def __len__(self):
+        return len(self._series)
+
+    def get(self, name, labels=None, family=None):
+        """Return the Series of `name` with the `labels` dict (label order is kept)
+
+        `family` is the metric name of the description the series belongs to, if that
+        differs from `name` (the _bucket, _sum and _count series of a histogram).
+        """
+        key = (name, tuple(labels.items()) if labels else ())
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = Series(name, key[1], family)
+        return series
+
+# The registry used by series()
+registry = SeriesRegistry()
+
+def series(name, labels=None):
+    """Return the interned Series of `name` and `labels` from the default registry"""
+    return registry.get(name, labels)
+
+class Sample(object):
+    """A value of an interned Series, the cheap alternative to Metric
+
+    Filters can look up their series once (e.g. in __init__) and yield
+    `Sample(self.pm2_5, r['pm2_5'])`; rendering is a concatenation of the series prefix
+    and the value.
+    """
+    __slots__ = ('series', 'value', 'timestamp')
+
+    def __init__(self, series, value, timestamp=None):
+        self.series = series
+        self.value = value
+        self.timestamp = timestamp
+
+    @property
+    def name(self):
+        return self.series.name
+
+    @property
+    def family(self):
+        return self.series.family
+
+    @property
+    def labels(self):
+        return dict(self.series.labels)
+
+    def to_bytes(self):
+        if self.timestamp is None:
+            return b"%s%s\n" % (self.series.prefix, str(self.value).encode())
+        return b"%s%s %s\n" % (self.series.prefix, str(self.value).encode(), str(self.timestamp).encode())
+
+    def to_string(self):
+        return self.to_bytes().decode('utf-8')
+
+def format_bound(value):
+    """Format a bucket bound or quantile the way Prometheus clients do, e.g. '0.5', '10.0', '+Inf'"""
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+class Histogram(object):
+    """Prometheus histogram with fixed buckets, updated one observation at a time
+
+    Memory is fixed: one counter per bucket in an array, plus the sum and count. No
+    observations are kept. Declare it with MetricDescription(name, 'histogram', ...) and
+    yield `samples()` from a MetricFilter.process().
+
+    With `lock=False` observe() does not lock, for a histogram that is only updated by one
+    thread at a time (e.g. the latency of the commands to one serial port). A concurrent
+    samples() may then see an observation in the count but not yet in the sum.
+    """
+    def __init__(self, name, buckets, labels=None, registry=registry, lock=True):
+        bounds = sorted(float(b) for b in buckets)
+        if not bounds or bounds[-1] != math.inf:
+            bounds.append(math.inf)
+        self.name = name
+        self.bounds = bounds
+        # Not cumulative, the rendering accumulates
+        self.counts = array('Q', [0]) * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock() if lock else None
+        labels = dict(labels or {})
+        self.bucket_series = [registry.get(name + '_bucket', dict(labels, le=format_bound(b)), name) for b in bounds]
+        self.sum_series = registry.get(name + '_sum', labels, name)
+        self.count_series = registry.get(name + '_count', labels, name)
+
+    def observe(self, value):
+        value = float(value)
+        if value != value: # NaN
+            return
+        i = bisect_left(self.bounds, value)
+        if self._lock is None:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+            return
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        """Return the _bucket (cumulative), _sum and _count Samples"""
+        if self._lock is None:
+            counts = self.counts.tolist()
+            total, count = self.sum, self.count
+        else:
+            with self._lock:
+                counts = self.counts.tolist()
+                total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for series, c in zip(self.bucket_series, counts):
+            cumulative += c
+            samples.append(Sample(series, cumulative))
+        samples.append(Sample(self.sum_series, total))
+        samples.append(Sample(self.count_series, count))
+        return samples
+
+class _SketchStore(object):
+    """Counts per logarithmic bin index in an array of at most `max_bins` entries
+
+    When a new index does not fit, the lowest bins are merged into one, so the accuracy
+    of the highest values is kept.
+    """
+    def __init__(self, max_bins):
+        self.max_bins = max_bins
+        self.bins = array('Q')
+        self.offset = 0
+
+    def add(self, index):
+        bins = self.bins
+        if not bins:
+            self.offset = index
+            bins.append(0)
+        top = self.offset + len(bins) - 1
+        lo, hi = min(self.offset, index), max(top, index)
+        if hi - lo + 1 > self.max_bins:
+            lo = hi - self.max_bins + 1
+        if lo > self.offset:
+            # Merge the bins below `lo` into bin `lo`
+            merged = sum(bins[:lo - self.offset])
+            del bins[:lo - self.offset]
+            if not bins:
+                bins.append(0)
+            bins[0] += merged
+            self.offset = lo
+            top = lo + len(bins) - 1
+        elif lo < self.offset:
+            bins[0:0] = array('Q', [0]) * (self.offset - lo)
+            self.offset = lo
+        if hi > top:
+            bins.extend(array('Q', [0]) * (hi - top))
+        bins[max(index, lo) - self.offset] += 1
+
+    def items(self, reverse=False):
+        """Yield (index, count) of the non-empty bins"""
+        indexes = range(len(self.bins) - 1, -1, -1) if reverse else range(len(self.bins))
+        for i in indexes:
+            if self.bins[i]:
+                yield self.offset + i, self.bins[i]
+
+class QuantileSketch(object):
+    """Bounded quantile sketch with relative error guarantees (DDSketch)
+
+    Values are counted in logarithmic bins, quantiles are accurate to `relative_accuracy`
+    of the value. Memory is bounded by 2 * `max_bins` counters, positive and negative
+    values have their own bins and values closer to zero than `min_value` are counted as zero.
+    """
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, min_value=1e-9):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.positive = _SketchStore(max_bins)
+        self.negative = _SketchStore(max_bins)
+        self.zero_count = 0
+        self.count = 0
+
+    def _index(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value):
+        if value > self.min_value:
+            self.positive.add(self._index(value))
+        elif value < -self.min_value:
+            self.negative.add(self._index(-value))
+        else:
+            self.zero_count += 1
+        self.count += 1
+
+    def quantile(self, q):
+        """Return the value at quantile `q` (0 to 1), NaN when empty"""
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for index, count in self.negative.items(reverse=True):
+            seen += count
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index, count in self.positive.items():
+            seen += count
+            if seen > rank:
+                return self._value(index)
+        return self._value(self.positive.offset + len(self.positive.bins) - 1)
+
+class Summary(object):
+    """Prometheus summary with quantiles from a bounded QuantileSketch
+
+    Like the Histogram no observations are kept, memory is bounded by the sketch.
+    """
+    def __init__(self, name, quantiles=(0.5, 0.9, 0.99), labels=None, relative_accuracy=0.01, max_bins=2048, registry=registry):
+        self.name = name
+        self.quantiles = list(quantiles)
+        self.sketch = QuantileSketch(relative_accuracy, max_bins)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        labels = dict(labels or {})
+        self.quantile_series = [registry.get(name, dict(labels, quantile=format_bound(q))) for q in self.quantiles]
+        self.sum_series = registry.get(name + '_sum', labels, name)
+        self.count_series = registry.get(name + '_count', labels, name)
+
+    def observe(self, value):
+        value = float(value)
+        if value != value: # NaN
+            return
+        with self._lock:
+            self.sketch.add(value)
+            self.sum += value
+
+    def samples(self):
+        """Return the quantile, _sum and _count Samples"""
+        with self._lock:
+            samples = [Sample(series, self.sketch.quantile(q)) for series, q in zip(self.quantile_series, self.quantiles)]
+            samples.append(Sample(self.sum_series, self.sum))
+            samples.append(Sample(self.count_series, self.sketch.count))
+        return samples
 
 class MetricMaker(object):
     def __init__(self, metric_descriptions, metric_filters):
         self.descriptions = metric_descriptions
         self.filters = metric_filters
         # Memoize the names because we'll use them a lot
-        self._metric_names = [d.name for d in self.descriptions]
+        self._metric_names = set(d.name for d in self.descriptions)
+        self._headers = [(d.name, d.header().encode('utf-8')) for d in self.descriptions]
+        self._openmetrics_headers = [(d.name, exposition.openmetrics_header(d)) for d in self.descriptions]
+        self._build_index()
+        # (format, gzip) -> (generation, body, compressor, complete body) of the last
+        # rendering with a generation, see encode()
+        self._cache = {}
+        # (generation, metrics grouped by family), shared by the formats
+        self._groups_cache = None
+
+    def _build_index(self):
+        """Index the filters that only use `_match`, so a record is routed straight to the
+        filters that can match it instead of trying every filter.
+
+        Filters are grouped by the keys of their `_match` dict, e.g. ('id', 'model'). Per group
+        a dict maps the values of those keys to the filters. Filters that override match() or
+        filter(), or have unhashable `_match` values, are tried on every record.
+        """
+        # keys -> {values: [(position, filter)]}
+        self._index = {}
+        self._unindexed = []
+        for position, f in enumerate(self.filters):
+            match = getattr(f, '_match', None)
+            indexable = type(f).match is MetricFilter.match and type(f).filter is MetricFilter.filter \
+                and isinstance(match, dict)
+            if indexable:
+                keys = tuple(sorted(match))
+                try:
+                    self._index.setdefault(keys, {}).setdefault(tuple(match[k] for k in keys), []).append((position, f))
+                    continue
+                except TypeError:
+                    pass
+            self._unindexed.append((position, f))
 
     def to_metrics(self, records):
         """Convert a list of dicts to a list of metrics using the provided filters
+
+        The metrics are ordered by filter, then by record.
         """
-        metrics = []
         # Each filter may generate any number of metrics, or none
-        for f in self.filters:
-            for r in records:
-                for m in f.filter(r):
-                    if m.name not in self._metric_names:
-                        raise ValueError("Tried to create metric %s, but no description was provided. Provide a MetricDescription to MetricMaker constructor.")
-                    metrics.append(m)
-        
+        per_filter = [[] for f in self.filters]
+        for r in records:
+            for position, f in self._indexed_matches(r):
+                per_filter[position].extend(f.process(r))
+            for position, f in self._unindexed:
+                per_filter[position].extend(f.filter(r))
+
+        metrics = []
+        for generated in per_filter:
+            for m in generated:
+                if m.family not in self._metric_names:
+                    raise ValueError("Tried to create metric %s, but no description was provided. Provide a MetricDescription to MetricMaker constructor." % m.family)
+                metrics.append(m)
         return metrics
 
-    def to_string(self, records_or_metrics):
-        """Convert a list of records (dicts), or Metric objects to exposition format"""
-        s = ""
+    def _indexed_matches(self, r):
+        for keys, filters in self._index.items():
+            try:
+                matched = filters.get(tuple([r[k] for k in keys]))
+            except (KeyError, TypeError):
+                continue
+            if matched is not None:
+                yield from matched
+
+    def observe(self, records):
+        """Pass every stored record to observe() of the filters that match it"""
+        for r in records:
+            for position, f in self._indexed_matches(r):
+                f.observe(r)
+            for position, f in self._unindexed:
+                if f.match(r):
+                    f.observe(r)
+
+    def to_string(self, records_or_metrics, generation=None):
+        """Convert a list of records (dicts), or Metric objects to exposition format
+
+        `generation` is any value that changes whenever the records change, e.g. the
+        generation of the SensorDatabase. When it equals the generation of the previous
+        call, the previous output is returned without rendering.
+        """
+        return self.to_bytes(records_or_metrics, generation).decode('utf-8')
+
+    def to_bytes(self, records_or_metrics, generation=None):
+        """Same as to_string(), encoded as UTF-8 (this is how it is rendered and cached)"""
+        return self.encode(records_or_metrics, generation)
+
+    def encode(self, records_or_metrics, generation=None, format=exposition.FORMAT_TEXT, compress=False, extra=b""):
+        """Render in `format` (see exposition.py), gzip compressed if `compress`
+
+        Every (format, compress) combination is cached per `generation` like to_string(),
+        so with unchanged data a scrape neither renders nor compresses the records.
+
+        `extra` is appended on every call, already rendered in the same format (see
+        render()), e.g. the self-instrumentation. When compressing, a copy of the compressor
+        state after the cached part continues with `extra`, so only `extra` is compressed.
+        """
+        key = (format, compress)
+        end = b"# EOF\n" if format == exposition.FORMAT_OPENMETRICS else b""
+        cached = self._cache.get(key)
+        if generation is None or cached is None or cached[0] != generation:
+            body = self.render(records_or_metrics, format, generation)
+            compressor = None
+            if compress:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # gzip container
+                body = compressor.compress(body)
+            cached = (generation, body, compressor, self._finish(body, compressor, end))
+            if generation is not None:
+                self._cache[key] = cached
+        generation, body, compressor, complete = cached
+        if not extra:
+            return complete
+        return self._finish(body, compressor, extra + end)
+
+    @staticmethod
+    def _finish(body, compressor, tail):
+        if compressor is None:
+            return body + tail
+        compressor = compressor.copy()
+        return body + compressor.compress(tail) + compressor.flush()
+
+    def render(self, records_or_metrics, format=exposition.FORMAT_TEXT, generation=None):
+        """Render in `format`, uncompressed and without the closing '# EOF' of OpenMetrics"""
+        groups = self._groups(records_or_metrics, generation)
+        if format == exposition.FORMAT_PROTOBUF:
+            return exposition.protobuf(self.descriptions, groups)
+        if format == exposition.FORMAT_OPENMETRICS:
+            return exposition.openmetrics_text(self._openmetrics_headers, groups, eof=False)
+        return self._render(groups)
+
+    def _groups(self, records_or_metrics, generation):
+        """Convert the records to metrics and group them by family in one pass"""
+        cached = self._groups_cache
+        if generation is not None and cached is not None and cached[0] == generation:
+            return cached[1]
         if len(records_or_metrics) > 0 and isinstance(records_or_metrics[0], dict):
             metrics = self.to_metrics(records_or_metrics)
         else:
             metrics = records_or_metrics
 
-        for d in self.descriptions:
-            s += d.header()
-            lines = filter(lambda m: m.name == d.name, metrics)
-            for l in lines:
-                s += l.to_string()
-            s += "\n" # blank line for readability only
-        
-        return s
+        groups = {name: [] for name, header in self._headers}
+        for m in metrics:
+            group = groups.get(m.family)
+            if group is not None:
+                group.append(m)
+        if generation is not None:
+            self._groups_cache = (generation, groups)
+        return groups
+
+    def _render(self, groups):
+        parts = []
+        for name, header in self._headers:
+            parts.append(header)
+            parts.extend(m.to_bytes() for m in groups[name])
+            parts.append(b"\n") # blank line for readability only
+        return b"".join(parts)
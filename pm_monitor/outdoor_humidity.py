@@ -9,23 +9,33 @@ Description:
     The output will be used by PM-monitor which expects a JSON formatted output with a timestamp, sensor model, sensor_id and the humidity value.
 
 ToDo:
-    - Verify what is the current timeout?.
     - A specific debug option might also be an option.
 Done:
+    - Explicit connect and read timeouts, a persistent session and a response cache with revalidation (http_client.py).
     - Add a try except error handling for e.g. timeouts.
     - Add exception handling for exceptions (e.g. KeyError) in humidity = str(response[key]) and return None, for both get_humidity...() functions.
 
 Preparation on Linux:
     - Create an environment variable $CITY for the city of interest e.g. in ~/.profile.
     - Create an environment variable $OWM_API_KEY for the personal API key to use with openweathermap.org e.g. in ~/.profile.
+    - Optionally create an environment variable $PM_MONITOR_BUIENRADAR_STATION with the id (e.g. 6275) or the name
+      (e.g. "Arnhem" or "Meetstation Arnhem") of the Buienradar station, by default the second station of the feed is used.
 
 """
 #Obtain Outdoor Humidity
 
-import requests
 from datetime import datetime
+import codecs
+import json
 import os
 
+from .http_client import client
+
+# Seconds a response is used without asking the server again. Both sources update about
+# every 10 minutes; after the TTL an unchanged feed costs a 304 (Not Modified) only.
+OWM_TTL = 300
+BUIENRADAR_TTL = 60
+
 
 def get_humidity():
     """Obtain the outdoor humidity value for $CITY from openweathermap.org via API"""
@@ -39,10 +49,8 @@ def get_humidity():
     querystring = {"q":city, 'appid':api_key, 'units':'metric'}
 
     #Call API
-    try:
-        response = requests.request("GET", url, params=querystring)
-        response = response.json()
-    except Exception as e:
+    response, error_message = client.get_json(url, params=querystring, ttl=OWM_TTL)
+    if response is None:
         return None
     else:
         try:
@@ -52,22 +60,105 @@ def get_humidity():
             return None
 
 
-def get_humidity_buienradar():
+# Fields of a Buienradar station that are kept
+STATION_FIELDS = ('stationid', 'stationname', 'timestamp', 'humidity', 'temperature', 'airpressure')
+
+
+def station_matches(measurement, station):
+    """True if `station` (id or name, case insensitive, with or without "Meetstation ") is this measurement"""
+    station = str(station).strip().lower()
+    name = str(measurement.get('stationname', '')).lower()
+    return str(measurement.get('stationid')) == station or name == station or name == "meetstation " + station
+
+
+def extract_station(chunks, station=None, fields=STATION_FIELDS):
+    """Extract one station from the byte chunks of the Buienradar feed, incrementally
+
+    Only the text up to "stationmeasurements" is scanned, then the measurements are decoded one
+    object at a time until `station` (see station_matches) is found; the rest of the feed is
+    not parsed. Without `station` the second measurement is used (the previous behaviour).
+
+    Returns a dict with the `fields` of the station, or None if the station is not in the feed.
+    Raises ValueError if the feed can not be parsed.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    marker = '"stationmeasurements"'
+    buffer = ''
+    pos = None # position in the buffer within the measurements array, None before it
+    index = 0
+    chunks = iter(chunks)
+    done = False
+    while True:
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+            buffer += text_decoder.decode(b'', final=True)
+        else:
+            buffer += text_decoder.decode(chunk)
+        if pos is None:
+            found = buffer.find(marker)
+            if found < 0:
+                # Keep only what could be the start of the marker
+                buffer = buffer[-len(marker):]
+                if done:
+                    return None
+                continue
+            start = buffer.find('[', found + len(marker))
+            if start < 0:
+                if done:
+                    raise ValueError("stationmeasurements is not a list")
+                continue
+            buffer = buffer[start + 1:]
+            pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                return None
+            try:
+                measurement, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if done:
+                    raise
+                # Incomplete object, wait for the next chunk
+                break
+            if isinstance(measurement, dict) and (station_matches(measurement, station) if station else index == 1):
+                return {k: measurement[k] for k in fields if k in measurement}
+            index += 1
+            pos = end
+        buffer = buffer[pos:]
+        pos = 0
+        if done:
+            raise ValueError("stationmeasurements is not terminated")
+
+
+def get_station_buienradar(station=None):
+    """Obtain the measurements of one Buienradar station, see extract_station().
+
+    `station` defaults to $PM_MONITOR_BUIENRADAR_STATION.
+
+    Returns
+    -------
+    dict of STATION_FIELDS, or None if the station is not available.
+    string, error message, or None.
+    """
     url = 'https://data.buienradar.nl/2.0/feed/json'
-    
-    #Call API
-    try:
-        response = requests.request("GET", url)
-        response = response.json()
-    except Exception as e:
-        #print("ErrorType : {}, Error : {}".format(type(e).__name__, e))
+    if station is None:
+        station = os.getenv('PM_MONITOR_BUIENRADAR_STATION')
+
+    #Call API, only the extracted station is cached
+    return client.get_extracted(url, lambda chunks: extract_station(chunks, station), ('station', station), ttl=BUIENRADAR_TTL)
+
+
+def get_humidity_buienradar():
+    measurement, error_message = get_station_buienradar()
+    if measurement is None or 'humidity' not in measurement:
+        #print(error_message)
         return None
-    else:
-        try:
-            humidity = str(response['actual']['stationmeasurements'][1]['humidity'])
-            return humidity
-        except Exception as e:
-            return None
+    return str(measurement['humidity'])
 
 
 def get_message2(timeout=30):
@@ -77,15 +168,20 @@ def get_message2(timeout=30):
     -------
     Message as a dict, or None if no message is obtained from the API.
     """
-    outdoor_rh = get_humidity_buienradar()
+    measurement, error_message = get_station_buienradar()
     message_dict = {}
 
-    if outdoor_rh != None:
+    if measurement is not None and measurement.get('humidity') is not None:
         #construct timestamp
         message_dict["time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         message_dict["model"] = "Outdoor Humidity"
         message_dict["id"] = 110
-        message_dict["humidity"] = outdoor_rh
+        message_dict["humidity"] = str(measurement['humidity'])
+        # Not every station measures these
+        if measurement.get('temperature') is not None:
+            message_dict["temperature_C"] = str(measurement['temperature'])
+        if measurement.get('airpressure') is not None:
+            message_dict["pressure_hPa"] = str(measurement['airpressure'])
         return message_dict
     else:
         return None
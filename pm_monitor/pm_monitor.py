@@ -49,7 +49,6 @@ Version 2.0 2023-06-22 22:59:
     Return 'None' if PM2.5 reading is > 800
 Version 2.1 2023-06-25 23:45:
     Include the actual reading if PM2.5 reading is above 800 in error message
-
 	
 	
 @author: rhermsen
@@ -76,15 +75,215 @@ import serial
 import serial.tools.list_ports
 import json
 import time
+import collections
 from datetime import datetime
 
+from .metrics import Histogram
+
+
+# The WritePoint runs from "000000" up to "172800", after which it wraps.
+HISTORY_SIZE = 172801
+
+# All bytes outside of the ASCII range, e.g. the 0xf5 seen in "WritePoint":"\xf567295".
+NON_ASCII_BYTES = bytes(range(0x80, 0x100))
+
+# The longest frame of the PM Detector (a dataset) is about 300 bytes, anything longer is garbage.
+MAX_FRAME_SIZE = 1024
+
+# Buckets (seconds) of the command latency histograms, a response typically takes ~20ms.
+COMMAND_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class PMDframeDecoder(object):
+    def __init__(self):
+        '''
+        DESCRIPTION:
+            Incremental decoder for the '{...}' JSON frames send by the PM Detector.
+            Raw serial data is added with feed(), complete frames can be taken from self.frames.
+            Data outside of a frame (e.g. newlines or garbage) and non ASCII bytes (e.g. 0xf5) are skipped.
+            The PM Detector does not use nested JSON objects, so a '{' inside a frame means the frame was
+            incomplete and decoding restarts at that '{' (a resync).
+            Frames longer than MAX_FRAME_SIZE are skipped, so a '{' without '}' does not buffer garbage forever.
+            bytesFed, frameCount, skippedBytes and resyncs count since the start, for the self-instrumentation.
+
+        Returns
+        -------
+        None.
+        '''
+        self.buffer = bytearray()
+        self.frames = collections.deque()
+        self.bytesFed = 0
+        self.frameCount = 0
+        self.skippedBytes = 0
+        self.resyncs = 0
+
+    def feed(self, data):
+        '''
+        Parameters
+        ----------
+        data : bytes, raw data read from the serial port.
+
+        Returns
+        -------
+        int, the amount of complete frames available in self.frames.
+        '''
+        buffer = self.buffer
+        buffer += data
+        self.bytesFed += len(data)
+        while True:
+            start = buffer.find(b'{')
+            if start < 0:
+                self.skippedBytes += len(buffer)
+                buffer.clear()
+                break
+            end = buffer.find(b'}', start)
+            if end < 0:
+                if len(buffer) - start > MAX_FRAME_SIZE:
+                    # Too long for a frame, only a '{' near the end may still start one.
+                    last = buffer.rfind(b'{', start + 1)
+                    drop = last if last > 0 and len(buffer) - last <= MAX_FRAME_SIZE else len(buffer)
+                    self.skippedBytes += drop
+                    del buffer[:drop]
+                    continue
+                if start > 0:
+                    self.skippedBytes += start
+                    del buffer[:start]
+                break
+            restart = buffer.rfind(b'{', start, end)
+            if restart > start:
+                self.resyncs += 1
+            if end + 1 - restart > MAX_FRAME_SIZE:
+                self.skippedBytes += end + 1
+                del buffer[:end + 1]
+                continue
+            self.skippedBytes += restart
+            frame = bytes(buffer[restart:end + 1])
+            del buffer[:end + 1]
+            self.frameCount += 1
+            if frame.isascii():
+                self.frames.append(frame.decode("Ascii"))
+            else:
+                self.skippedBytes += len(frame)
+                frame = frame.translate(None, NON_ASCII_BYTES)
+                self.skippedBytes -= len(frame)
+                self.frames.append(frame.decode("Ascii"))
+        return len(self.frames)
+
+    def clear(self):
+        '''
+        DESCRIPTION:
+            Drop any partial and complete frames.
+        '''
+        self.buffer.clear()
+        self.frames.clear()
+
+
+class PMDstate(object):
+    FIELDS = ['SendInteralFlag', 'SendInteralTime', 'StoreInteralTime', 'WritePoint', 'ReadPoint']
+
+    def __init__(self, ttl=30):
+        '''
+        Parameters
+        ----------
+        ttl : int, seconds the parameters received from the PM Detector are considered fresh, None for no expiry.
+
+            DESCRIPTION:
+                Cached state of the PM Detector parameters (function 80).
+                A function 80 response is parsed once by update(), commands that change a parameter call set().
+                Only the WritePoint changes without a command from us (when the PM Detector stores data),
+                so the TTL is only relevant for the WritePoint.
+
+        Returns
+        -------
+        None.
+        '''
+        self.ttl = ttl
+        self.SendInteralFlag = None
+        self.SendInteralTime = None
+        self.StoreInteralTime = None
+        self.WritePoint = None
+        self.ReadPoint = None
+        self.updateTime = None
+        self.updateDatetime = None
+
+    def update(self, jsonExport):
+        '''
+        DESCRIPTION:
+            Store the values of a function 80 response.
+        '''
+        if int(jsonExport['SendInteralFlag']) == 1:
+            self.SendInteralFlag = True
+        elif int(jsonExport['SendInteralFlag']) == 0:
+            self.SendInteralFlag = False
+        self.SendInteralTime = int(jsonExport['SendInteralTime'])
+        self.StoreInteralTime = int(jsonExport['StoreInteralTime'])
+        self.WritePoint = jsonExport['WritePoint']
+        self.ReadPoint = jsonExport['ReadPoint']
+        self.updateTime = time.monotonic()
+        self.updateDatetime = datetime.now()
+
+    def set(self, **values):
+        '''
+        DESCRIPTION:
+            Update parameters after a command that changed them was confirmed, e.g. set(SendInteralTime=5).
+        '''
+        for name, value in values.items():
+            if name not in self.FIELDS:
+                raise AttributeError("Unknown PM Detector parameter %s" % name)
+            setattr(self, name, value)
+
+    def invalidate(self):
+        '''
+        DESCRIPTION:
+            Force the next getter to request the parameters from the PM Detector.
+        '''
+        self.WritePoint = None
+        self.ReadPoint = None
+        self.updateTime = None
+
+    def age(self):
+        '''
+        Returns
+        -------
+        float, seconds since the last function 80 response, or None if there was none.
+        '''
+        if self.updateTime is None:
+            return None
+        return time.monotonic() - self.updateTime
+
+    def isFresh(self):
+        '''
+        Returns
+        -------
+        bool, True if the last function 80 response is younger than the TTL.
+        '''
+        if self.updateTime is None:
+            return False
+        return self.ttl is None or self.age() < self.ttl
+
+    def asDict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+def stateProperty(name):
+    # Keeps self.SendInteralTime etc. working on the PMDcommunicator, the values live in the PMDstate.
+    return property(lambda self: getattr(self.state, name), lambda self, value: self.state.set(**{name: value}))
+
 
 class PMDcommunicator(object):
-    def __init__(self, comPort):
+    SendInteralFlag = stateProperty('SendInteralFlag')
+    SendInteralTime = stateProperty('SendInteralTime')
+    StoreInteralTime = stateProperty('StoreInteralTime')
+    WritePoint = stateProperty('WritePoint')
+    ReadPoint = stateProperty('ReadPoint')
+
+    def __init__(self, comPort, id=100, parameterTtl=30):
         '''
         Parameters
         ----------
         comPort : string, e.g. "COM4" the com port used by the USB to Serial CH340 driver.
+        id : int or string, the id of the PM Detector in the messages, must be unique per PM Detector.
+        parameterTtl : int, seconds before the cached WritePoint is requested again, see PMDstate.
         
             DESCRIPTION:
                 Class to communicate with the PM Detector. After instantiation the following is possible.
@@ -109,23 +308,182 @@ class PMDcommunicator(object):
         None.
         '''
         self.comPort = comPort
+        self.id = id
         self.baudrate = 115200
         self.bytesize = 8
         self.timeout = 2
+        # A write to a stalled device fails instead of blocking the caller forever.
+        self.writeTimeout = 2
         self.stopbits = serial.STOPBITS_ONE
-        self.serialPort = serial.Serial(port=self.comPort, baudrate=self.baudrate, bytesize=self.bytesize, timeout=self.timeout, stopbits=self.stopbits)
-        self.SendInteralTime = None
-        self.StoreInteralTime = None
-        self.WritePoint = None
-        self.ReadPoint = None
-        self.SendInteralFlag = None
+        self.serialPort = serial.Serial(port=self.comPort, baudrate=self.baudrate, bytesize=self.bytesize, timeout=self.timeout,
+                                        write_timeout=self.writeTimeout, stopbits=self.stopbits)
+        self.state = PMDstate(parameterTtl)
         self.writepointerror = None
         self.readpointerror = None
-        self.getParameterTime = None
+        self.decoder = PMDframeDecoder()
+        # Datasets received while waiting for a command response.
+        self.pushQueue = collections.deque(maxlen=100)
+        # Self-instrumentation, see observeCommand().
+        self.timeouts = 0
+        self.decodeErrors = 0
+        self.commandLatency = {}
     
 
+    @property
+    def getParameterTime(self):
+        return self.state.updateDatetime
+
+
+    def openPort(self):
+        '''
+        DESCRIPTION:
+            Open the serial port again after closePort(), partial frames of the previous connection are dropped.
+        '''
+        if not self.serialPort.is_open:
+            self.decoder.clear()
+            self.serialPort.open()
+
+
     def closePort(self):
         self.serialPort.close()
+
+
+    def observeCommand(self, fun, seconds):
+        '''
+        DESCRIPTION:
+            Add the time from sending a command to its response to the latency histogram of the function.
+            Only one thread uses the serial port at a time, so the histograms are not locked.
+        '''
+        histogram = self.commandLatency.get(fun)
+        if histogram is None:
+            labels = {'pm_detector': str(self.id), 'function': '%02d' % fun}
+            histogram = self.commandLatency[fun] = Histogram('pm_monitor_command_duration_seconds', COMMAND_LATENCY_BUCKETS, labels, lock=False)
+        histogram.observe(seconds)
+
+
+    def readFrame(self, timeout=30):
+        '''
+        DESCRIPTION:
+            Read one complete '{...}' frame from the serial port.
+            All bytes waiting in the read buffer are drained in one read call and fed to the frame decoder,
+            so a frame costs a few system calls instead of one per character.
+
+        Parameters
+        ----------
+        timeout : int, seconds to wait for a complete frame.
+
+        Returns
+        -------
+        string, the frame, or None if no frame was received.
+        string, error message, or None if a frame was received.
+        '''
+        frames = self.decoder.frames
+        startTime = time.time()
+        while not frames:
+            try:
+                data = self.serialPort.read(self.serialPort.in_waiting or 1)
+            except Exception as e:
+                error_message = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+                return None, error_message
+            if data:
+                self.decoder.feed(data)
+            # Also when data arrives, garbage or partial frames must not extend the wait.
+            if not frames and time.time() - startTime > timeout:
+                self.timeouts += 1
+                return None, "timeout"
+        return frames.popleft(), None
+
+
+    def decodeFrame(self, PMData):
+        '''
+        DESCRIPTION:
+            Convert a frame to a dictionary.
+            The function 80 response ends with ',}', the trailing comma is removed before decoding.
+
+        Returns
+        -------
+        dict, the decoded frame.
+        '''
+        if len(PMData) > 2 and PMData[-2] == ',':
+            PMData = PMData[:-2] + PMData[-1]
+        return json.loads(PMData)
+
+
+    def sendCommand(self, commandString, timeout=30):
+        '''
+        Parameters
+        ----------
+        commandString : string, the command e.g. '{"fun":"80"}\n'.
+        timeout : int, seconds to wait for the response.
+
+            DESCRIPTION:
+                Send a command to the PM Detector and wait for the response with the matching "res".
+                Returns as soon as the response is received, instead of waiting a fixed time.
+                Datasets received in the meantime are added to pushQueue, responses for other functions are dropped.
+
+        Returns
+        -------
+        dict, the response, or None if no matching response was received.
+        string, error message, or None if the response was received.
+        '''
+        fun = int(json.loads(commandString)['fun'])
+        sent = time.monotonic()
+        try:
+            self.serialPort.write(commandString.encode('Ascii'))
+        except Exception as e:
+            error_message = "Serial write: ErrorType : {}, Error : {}".format(type(e).__name__, e)
+            return None, error_message
+        deadline = time.time() + timeout
+        while True:
+            PMData, error_message = self.readFrame(deadline - time.time())
+            if PMData is None:
+                if error_message == "timeout":
+                    error_message = error_message + " read buffer:" + str(self.getReadBuffer()) + " write buffer:" + str(self.getWriteBuffer())
+                return None, "Serial read: " + error_message
+            try:
+                data_dict = self.decodeFrame(PMData)
+            except Exception as e:
+                self.decodeErrors += 1
+                if time.time() > deadline:
+                    error_message = "JSON decode PMData: ErrorType : {}, Error : {}".format(type(e).__name__, e)
+                    return None, error_message + str(PMData)
+                continue
+            if 'res' not in data_dict:
+                self.pushQueue.append(data_dict)
+            elif int(data_dict['res']) == fun:
+                self.observeCommand(fun, time.monotonic() - sent)
+                return data_dict, None
+            elif time.time() > deadline:
+                self.timeouts += 1
+                return None, "timeout waiting for response to function " + str(fun)
+
+
+    def readDataset(self, timeout=30):
+        '''
+        DESCRIPTION:
+            Read one dataset pushed by the PM Detector, datasets received earlier by sendCommand() come first.
+            Late command responses are skipped.
+
+        Returns
+        -------
+        dict, the dataset, or None if no dataset was received.
+        string, error message, or None if a dataset was received.
+        '''
+        if self.pushQueue:
+            return self.pushQueue.popleft(), None
+        deadline = time.time() + timeout
+        while True:
+            PMData, error_message = self.readFrame(deadline - time.time())
+            if PMData is None:
+                return None, error_message
+            try:
+                data_dict = json.loads(PMData)
+            except Exception as e:
+                self.decodeErrors += 1
+                error_message = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+                return None, error_message + " " + PMData
+            if 'res' not in data_dict:
+                return data_dict, None
    
     
     def setSendTime(self, sendTime, timeout=30):
@@ -145,23 +503,10 @@ class PMDcommunicator(object):
             print('Only string lengths of 3 are supported with a value between "000" to "999".')
             exit(1)
         sendTimeString = '{"fun":"01","sendtime":"' + sendTime.zfill(3) + '"}\n' #Obtain data every pushData seconds.
-        self.serialPort.write(sendTimeString.encode('Ascii'))
-        time.sleep(0.5)
-        PMData = ' '
-        startTime = time.time()
-        while PMData[-1] != '}':
-            # https://stackoverflow.com/questions/606191/convert-bytes-to-a-string
-            try:
-                PMData += self.serialPort.read(1).decode("Ascii")
-            except:
-                return None
-            timeNow = time.time()
-            if timeNow - startTime > timeout:
-                return None
-        # https://www.geeksforgeeks.org/python-convert-string-dictionary-to-dictionary/
-        if int(json.loads(sendTimeString)['fun']) == int(json.loads(PMData)['res']):
-            pass
-        self.getPMdetectorParameters()
+        response, error_message = self.sendCommand(sendTimeString, timeout)
+        if response is None:
+            return None
+        self.state.set(SendInteralTime=int(sendTime))
     
 
     def setStoreTime(self, storeTime, timeout=30):
@@ -190,23 +535,10 @@ class PMDcommunicator(object):
             print('Only string lengths of 3 are supported with a value between "000" to "999".')
             exit(1)
         storeTimeString = '{"fun":"02","storetime":"' + storeTime.zfill(3) + '"}\n' #
-        self.serialPort.write(storeTimeString.encode('Ascii'))
-        time.sleep(0.5)
-        PMData = ' '
-        startTime = time.time()
-        while PMData[-1] != '}':
-            # https://stackoverflow.com/questions/606191/convert-bytes-to-a-string
-            try:
-                PMData += self.serialPort.read(1).decode("Ascii")
-            except:
-                return None
-            timeNow = time.time()
-            if timeNow - startTime > timeout:
-                return None
-        # https://www.geeksforgeeks.org/python-convert-string-dictionary-to-dictionary/
-        if int(json.loads(storeTimeString)['fun']) == int(json.loads(PMData)['res']):
-            pass
-        self.getPMdetectorParameters()
+        response, error_message = self.sendCommand(storeTimeString, timeout)
+        if response is None:
+            return None
+        self.state.set(StoreInteralTime=int(storeTime))
     
 
     def pushStartPMdetector(self, timeout=30):
@@ -219,48 +551,13 @@ class PMDcommunicator(object):
         -------
         bool, True if the push data sequence was successful confirmed by the PM Detector.
         '''
-        try:
-            initStartString = '{"fun":"05","flag":"1"}\n' #Start obtaining data with last submitted sendtime.
-            self.serialPort.write(initStartString.encode('Ascii'))
-            time.sleep(0.5)
-        except Exception as e:
-            error_message = "Serial write: ErrorType : {}, Error : {}".format(type(e).__name__, e)
-            return False, error_message
-        PMData = ' '
-        startTime = time.time()
-        while PMData[-1] != '}':
-            # https://stackoverflow.com/questions/606191/convert-bytes-to-a-string
-            try:
-                PMData += self.serialPort.read(1).decode("Ascii")
-            except Exception as e:
-                error_message = "Serial read: ErrorType : {}, Error : {}".format(type(e).__name__, e)
-                return False, error_message
-            timeNow = time.time()
-            if timeNow - startTime > timeout:
-                error_message = "Serial read: timeout" + " read buffer:" + str(self.getReadBuffer()) + " write buffer:" + str(self.getWriteBuffer())
-                return False, error_message
-        # https://www.geeksforgeeks.org/python-convert-string-dictionary-to-dictionary/
-        try:
-            if int(json.loads(initStartString)['fun']) == int(json.loads(PMData)['res']):
-                self.SendInteralFlag = True
-                error_message = ''
-                return True, error_message
-            else:
-                error_message = "Failed to start sending data via serial port"
-                return False, error_message
-        except Exception as e:
-            error_message = "JSON decode PMData: ErrorType : {}, Error : {}".format(type(e).__name__, e)
-            error_message = error_message + str(PMData) + str(len(PMData))
-            try:
-                error_message = error_message + " read buffer:" + str(self.getReadBuffer())
-            except:
-                pass
-            if len(PMData) >= 20:
-                # Received response much larger than expected. Correct response is probably still in serial buffer.
-                time.sleep(0.5)
-                self.clearReadBuffer()
-                time.sleep(0.5)
+        initStartString = '{"fun":"05","flag":"1"}\n' #Start obtaining data with last submitted sendtime.
+        response, error_message = self.sendCommand(initStartString, timeout)
+        if response is None:
             return False, error_message
+        self.SendInteralFlag = True
+        error_message = ''
+        return True, error_message
         
 
     def pushStopPMdetector(self):
@@ -268,10 +565,8 @@ class PMDcommunicator(object):
         Description:
             Send string to PM Detector to stop sending data via serial port.
             Note: There is no confirmation this was successful, serial output will just stop.
-            It will also flush any remaining characters from the input buffer.
-            There is a one second sleep to prevent any subsequent send command to become flushed.
-
-            NOTE: Take the 1 second sleep into account in the calling script.
+            Datasets that are still underway are not flushed, sendCommand() and readDataset() will pick them up.
+            Only waits until the command has been written to the serial port.
 
             Ref:
                 https://stackoverflow.com/questions/60766714/pyserial-flush-vs-reset-input-buffer-reset-output-buffer
@@ -282,12 +577,8 @@ class PMDcommunicator(object):
         '''
         initStopString = '{"fun":"05","flag":"0"}\n' #Start obtaining data with last submitted sendtime.
         self.serialPort.write(initStopString.encode('Ascii'))
+        self.serialPort.flush()
         self.SendInteralFlag = False
-        time.sleep(0.4)
-        self.clearWriteBuffer()
-        time.sleep(0.4)
-        self.clearReadBuffer()
-        time.sleep(0.2)
 
 
     def readPMdetector(self, timeout=30):
@@ -313,32 +604,18 @@ class PMDcommunicator(object):
         None.
         '''
         retry = 0
+        error_message2 = ''
         if self.SendInteralFlag == None or self.SendInteralFlag == False:
             retry += 1
             result, error_message2 = self.pushStartPMdetector()
 
         # https://stackoverflow.com/questions/26838953/python-read-from-serial-port-and-encode-as-json
-        PMData = ' '
-        startTime = time.time()
-        while PMData[-1] != '}':
-            # https://stackoverflow.com/questions/606191/convert-bytes-to-a-string
-            #PMData.append(serialPort.read(1).decode("utf-8"))
-            #PMData += serialPort.read(1).decode("utf-8")
-            try:
-                PMData += self.serialPort.read(1).decode("Ascii")
-            except Exception as e:
-                error_message = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
-                return None, error_message, error_message2
-            timeNow = time.time()
-            if timeNow - startTime > timeout:
-                error_message = "timeout" + " read buffer:" + str(self.getReadBuffer()) + " write buffer:" + str(self.getWriteBuffer())
-                return None, error_message, error_message2
-        try:
-            jsonExport = json.loads(PMData)
-            return jsonExport, None, error_message2
-        except Exception as e:
-            error_message = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+        jsonExport, error_message = self.readDataset(timeout)
+        if jsonExport is None:
+            if error_message == "timeout":
+                error_message = error_message + " read buffer:" + str(self.getReadBuffer()) + " write buffer:" + str(self.getWriteBuffer())
             return None, error_message, error_message2
+        return jsonExport, None, error_message2
 
 
     def getPMdetectorParameters(self, timeout = 30):
@@ -363,48 +640,38 @@ class PMDcommunicator(object):
         -------
         jsonExport : Dictionary, JSON format dictionary with the current parameters.
         '''
-        if self.SendInteralFlag == True:
-            self.pushStopPMdetector()
+        # Datasets pushed in the meantime are queued by sendCommand(), so push mode can stay active.
+        # Stray bytes like 0xf5 are skipped by the frame decoder.
         dumpString = '{"fun":"80"}\n'
-        self.serialPort.write(dumpString.encode('Ascii'))
-        time.sleep(0.5)
-        PMData = ' '
-        empty_buffer = 0
-        startTime = time.time()
-        while PMData[-1] != '}' and  empty_buffer <= 10:
-            if self.getReadBuffer() == 0:
-                empty_buffer += 1
-            # https://stackoverflow.com/questions/606191/convert-bytes-to-a-string
-            #PMData += self.serialPort.read(1).decode("Ascii")
-            #PMData += self.serialPort.read(1).decode("utf-8")
-            char = self.serialPort.read(1)
-            if char != b'\xf5':
-                try:
-                    PMData += char.decode("Ascii")
-                except:
-                    return None
-            timeNow = time.time()
-            if timeNow - startTime > timeout:
-                error_message = "timeout"
-                return error_message
-        if len(PMData) > 2 and PMData[-2] == ',':
-            PMData = PMData[:-2] + PMData[-1]
-            jsonExport = json.loads(PMData)
-        else:
+        jsonExport, error_message = self.sendCommand(dumpString, timeout)
+        if jsonExport is None:
+            if error_message.startswith("Serial read: timeout"):
+                return "timeout"
             return None
-        if int(json.loads(PMData)['res']) == 80:
-            #self.getParameterTime = str(datetime.now()).split(".")[0]
-            #self.getParameterTime = (datetime.strptime(self.iterationTime, '%Y-%m-%d %H:%M:%S'))
-            self.getParameterTime = datetime.now()
-            if int(json.loads(PMData)['SendInteralFlag']) == 1:
-                self.SendInteralFlag = True
-            elif int(json.loads(PMData)['SendInteralFlag']) == 0:
-                self.SendInteralFlag = False
-            self.SendInteralTime = int(json.loads(PMData)['SendInteralTime'])
-            self.StoreInteralTime = int(json.loads(PMData)['StoreInteralTime'])
-            self.WritePoint = json.loads(PMData)['WritePoint']
-            self.ReadPoint = json.loads(PMData)['ReadPoint']
-            return jsonExport
+        self.storeParameters(jsonExport)
+        return jsonExport
+
+
+    def storeParameters(self, jsonExport):
+        '''
+        DESCRIPTION:
+            Store the separate values of a function 80 response in the PMDstate.
+        '''
+        self.state.update(jsonExport)
+
+
+    def getParameters(self, timeout=30):
+        '''
+        DESCRIPTION:
+            Getter for all parameters, only requested from the PM Detector when the cached state is not fresh.
+
+        Returns
+        -------
+        dict, the parameters with the same names as the function 80 response.
+        '''
+        if not self.state.isFresh():
+            self.getPMdetectorParameters(timeout)
+        return self.state.asDict()
     
         
     def getSendTime(self):
@@ -444,12 +711,8 @@ class PMDcommunicator(object):
         -------
         string, the string value of the WritePoint. 
         '''
-        if self.WritePoint == None:
-            self.getPMdetectorParameters()
-        try:
-            if (datetime.now() - self.getParameterTime).total_seconds() >= 30:
-                self.getPMdetectorParameters()
-        except TypeError:
+        # The WritePoint only moves when the PM Detector stores data.
+        if self.WritePoint == None or (self.StoreInteralTime and not self.state.isFresh()):
             self.getPMdetectorParameters()
         return self.WritePoint
     
@@ -519,7 +782,8 @@ class PMDcommunicator(object):
         DESCRIPTION:
             Clear (setter) the read buffer of content received via serial port.
         """
-        self.serialPort.reset_input_buffer()    
+        self.serialPort.reset_input_buffer()
+        self.decoder.clear()
 
 
     def setClock(self, timeout=30):
@@ -540,34 +804,12 @@ class PMDcommunicator(object):
         # {"fun":"03","clock":"21-03-05 20:57:24"}}  {"res":"3"}                     (YY-MM-DD hh:mm:ss)
         currentClock = datetime.now()
         setClockString = '{"fun":"03","clock":"' + currentClock.strftime("%y-%m-%d %H:%M:%S")  + '"}\n'
-        try:
-            #print("Trying to set clock using string:", setClockString)
-            self.serialPort.write(setClockString.encode('Ascii'))
-            time.sleep(0.5)
-        except Exception as e:
-            error_message = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
+        #print("Trying to set clock using string:", setClockString)
+        response, error_message = self.sendCommand(setClockString, timeout)
+        if response is None:
             return error_message
-        PMData = ' '
-        startTime = time.time()
-        while PMData[-1] != '}':
-            # https://stackoverflow.com/questions/606191/convert-bytes-to-a-string
-            try:
-                PMData += self.serialPort.read(1).decode("Ascii")
-            except Exception as e:
-                error_message = "ErrorType : {}, Error : {}".format(type(e).__name__, e)
-                return error_message
-            timeNow = time.time()
-            if timeNow - startTime > timeout:
-                error_message = "timeout"
-                return error_message
-            #print('PMData =', PMData)
-        # https://www.geeksforgeeks.org/python-convert-string-dictionary-to-dictionary/
-        if int(json.loads(setClockString)['fun']) == int(json.loads(PMData)['res']):
-            message = "successfull setting clock"
-            return message
-        else:
-            message = "unsuccessfull setting clock without error"
-            return message
+        message = "successfull setting clock"
+        return message
         
     
     def get_message(self, timeout=30):
@@ -578,27 +820,10 @@ class PMDcommunicator(object):
         Message as a dict, or None if no message is obtained from the buffer.
         """
         data_dict, error_message, error_message2 = self.readPMdetector(timeout)
-        message_dict = {}
 
         if (isinstance(data_dict, dict)) and (len(data_dict) == 16):
-            #construct timestamp
-            message_dict["time"] = data_dict["y"] + \
-                                '-' + data_dict["m"] + \
-                                '-' + data_dict["d"] + \
-                                ' ' + data_dict["h"] + \
-                                ':' + data_dict["min"] + \
-                                ':' + data_dict["sec"]
-            message_dict["model"] = "PM-Monitor"
-            message_dict["id"] = 100
-            message_dict["temperature_C"] = data_dict["t"]
-            message_dict["humidity"] = data_dict["r"]
-            message_dict["pm2_5"] = data_dict["cpm2.5"]
-            message_dict["pm1_0"] = data_dict["cpm1.0"]
-            message_dict["pm10"] = data_dict["cpm10"]
-            if int(data_dict["cpm2.5"]) > 800:
-                return None, f'PM2.5 reading above 800, reading {data_dict["cpm2.5"]}', ''
-            else:
-            return message_dict, '', ''
+            message_dict, error_message = self.toMessage(data_dict)
+            return message_dict, error_message, ''
         else:
             if error_message == None:
                 error_message = "Lenght data_dict = " + str(len(data_dict)) + " data_dict = " + str(data_dict)
@@ -606,17 +831,164 @@ class PMDcommunicator(object):
                     error_message = error_message + " read buffer:" + str(self.getReadBuffer())
                 except:
                     pass 
-                try:
-                    if len(data_dict) == 1 and data_dict["res"] == "5":
-                        # Received the wrong response type. Correct response is probably still in serial buffer. 
-                        time.sleep(0.5)
-                        self.clearReadBuffer()
-                        time.sleep(0.5)
-                except Exception as e:
-                    pass
             return None, error_message, error_message2
 
 
+    def dumpHistory(self, timeout=30, idleTimeout=2):
+        '''
+        Parameters
+        ----------
+        timeout : int, seconds to wait for the first record.
+        idleTimeout : int, seconds to wait for a next record before the dump is considered complete.
+
+            DESCRIPTION:
+                Have the PM Detector dump all historical data (function 04), and yield the records as they arrive.
+                The amount of records is determined from the ReadPoint and WritePoint (function 80).
+                Push mode is stopped first, so pushed datasets do not mix with the historical records.
+
+        Yields
+        ------
+        int, the point of the record in the PM Detector memory.
+        dict, the record, in the same format as a pushed dataset.
+        '''
+        if self.SendInteralFlag == True:
+            self.pushStopPMdetector()
+        if not isinstance(self.getPMdetectorParameters(timeout), dict):
+            return
+        try:
+            readPoint = int(self.ReadPoint)
+            count = (int(self.WritePoint) - readPoint) % HISTORY_SIZE
+        except ValueError:
+            # e.g. "ReadPoint":"y15455", read until the dump stops.
+            readPoint = 0
+            count = None
+        if count == 0:
+            return
+        dumpString = '{"fun":"04"}\n'
+        try:
+            self.serialPort.write(dumpString.encode('Ascii'))
+        except Exception:
+            return
+        index = 0
+        while count is None or index < count:
+            PMData, error_message = self.readFrame(timeout if index == 0 else idleTimeout)
+            if PMData is None:
+                break
+            try:
+                data_dict = json.loads(PMData)
+            except Exception:
+                continue
+            if 'res' in data_dict:
+                if int(data_dict['res']) == 4 and index > 0:
+                    break
+                continue
+            yield (readPoint + index) % HISTORY_SIZE, data_dict
+            index += 1
+
+
+    def deletePMdetectorData(self, timeout=30):
+        '''
+        DESCRIPTION:
+            Delete all historical data stored in the PM Detector (function 06).
+
+        Returns
+        -------
+        bool, True if the PM Detector confirmed the deletion.
+        '''
+        deleteString = '{"fun":"06"}\n'
+        response, error_message = self.sendCommand(deleteString, timeout)
+        if response is None:
+            return False
+        self.state.invalidate()
+        return True
+
+
+    def toMessage(self, data_dict):
+        """Convert one dataset of the PM Detector (16 items) to a message.
+
+        Returns
+        -------
+        Message as a dict, or None if the PM2.5 reading is not plausible.
+        Error message as a string, '' if a message is returned.
+        """
+        message_dict = {}
+        #construct timestamp
+        message_dict["time"] = data_dict["y"] + \
+                            '-' + data_dict["m"] + \
+                            '-' + data_dict["d"] + \
+                            ' ' + data_dict["h"] + \
+                            ':' + data_dict["min"] + \
+                            ':' + data_dict["sec"]
+        message_dict["model"] = "PM-Monitor"
+        message_dict["id"] = self.id
+        message_dict["temperature_C"] = data_dict["t"]
+        message_dict["humidity"] = data_dict["r"]
+        message_dict["pm2_5"] = data_dict["cpm2.5"]
+        message_dict["pm1_0"] = data_dict["cpm1.0"]
+        message_dict["pm10"] = data_dict["cpm10"]
+        if int(data_dict["cpm2.5"]) > 800:
+            return None, f'PM2.5 reading above 800, reading {data_dict["cpm2.5"]}'
+        else:
+            return message_dict, ''
+
+
+    def iter_messages(self, sendTime="005", timeout=30):
+        """Stream messages from the PM Detector in push mode.
+
+        The sendtime is set (function 01) and push mode is started (function 05) once,
+        after that every dataset pushed by the PM Detector is yielded as it arrives.
+        Push mode is stopped again when the generator is closed.
+
+        Parameters
+        ----------
+        sendTime : string, a 3 digit string between "001" and "999", the period in seconds between datasets.
+        timeout : int, seconds to wait for a dataset before push mode is restarted.
+
+        Yields
+        ------
+        Message as a dict, or None if no valid message was received.
+        Error message as a string, '' if a message is yielded.
+        """
+        self.setSendTime(sendTime)
+        result, error_message = self.pushStartPMdetector(timeout)
+        if not result:
+            yield None, error_message
+        try:
+            while True:
+                data_dict, error_message = self.readDataset(timeout)
+                if data_dict is None:
+                    yield None, error_message
+                    if error_message == "timeout":
+                        # No data within timeout, the PM Detector might have left push mode.
+                        result, error_message = self.pushStartPMdetector(timeout)
+                        if not result:
+                            yield None, error_message
+                    continue
+                if len(data_dict) != 16:
+                    yield None, "Lenght data_dict = " + str(len(data_dict)) + " data_dict = " + str(data_dict)
+                    continue
+                yield self.toMessage(data_dict)
+        finally:
+            self.pushStopPMdetector()
+
+
+def find_ch340_comports():
+    """
+    Find the comports of all connected PM Monitors.
+    The identity of a PM Monitor is the USB serial number, or if the CH340 has none, the USB location (e.g. "1-1.2").
+    The location stays the same as long as the PM Monitor is connected to the same USB port.
+
+    Returns
+    -------
+    List of (comport, identity) tuples of strings, sorted on identity.
+    """
+    ch340portList = []
+    for port in serial.tools.list_ports.grep("CH340|USB Serial"):
+        identity = port.serial_number or port.location or port.device
+        ch340portList.append((port.device, identity))
+    return sorted(ch340portList, key=lambda p: p[1])
+
+
 def find_ch340_comport():
     """
     Find the comport of the PM Monitor. This function assumes there is only one ch340 device present.
@@ -0,0 +1,201 @@
+from bisect import bisect_left, bisect_right
+import math
+import threading
+
+from .timeseries import RingBuffer, HISTORY_FIELDS
+
+# Window length in seconds -> amount of closed windows kept per sensor
+# (2 days of minutes, 90 days of hours, 5 years of days)
+ROLLUP_RESOLUTIONS = {60: 2880, 3600: 2160, 86400: 1830}
+
+AGGREGATES = ('count', 'min', 'max', 'mean')
+
+
+class WindowSeries(object):
+    """Aggregates of one sensor at one resolution
+
+    The open window is kept as running count/sum/min/max per field, so a sample costs
+    O(1). When a sample falls into a later window the open window is closed: its start
+    and per field count, min, max and mean are appended to fixed capacity ring buffers.
+    Samples older than the open window (out of order) are ignored.
+    """
+    def __init__(self, resolution, capacity, fields=HISTORY_FIELDS):
+        self.resolution = resolution
+        self.fields = list(fields)
+        self.starts = RingBuffer(capacity, 'q')
+        self.closed = {f: {'count': RingBuffer(capacity, 'I'),
+                           'min': RingBuffer(capacity, 'd'),
+                           'max': RingBuffer(capacity, 'd'),
+                           'mean': RingBuffer(capacity, 'd')} for f in self.fields}
+        self.open_start = None
+        self._reset()
+
+    def _reset(self):
+        n = len(self.fields)
+        self.counts = [0] * n
+        self.sums = [0.0] * n
+        self.mins = [math.inf] * n
+        self.maxs = [-math.inf] * n
+
+    def _aggregates(self, i):
+        """count, min, max and mean of field `i` in the open window"""
+        count = self.counts[i]
+        if count:
+            return count, self.mins[i], self.maxs[i], self.sums[i] / count
+        return 0, math.nan, math.nan, math.nan
+
+    def _close(self):
+        self.starts.append(self.open_start)
+        for i, f in enumerate(self.fields):
+            for a, value in zip(AGGREGATES, self._aggregates(i)):
+                self.closed[f][a].append(value)
+        self._reset()
+
+    def add(self, timestamp, values):
+        """Add a sample, `values` are floats in the order of `fields`, NaN for missing"""
+        start = int(timestamp) // self.resolution * self.resolution
+        if self.open_start is None:
+            self.open_start = start
+        elif start != self.open_start:
+            if start < self.open_start:
+                return
+            self._close()
+            self.open_start = start
+        for i, value in enumerate(values):
+            if value != value: # NaN
+                continue
+            self.counts[i] += 1
+            self.sums[i] += value
+            if value < self.mins[i]:
+                self.mins[i] = value
+            if value > self.maxs[i]:
+                self.maxs[i] = value
+
+    def add_many(self, timestamps, columns):
+        """Add samples in time order in bulk, `columns` are lists of floats in the order of `fields`
+
+        Aggregates every window over slices of the columns, the result is the same as
+        calling add() for every sample.
+        """
+        resolution = self.resolution
+        times = [int(t) for t in timestamps]
+        # The closed windows, appended to the ring buffers at the end
+        starts = []
+        closed = [[[] for a in AGGREGATES] for f in self.fields]
+        # Only the columns with missing values have to be filtered
+        with_nan = {i for i, column in enumerate(columns) if any(value != value for value in column)}
+        lo = 0
+        n = len(times)
+        while lo < n:
+            start = times[lo] // resolution * resolution
+            hi = bisect_left(times, start + resolution, lo)
+            if self.open_start is None:
+                self.open_start = start
+            elif start != self.open_start:
+                if start < self.open_start:
+                    lo = hi
+                    continue
+                starts.append(self.open_start)
+                for i, aggregates in enumerate(closed):
+                    for values, value in zip(aggregates, self._aggregates(i)):
+                        values.append(value)
+                self._reset()
+                self.open_start = start
+            for i, column in enumerate(columns):
+                values = column[lo:hi]
+                if i in with_nan:
+                    values = [value for value in values if value == value] # not NaN
+                if not values:
+                    continue
+                self.counts[i] += len(values)
+                self.sums[i] = sum(values, self.sums[i])
+                self.mins[i] = min(self.mins[i], min(values))
+                self.maxs[i] = max(self.maxs[i], max(values))
+            lo = hi
+        self.starts.extend(starts)
+        for f, aggregates in zip(self.fields, closed):
+            for a, values in zip(AGGREGATES, aggregates):
+                self.closed[f][a].extend(values)
+
+    def range(self, since=None, until=None, fields=None, include_open=True):
+        """Return the windows that start between `since` and `until` as plain lists
+
+        The result has a 'time' entry with the window starts and per field a dict of
+        'count', 'min', 'max' and 'mean'. With `include_open` the open (still incomplete)
+        window is added as the last window.
+        """
+        fields = self.fields if fields is None else [f for f in fields if f in self.closed]
+        starts = self.starts.view()
+        lo = 0 if since is None else bisect_left(starts, since)
+        hi = len(starts) if until is None else bisect_right(starts, until)
+        result = {'time': starts[lo:hi].tolist()}
+        for f in fields:
+            result[f] = {a: self.closed[f][a].view()[lo:hi].tolist() for a in AGGREGATES}
+        start = self.open_start
+        if include_open and start is not None and (since is None or start >= since) and (until is None or start <= until):
+            result['time'].append(start)
+            for f in fields:
+                i = self.fields.index(f)
+                count = self.counts[i]
+                result[f]['count'].append(count)
+                result[f]['min'].append(self.mins[i] if count else math.nan)
+                result[f]['max'].append(self.maxs[i] if count else math.nan)
+                result[f]['mean'].append(self.sums[i] / count if count else math.nan)
+        return result
+
+
+class Rollup(object):
+    """Streaming min/max/mean/count aggregates per sensor for every resolution
+
+    Updated by the SensorDatabase for every stored record. Queries copy the requested
+    windows under a lock, so they never see a half updated window.
+    """
+    def __init__(self, resolutions=ROLLUP_RESOLUTIONS, fields=HISTORY_FIELDS):
+        self.resolutions = dict(resolutions)
+        self.fields = list(fields)
+        self._lock = threading.Lock()
+        # sensor key -> {resolution: WindowSeries}
+        self.series = {}
+
+    def add(self, key, timestamp, record):
+        values = []
+        for f in self.fields:
+            try:
+                values.append(float(record[f]))
+            except (KeyError, TypeError, ValueError):
+                values.append(math.nan)
+        with self._lock:
+            windows = self.series.get(key)
+            if windows is None:
+                windows = self.series[key] = {resolution: WindowSeries(resolution, capacity, self.fields)
+                                              for resolution, capacity in self.resolutions.items()}
+            for w in windows.values():
+                w.add(timestamp, values)
+
+    def add_many(self, key, timestamps, columns):
+        """Add the samples of sensor `key` in time order in bulk, `columns` has a list of
+        floats (see field_values()) per field
+        """
+        columns = [columns[f] for f in self.fields]
+        with self._lock:
+            windows = self.series.get(key)
+            if windows is None:
+                windows = self.series[key] = {resolution: WindowSeries(resolution, capacity, self.fields)
+                                              for resolution, capacity in self.resolutions.items()}
+            for w in windows.values():
+                w.add_many(timestamps, columns)
+
+    def keys(self):
+        with self._lock:
+            return list(self.series)
+
+    def query(self, key, resolution, since=None, until=None, fields=None, include_open=True):
+        """Get the windows of sensor `key`, see WindowSeries.range()
+
+        Returns None if `key` or `resolution` is unknown.
+        """
+        with self._lock:
+            w = self.series.get(key, {}).get(resolution)
+            if w is None:
+                return None
+            return w.range(since, until, fields, include_open)
@@ -1,77 +1,139 @@
 from .metrics import MetricMaker
 from .sensor_database import SensorDatabase
-from .server import create_app
+from .server import create_app, serve_async
 #from .rtl433 import rtl433
-from .pm_monitor import PMDcommunicator, find_ch340_comport
+from .pm_monitor import PMDcommunicator, find_ch340_comports
 from .outdoor_humidity import get_message2, get_humidity
+from .collector import Scheduler, PMDetectorCollector, OutdoorHumidityCollector
+from .wal import WriteAheadLog
+from .archive import Archive
+from .backfill import backfill
+from .exporter import Exporter, MODE_REMOTE_WRITE, MODE_PUSHGATEWAY
+from .instrumentation import Instrumentation
+from .http_client import client
+from .timeseries import HISTORY_FIELDS
 import threading
+import asyncio
+import signal
 import time
 import os
 
-def run(metric_descriptions=None, metric_filters=None):
+def create_database():
+    """Create the SensorDatabase, durable when PM_MONITOR_WAL is set to the path of a write-ahead log,
+    and with a long-term archive when PM_MONITOR_ARCHIVE is set to a directory.
+    """
+    wal_path = os.getenv('PM_MONITOR_WAL')
+    archive_path = os.getenv('PM_MONITOR_ARCHIVE')
+    wal = WriteAheadLog(wal_path) if wal_path else None
+    archive = Archive(archive_path, HISTORY_FIELDS) if archive_path else None
+    return SensorDatabase(wal=wal, archive=archive)
+
+def create_exporter(db, metric_maker):
+    """Push the stored records to PM_MONITOR_REMOTE_WRITE_URL (Prometheus remote-write) or to
+    PM_MONITOR_PUSHGATEWAY_URL (e.g. http://host:9091/metrics/job/pm_monitor), if set.
+    Batches that could not be sent are queued in the PM_MONITOR_EXPORT_QUEUE directory.
+    """
+    remote_write_url = os.getenv('PM_MONITOR_REMOTE_WRITE_URL')
+    pushgateway_url = os.getenv('PM_MONITOR_PUSHGATEWAY_URL')
+    queue_directory = os.getenv('PM_MONITOR_EXPORT_QUEUE', "pm_monitor_export_queue")
+    if remote_write_url:
+        exporter = Exporter(remote_write_url, metric_maker, MODE_REMOTE_WRITE, queue_directory)
+    elif pushgateway_url:
+        exporter = Exporter(pushgateway_url, metric_maker, MODE_PUSHGATEWAY, queue_directory)
+    else:
+        return None
+    db.observers.append(exporter.observe)
+    return exporter
+
+def find_receivers():
+    """Return the port and id of every connected PM Detector.
+
+    The id of a PM Detector is taken from PM_MONITOR_DEVICE_IDS, e.g. "1-1.2=100,1-1.3=101", which maps the identity
+    (USB serial number or location, see find_ch340_comports) to an id. Without a mapping a single PM Detector gets id 100
+    and multiple PM Detectors get their identity as id.
+    """
+    ports = find_ch340_comports()
+    if len(ports) == 0:
+        print("PM Monitor is not connected. Please connect PM Monitor to a USB port with a data cable.")
+        exit(1)
+    device_ids = {}
+    for item in os.getenv('PM_MONITOR_DEVICE_IDS', "").split(","):
+        if "=" in item:
+            identity, id = item.split("=", 1)
+            device_ids[identity.strip()] = int(id) if id.strip().isdigit() else id.strip()
+    receivers = []
+    for port, identity in ports:
+        if identity in device_ids:
+            id = device_ids[identity]
+        elif len(ports) == 1:
+            id = 100
+        else:
+            id = identity
+        print("PM Monitor %s on %s, id %s" % (identity, port, id))
+        receivers.append((port, id))
+    return receivers
+
+def open_receivers(communicator_class=PMDcommunicator):
+    """Open a communicator for every connected PM Detector, see find_receivers()."""
+    return [communicator_class(port, id) for port, id in find_receivers()]
+
+def backfill_receiver(port, id, db, store_time, checkpoint_path):
+    """Set the storetime and backfill the history of the PM Detector on `port` with a (blocking) PMDcommunicator."""
+    receiver = PMDcommunicator(port, id)
+    try:
+        receiver.setStoreTime(store_time)
+        if receiver.getStoreTime():
+            print("backfilled messages:", backfill(receiver, db, checkpoint_path))
+    finally:
+        receiver.closePort()
+
+def run(metric_descriptions=None, metric_filters=None, mode=None):
+    """Collect data from the sources and serve it via HTTP.
+
+    `mode` (or the PM_MONITOR_MODE environment variable) selects how the sources are driven:
+    "threads" (default) runs the sources as collectors on a Scheduler (one timer thread plus a pool of
+    PM_MONITOR_WORKERS worker threads), "asyncio" runs all of them from one event loop.
+    """
     if metric_descriptions is None:
         metric_descriptions = []
     if metric_filters is None:
         metric_filters = []
+    if mode is None:
+        mode = os.getenv('PM_MONITOR_MODE', "threads")
+    # Stop on SIGTERM (e.g. systemd, docker) like on Ctrl-C, so the data is written at shutdown.
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    if mode == "asyncio":
+        asyncio.run(run_async(metric_descriptions, metric_filters))
+        return
     
-    db = SensorDatabase()
+    db = create_database()
 
     metric_maker = MetricMaker(metric_descriptions, metric_filters)
+    db.observers.append(metric_maker.observe)
+    exporter = create_exporter(db, metric_maker)
 
     #receiver = rtl433()
-    receiver = PMDcommunicator(find_ch340_comport())
-    receiver.setSendTime("000")
-    receiver.setStoreTime("000")
-    
-    error_event = threading.Event()
-    def rx_thread_entry():
-        count = 0
-        while True:
-            try:
-                count += 1
-                if count > 86400/5: # for ~24 hours 86400/5, for ~1 hour 86400/(5*24)
-                    count = 0
-                    print("setting clock")
-                    print("clock return:", receiver.setClock())
-                message, error, error2 = receiver.get_message() # Accounts for 0.5 sleep seconds
-                receiver.pushStopPMdetector() # Accounts for 1 sleep second
-                print("message 100=", message)
-                print("error2=", error2)
-                time.sleep(3.5)
-                if message is not None:
-                    db.store(message)
-                else:
-                    print("error =", error)
-                    print("error2 =", error2)
-            except:
-                print("exception raised while trying to get a new messages")
-                error_event.set()
-                raise
-        
-    rx_thread = threading.Thread(target=rx_thread_entry, daemon=False)
-    rx_thread.start()
-
-    def rx2_thread_entry():
-        while True:
-            try:
-                message = get_message2()
-                print("message 110=", message)
-                time.sleep(30)
-                if message is not None:
-                    db.store(message)
-            except:
-                print("exception raised while trying to get a new messages")
-                error_event.set()
-                raise
-        
-    rx2_thread = threading.Thread(target=rx2_thread_entry, daemon=False)
-    rx2_thread.start()
+    # All sources are collectors on one scheduler: a slow, hung or failing source is retried with backoff
+    # and does not delay or stop the others.
+    scheduler = Scheduler(db, workers=int(os.getenv('PM_MONITOR_WORKERS', "4")))
+    send_time = "005"
+    store_time = os.getenv('PM_MONITOR_STORE_TIME', "000")
+    checkpoint_path = os.getenv('PM_MONITOR_BACKFILL_CHECKPOINT', "pm_monitor_backfill_{id}.json")
+    receivers = open_receivers()
+    for receiver in receivers:
+        scheduler.add(PMDetectorCollector(receiver, db, send_time, store_time, checkpoint_path.format(id=receiver.id)))
+    scheduler.add(OutdoorHumidityCollector())
+    scheduler.start()
+    instrumentation = Instrumentation(db, receivers, scheduler, exporter, client)
 
+    error_event = threading.Event()
     host = os.getenv('PM_MONITOR_HOST', "0.0.0.0")
     port = os.getenv('PM_MONITOR_PORT', "5000")
     def http_thread_entry():
         try:
-            app = create_app(db,  metric_maker)
+            app = create_app(db,  metric_maker, instrumentation)
             app.run(host=host, port=port)
         except:
             error_event.set()
@@ -81,10 +143,115 @@ def run(metric_descriptions=None, metric_filters=None):
     http_thread = threading.Thread(target=http_thread_entry, daemon=True)
     http_thread.start()
 
-    while(not error_event.wait()):
-        print("no error event")
-        pass
-    if error_event.wait():
-        print("there must be an error event raised")
+    try:
+        while(not error_event.wait()):
+            print("no error event")
+            pass
+        if error_event.wait():
+            print("there must be an error event raised")
+
+        time.sleep(1)
+    finally:
+        scheduler.stop()
+        if exporter is not None:
+            exporter.close()
+        db.close()
+
+async def run_async(metric_descriptions, metric_filters):
+    """Event loop variant of run(): the PM Detector, the outdoor humidity and the HTTP server share one thread.
+
+    The outdoor humidity request is blocking (requests), it runs in the default executor of the loop. So does the
+    backfill of a PM Detector: dumpHistory() reads the serial port itself, it uses a PMDcommunicator before the
+    AsyncPMDcommunicator opens the port.
+    """
+    # Imported here, so the threads mode does not depend on the event loop support of the serial port.
+    from .async_pm_monitor import AsyncPMDcommunicator
+
+    db = create_database()
+
+    metric_maker = MetricMaker(metric_descriptions, metric_filters)
+    db.observers.append(metric_maker.observe)
+    exporter = create_exporter(db, metric_maker)
+
+    send_time = "005"
+    store_time = os.getenv('PM_MONITOR_STORE_TIME', "000")
+    checkpoint_path = os.getenv('PM_MONITOR_BACKFILL_CHECKPOINT', "pm_monitor_backfill_{id}.json")
+    instrumentation = Instrumentation(db, exporter=exporter, http_client=client)
+
+    clock_interval = 86400
+    retry_interval = 5
+    max_retry_interval = 600
+
+    async def rx_source(port, id):
+        # Every PM Detector retries on its own: a failing or unplugged one is reopened with backoff,
+        # without stopping the other sources or the HTTP server.
+        loop = asyncio.get_running_loop()
+        backfilled = False
+        delay = retry_interval
+        while True:
+            receiver = None
+            try:
+                if not backfilled:
+                    # The dump reads the serial port itself, it runs blocking in the executor before the
+                    # event loop starts reading the port.
+                    await loop.run_in_executor(None, backfill_receiver, port, id, db, store_time, checkpoint_path.format(id=id))
+                    backfilled = True
+                receiver = AsyncPMDcommunicator(port, id)
+                instrumentation.receivers = [r for r in instrumentation.receivers if r.id != id] + [receiver]
+                await receiver.setStoreTime(store_time)
+                while True:
+                    last_clock = time.monotonic()
+                    messages = receiver.iter_messages(send_time)
+                    async for message, error in messages:
+                        print("message %s=" % receiver.id, message)
+                        if message is not None:
+                            db.store(message)
+                            delay = retry_interval
+                        else:
+                            print("error =", error)
+                        # By elapsed time, so missed datasets do not postpone setting the clock
+                        if time.monotonic() - last_clock >= clock_interval:
+                            break
+                    await messages.aclose()
+                    print("setting clock")
+                    print("clock return:", await receiver.setClock())
+            except Exception as e:
+                print("PM Monitor %s: ErrorType : %s, Error : %s, retry in %d s" % (id, type(e).__name__, e, delay))
+            finally:
+                if receiver is not None:
+                    receiver.closePort()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_retry_interval)
+
+    async def rx2_source(interval=30):
+        # Fixed rate on monotonic deadlines, the duration of the request does not shift the samples
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic()
+        while True:
+            try:
+                message = await loop.run_in_executor(None, get_message2)
+                print("message 110=", message)
+                if message is not None:
+                    db.store(message)
+            except Exception as e:
+                print("outdoor humidity: ErrorType : %s, Error : %s" % (type(e).__name__, e))
+            deadline += interval
+            now = time.monotonic()
+            if deadline <= now:
+                missed = int((now - deadline) / interval) + 1
+                deadline += missed * interval
+                print("outdoor humidity: missed %d tick(s)" % missed)
+            await asyncio.sleep(deadline - now)
+
+    host = os.getenv('PM_MONITOR_HOST', "0.0.0.0")
+    port = os.getenv('PM_MONITOR_PORT', "5000")
+    server = await serve_async(create_app(db, metric_maker, instrumentation), host, port)
 
-    time.sleep(1)
\ No newline at end of file
+    try:
+        # The sources handle their own errors, only the HTTP server failing stops the loop.
+        await asyncio.gather(*[rx_source(port, id) for port, id in find_receivers()], rx2_source(), server.serve_forever())
+    finally:
+        server.close()
+        if exporter is not None:
+            exporter.close()
+        db.close()
@@ -1,6 +1,13 @@
 from datetime import datetime 
+from bisect import bisect_left, bisect_right
+import time
+import threading
+import traceback
 # pip install python-dateutil
 import dateutil.parser as parser
+from .timeseries import SeriesHistory, HISTORY_FIELDS, field_values
+from .archive import series_name
+from .rollup import Rollup, ROLLUP_RESOLUTIONS
 
 def sanitize_sensor_record(r):
     """Fix any inconsistencies in the way rtl_433 returns json
@@ -11,23 +18,324 @@ def sanitize_sensor_record(r):
         del r2['sensor_id']
     return r2
 
+# "YYYY-MM-DD HH" -> epoch seconds of the start of that hour (local time)
+_hour_epochs = {}
+
+def parse_time(s):
+    """Convert the 'time' of a record to epoch seconds (local time)
+    """
+    # The format used by all sources: the start of the hour is parsed once, the minutes and
+    # seconds are added to it (the replay of the write-ahead log parses a lot of them).
+    if len(s) == 19 and s[13] == ':' and s[16] == ':' and s[14:16].isdigit() and s[17:19].isdigit() \
+            and s[14] < '6' and s[17] < '6':
+        hour = _hour_epochs.get(s[:13])
+        if hour is None:
+            try:
+                hour = datetime.strptime(s[:13], "%Y-%m-%d %H").timestamp()
+            except ValueError:
+                return parser.parse(s).timestamp()
+            if len(_hour_epochs) >= 4096:
+                _hour_epochs.clear()
+            _hour_epochs[s[:13]] = hour
+        return hour + int(s[14:16]) * 60 + int(s[17:19])
+    try:
+        return datetime.strptime(s, "%Y-%m-%d %H:%M:%S").timestamp()
+    except ValueError:
+        return parser.parse(s).timestamp()
+
+class Snapshot(object):
+    """Consistent, immutable view of the latest records
+
+    A new Snapshot is created for every store (copy-on-write), so readers can iterate
+    it without locks while the collectors keep storing.
+    """
+    __slots__ = ('generation', 'sensors', 'timestamps', 'index_times', 'index_keys')
+
+    def __init__(self, generation, sensors, timestamps, index_times, index_keys):
+        self.generation = generation
+        self.sensors = sensors
+        # Epoch seconds of the 'time' of every sensor, parsed once at ingest
+        self.timestamps = timestamps
+        # Sensor keys ordered by timestamp (two parallel lists, keys may not be comparable)
+        self.index_times = index_times
+        self.index_keys = index_keys
+
+    def recent(self, max_age):
+        i = bisect_right(self.index_times, time.time() - max_age)
+        return [self.sensors[key] for key in self.index_keys[i:]]
+
 class SensorDatabase(object):
     HASH_KEYS = ['model', 'id', 'channel']
 
-    def __init__(self):
-        self.sensors = {}
+    def __init__(self, history_capacity=17280, history_fields=HISTORY_FIELDS, wal=None, archive=None,
+                 rollup_resolutions=ROLLUP_RESOLUTIONS):
+        """`history_capacity` is the amount of samples kept per sensor (17280 is 24 hours at one
+        sample per 5 seconds), 0 disables the history. Memory per sensor is fixed at
+        2 * history_capacity * 8 bytes per field, plus the same for the timestamps.
+
+        Safe to use from multiple threads: writers are serialized by a lock, readers use
+        the current Snapshot and never wait for a writer (except history(), which copies
+        the samples under the lock).
+
+        With a `wal` (WriteAheadLog) every stored record is logged, and the records in the
+        log are stored again at construction, so the latest values and the history survive
+        a restart.
+
+        With an `archive` (Archive) the numeric fields of every stored record are also
+        appended to the long-term archive, see `archived()`.
+
+        `rollup_resolutions` maps window lengths in seconds to the amount of closed windows
+        kept per sensor, every stored record updates the min/max/mean/count of the history
+        fields of those windows, see `rollups()`. An empty dict disables the rollups.
+
+        Every callable in `observers` is called with the list of records of every store,
+        just before they become visible to readers (e.g. MetricMaker.observe for histograms),
+        so a reader of a generation never sees observer state older than it. Observers are
+        called with the store lock held and must be quick.
+        """
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot(0, {}, {}, [], [])
+        self.history_capacity = history_capacity
+        self.history_fields = history_fields
+        self.histories = {}
+        self.observers = []
+        self.skipped = 0
+        self.invalid = 0
+        self.observer_errors = 0
+        self.rollup = Rollup(rollup_resolutions, history_fields) if rollup_resolutions else None
+        # Set after the replay of the log, store_many() must not log it again. The archive
+        # ignores what it already has, so it gets the replayed records it lost in a crash.
+        self.wal = None
+        self.archive = archive
+        if wal is not None:
+            self._load(wal.replay())
+            wal.compactor = self._compaction_records
+            self.wal = wal
+
+    @property
+    def sensors(self):
+        return self._snapshot.sensors
+
+    @property
+    def timestamps(self):
+        return self._snapshot.timestamps
+
+    @property
+    def generation(self):
+        """Incremented on every store, readers can use it to detect changes"""
+        return self._snapshot.generation
+
+    def snapshot(self):
+        return self._snapshot
     
     def store(self, record):
-        record = sanitize_sensor_record(record)
-        key = tuple([record[k] for k in self.HASH_KEYS & record.keys()])
+        self.store_many([record])
+
+    def store_many(self, records):
+        """Store a batch of records, e.g. historical data from a backfill
+
+        The whole batch becomes visible to readers at once, as one new generation.
+        A record at or before the latest stored record of its sensor (e.g. history that is
+        dumped again, or older than the replayed log) is skipped, so the history and the
+        rollups stay in time order. `skipped` counts them. A record without a valid 'time'
+        is skipped too, before anything is stored, and counted in `invalid`.
+
+        An observer that raises is reported and counted in `observer_errors`, it does not
+        affect the store or the other observers.
+        """
+        # Parse the whole batch first, so a bad record can not leave a half applied store
+        parsed = self._parse(records)
+
+        stored = []
+        with self._lock:
+            snapshot = self._snapshot
+            sensors = dict(snapshot.sensors)
+            timestamps = dict(snapshot.timestamps)
+            index_times = list(snapshot.index_times)
+            index_keys = list(snapshot.index_keys)
+            try:
+                for key, timestamp, record in parsed:
+                    latest = timestamps.get(key)
+                    if latest is not None and timestamp <= latest:
+                        self.skipped += 1
+                        continue
+                    stored.append(record)
+
+                    if self.wal is not None:
+                        self.wal.append(record)
 
-        self.sensors[key] = record
+                    if self.archive is not None:
+                        self.archive.append(series_name(record, self.HASH_KEYS), timestamp, record)
+
+                    sensors[key] = record
+                    _reindex(timestamps, index_times, index_keys, key, timestamp)
+
+                    if self.history_capacity:
+                        h = self.histories.get(key)
+                        if h is None:
+                            h = self.histories[key] = SeriesHistory(self.history_capacity, self.history_fields)
+                        h.append(timestamp, record)
+
+                    if self.rollup is not None:
+                        self.rollup.add(key, timestamp, record)
+                # Before publishing: /metrics caches its rendering per generation, including the
+                # histograms updated by the observers.
+                for observer in self.observers:
+                    try:
+                        observer(stored)
+                    except Exception as e:
+                        self.observer_errors += 1
+                        print("observer %r failed: ErrorType : %s, Error : %s" % (observer, type(e).__name__, e))
+                        traceback.print_exc()
+            finally:
+                # What was stored (also when storing failed halfway) is always published
+                self._snapshot = Snapshot(snapshot.generation + 1, sensors, timestamps, index_times, index_keys)
+
+    def _parse(self, records):
+        """Return (key, timestamp, record) of the records with a valid 'time'"""
+        parsed = []
+        for record in records:
+            record = sanitize_sensor_record(record)
+            try:
+                timestamp = parse_time(record['time'])
+            except (KeyError, TypeError, ValueError, OverflowError) as e:
+                self.invalid += 1
+                print("invalid record, ErrorType : {}, Error : {}:".format(type(e).__name__, e), record)
+                continue
+            parsed.append((tuple([record[k] for k in self.HASH_KEYS & record.keys()]), timestamp, record))
+        return parsed
+
+    def _load(self, records):
+        """Store the records of the write-ahead log at construction, like store_many()
+
+        Fast path for the replay: the history and the rollups of every sensor are loaded in
+        bulk, the index is built once, and the observers are not called.
+        """
+        parsed = self._parse(records)
+        with self._lock:
+            snapshot = self._snapshot
+            sensors = dict(snapshot.sensors)
+            timestamps = dict(snapshot.timestamps)
+            samples = {}
+            for key, timestamp, record in parsed:
+                latest = timestamps.get(key)
+                if latest is not None and timestamp <= latest:
+                    self.skipped += 1
+                    continue
+                if self.archive is not None:
+                    self.archive.append(series_name(record, self.HASH_KEYS), timestamp, record)
+                sensors[key] = record
+                timestamps[key] = timestamp
+                samples.setdefault(key, ([], []))
+                samples[key][0].append(timestamp)
+                samples[key][1].append(record)
+
+            fields = list(self.history_fields)
+            if self.rollup is not None:
+                fields += [f for f in self.rollup.fields if f not in fields]
+            if self.history_capacity or self.rollup is not None:
+                for key, (times, key_records) in samples.items():
+                    columns = {f: field_values(key_records, f) for f in fields}
+                    if self.history_capacity:
+                        h = self.histories.get(key)
+                        if h is None:
+                            h = self.histories[key] = SeriesHistory(self.history_capacity, self.history_fields)
+                        h.extend(times, columns)
+                    if self.rollup is not None:
+                        self.rollup.add_many(key, times, columns)
+
+            index = sorted(timestamps.items(), key=lambda item: item[1])
+            self._snapshot = Snapshot(snapshot.generation + 1, sensors, timestamps,
+                                      [timestamp for key, timestamp in index], [key for key, timestamp in index])
+
+    def _compaction_records(self):
+        """Records that rebuild the current state: the history of every sensor, oldest
+        first, followed by the latest record of every sensor
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            records = []
+            for key, latest in snapshot.sensors.items():
+                h = self.histories.get(key)
+                if h is None or len(h) < 2:
+                    continue
+                identity = {k: latest[k] for k in self.HASH_KEYS if k in latest}
+                samples = h.range()
+                # The last sample of the history is the latest record itself
+                for i in range(len(samples['time']) - 1):
+                    record = dict(identity)
+                    record['time'] = datetime.fromtimestamp(samples['time'][i]).strftime("%Y-%m-%d %H:%M:%S")
+                    for f in h.fields:
+                        value = samples[f][i]
+                        if value == value: # not NaN
+                            record[f] = value
+                    records.append(record)
+            records.sort(key=lambda r: r['time'])
+            records.extend(snapshot.sensors[key] for key in snapshot.index_keys)
+            self.wal.discard_pending()
+            return records
+
+    def close(self):
+        """Write the pending data of the write-ahead log and the archive to disk"""
+        if self.wal is not None:
+            self.wal.close()
+        if self.archive is not None:
+            self.archive.close()
 
     def all(self):
-        return list(self.sensors.values())
+        return list(self._snapshot.sensors.values())
+
+    def keys(self):
+        return list(self._snapshot.sensors.keys())
+
+    def history(self, key, since=None, until=None):
+        """Get the history of sensor `key` between `since` and `until` (epoch seconds, inclusive)
+
+        Returns a dict of arrays ('time' plus one per history field), or None if there is
+        no history for `key`. The samples are copied with the store lock held, so all
+        columns hold the same samples and stay valid while new records are stored.
+        """
+        h = self.histories.get(key)
+        if h is None:
+            return None
+        with self._lock:
+            return h.range(since, until, copy=True)
+
+    def archived(self, key, field, since=None, until=None):
+        """Get (timestamps, values) of `field` of sensor `key` from the archive
+
+        Returns None without an archive or if `key` is unknown.
+        """
+        record = self._snapshot.sensors.get(key)
+        if self.archive is None or record is None:
+            return None
+        return self.archive.query(series_name(record, self.HASH_KEYS), field, since, until)
+
+    def rollups(self, key, resolution, since=None, until=None, fields=None):
+        """Get the min/max/mean/count windows of sensor `key` at `resolution` seconds that start
+        between `since` and `until` (epoch seconds, inclusive), the last window may still be open.
+
+        Returns a dict with 'time' (window starts) and per field a dict of 'count', 'min', 'max'
+        and 'mean' lists, or None without rollups or if `key` or `resolution` is unknown.
+        """
+        if self.rollup is None:
+            return None
+        return self.rollup.query(key, resolution, since, until, fields)
 
     def recent(self, max_age=5 * 60):
         """Get only sensors that have been updated within `max_age` seconds
         """
-        now = datetime.now()
-        return [x for x in self.sensors.values() if (now - parser.parse(x['time'])).total_seconds() < max_age]
\ No newline at end of file
+        return self._snapshot.recent(max_age)
+
+def _reindex(timestamps, index_times, index_keys, key, timestamp):
+    old = timestamps.get(key)
+    if old is not None:
+        i = bisect_left(index_times, old)
+        while index_keys[i] != key:
+            i += 1
+        del index_times[i]
+        del index_keys[i]
+    i = bisect_right(index_times, timestamp)
+    index_times.insert(i, timestamp)
+    index_keys.insert(i, key)
+    timestamps[key] = timestamp
@@ -4,6 +4,11 @@ import json
 #pip install Flask-Table
 from flask_table import Table, Col
 import pprint
+from .exposition import negotiate_format, accepts_gzip, CONTENT_TYPES
+import asyncio
+import io
+import sys
+import time
 
 # Declare your table
 class SensorTable(Table):
@@ -18,7 +23,12 @@ def raw_sensor_string(sensor):
         s += "%s=%s<br/>" % (k, str(v))
     return s
 
-def create_app(sensor_db, metric_maker):
+def without_nan(values):
+    """NaN is not valid JSON, missing aggregates become null"""
+    return [None if v != v else v for v in values]
+
+def create_app(sensor_db, metric_maker, instrumentation=None):
+    """With an `instrumentation` (see instrumentation.py) its internal metrics are added to /metrics"""
     app = flask.Flask(__name__)
     @app.route("/")
     def index():
@@ -26,12 +36,60 @@ def create_app(sensor_db, metric_maker):
 
     @app.route("/metrics")
     def metrics():
-        return flask.Response(metric_maker.to_string(sensor_db.recent()), mimetype='text/plain')
+        started = time.perf_counter()
+        snapshot = sensor_db.snapshot()
+        records = snapshot.recent(5 * 60)
+        # The recent records are a suffix of the time index, so for one generation their
+        # amount identifies them, even when records age out between scrapes.
+        format = negotiate_format(flask.request.headers.get('Accept'))
+        compress = accepts_gzip(flask.request.headers.get('Accept-Encoding'))
+        # The internal metrics change on every scrape, they are rendered separately and do not
+        # invalidate the cached rendering of the records.
+        extra = instrumentation.render(format) if instrumentation is not None else b""
+        body = metric_maker.encode(records, (snapshot.generation, len(records)), format, compress, extra)
+        if instrumentation is not None:
+            instrumentation.render_duration.observe(time.perf_counter() - started)
+        response = flask.Response(body, content_type=CONTENT_TYPES[format])
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept, Accept-Encoding'
+        return response
 
     @app.route ("/sensors.json")
     def sensors_json():
         return flask.Response(json.dumps(sensor_db.all()), mimetype='application/json')
 
+    @app.route("/rollups.json")
+    def rollups_json():
+        """Aggregates per sensor, e.g. /rollups.json?resolution=3600&since=1690000000&fields=pm2_5,pm10
+
+        `resolution` is the window length in seconds (default 60), one of the rollup resolutions of the
+        SensorDatabase, `since` and `until` are epoch seconds.
+        """
+        args = flask.request.args
+        try:
+            resolution = int(args.get('resolution', 60))
+            since = float(args['since']) if 'since' in args else None
+            until = float(args['until']) if 'until' in args else None
+        except ValueError:
+            return flask.Response("resolution, since and until must be numbers", status=400, mimetype='text/plain')
+        resolutions = sorted(sensor_db.rollup.resolutions) if sensor_db.rollup is not None else []
+        if resolution not in resolutions:
+            return flask.Response("resolution must be one of: %s" % ", ".join(str(r) for r in resolutions) if resolutions
+                                  else "rollups are disabled", status=400, mimetype='text/plain')
+        fields = args['fields'].split(',') if 'fields' in args else None
+        result = []
+        for key, sensor in sensor_db.snapshot().sensors.items():
+            windows = sensor_db.rollups(key, resolution, since, until, fields)
+            if windows is None:
+                continue
+            item = {k: sensor[k] for k in sensor_db.HASH_KEYS if k in sensor}
+            item['resolution'] = resolution
+            item['time'] = windows.pop('time')
+            item['fields'] = {f: {a: without_nan(v) for a, v in aggregates.items()} for f, aggregates in windows.items()}
+            result.append(item)
+        return flask.Response(json.dumps(result), mimetype='application/json')
+
     @app.route("/sensors")
     def sensors():
         items = [
@@ -46,4 +104,110 @@ def create_app(sensor_db, metric_maker):
         items = sorted(items, key=lambda x: x['time'], reverse=True)
         table = SensorTable(items)
         return flask.render_template('sensors.html', sensor_table=table)
-    return app
\ No newline at end of file
+    return app
+
+async def handle_http_connection(app, reader, writer):
+    """Serve the requests of one HTTP/1.1 connection with the WSGI `app`.
+
+    The routes of the app only format data that is already in memory, so they are
+    called directly from the event loop.
+
+    A minimal server for the routes of this app, for scrapers and browsers: requests on a
+    connection are handled one after the other (keep-alive, no pipelining), request bodies
+    may be sent with Content-Length or chunked, the response body is buffered and sent with
+    a Content-Length (HEAD gets the Content-Length of the GET response, without body).
+    Expect: 100-continue, trailers and upgrades are not supported.
+    """
+    host, port = writer.get_extra_info('sockname')[:2]
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, target, version = request_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().upper().replace('-', '_')] = value.strip()
+            if 'chunked' in headers.get('TRANSFER_ENCODING', '').lower():
+                body = await read_chunked(reader)
+                headers.pop('TRANSFER_ENCODING')
+                headers['CONTENT_LENGTH'] = str(len(body))
+            else:
+                content_length = int(headers.get('CONTENT_LENGTH') or 0)
+                body = await reader.readexactly(content_length) if content_length else b''
+            path, _, query = target.partition('?')
+
+            environ = {
+                'REQUEST_METHOD': method,
+                'SCRIPT_NAME': '',
+                'PATH_INFO': path,
+                'QUERY_STRING': query,
+                'SERVER_NAME': str(host),
+                'SERVER_PORT': str(port),
+                'SERVER_PROTOCOL': version,
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(body),
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': False,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            for name, value in headers.items():
+                if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                    environ[name] = value
+                else:
+                    environ['HTTP_' + name] = value
+
+            response = []
+            def start_response(status, response_headers, exc_info=None):
+                response[:] = [status, response_headers]
+            result = app(environ, start_response)
+            try:
+                response_body = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+            status, response_headers = response
+            keep_alive = version == 'HTTP/1.1' and headers.get('CONNECTION', '').lower() != 'close'
+            content_length = len(response_body)
+            if method == 'HEAD':
+                # The app leaves out the body, but sets the Content-Length of the GET response
+                response_body = b''
+                content_length = next((v for k, v in response_headers if k.lower() == 'content-length'), 0)
+            head = ["%s %s" % (version, status)]
+            head += ["%s: %s" % (k, v) for k, v in response_headers if k.lower() not in ('content-length', 'connection')]
+            head.append("Content-Length: %s" % content_length)
+            head.append("Connection: %s" % ('keep-alive' if keep_alive else 'close'))
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + response_body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def read_chunked(reader):
+    """Read a request body with chunked transfer coding, trailers are skipped"""
+    parts = []
+    while True:
+        size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            break
+        parts.append(await reader.readexactly(size))
+        await reader.readexactly(2) # CRLF
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+    return b''.join(parts)
+
+
+async def serve_async(app, host, port):
+    """Start serving the WSGI `app` from the running event loop, returns the asyncio server."""
+    return await asyncio.start_server(lambda r, w: handle_http_connection(app, r, w), host, int(port))
@@ -0,0 +1,223 @@
+"""Simulator of the PM Detector on a Linux pseudo-terminal
+
+Lets the PMDcommunicator be used without the device. The simulator opens a pty pair and answers on the master side,
+the PMDcommunicator opens the slave side (self.port) like the com port of the CH340.
+
+Supported functions:
+    01 sendtime, 02 storetime, 03 clock, 04 dump history, 05 push start/stop, 06 delete history, 80 parameters.
+
+To exercise the error handling the simulator can:
+    - push datasets faster than the sendtime allows (pushInterval),
+    - inject garbage between frames and 0xf5 bytes in the WritePoint/ReadPoint (garbage, a probability per frame),
+    - respond slowly (responseDelay).
+
+Usage:
+    with PMDsimulator(pushInterval=0.01) as simulator:
+        receiver = PMDcommunicator(simulator.port)
+"""
+
+import os
+import tty
+import json
+import time
+import random
+import select
+import threading
+from datetime import datetime, timedelta
+
+from .pm_monitor import HISTORY_SIZE
+
+
+class PMDsimulator(object):
+    def __init__(self, pushInterval=None, storeInterval=None, garbage=0.0, responseDelay=0.0, historyRecords=0, seed=None):
+        '''
+        Parameters
+        ----------
+        pushInterval : float, seconds between pushed datasets, None to use the sendtime like the PM Detector.
+        storeInterval : float, seconds between stored records, None to use the storetime like the PM Detector.
+        garbage : float, probability (0.0 - 1.0) to inject garbage before a frame and 0xf5 bytes in the parameters.
+        responseDelay : float, seconds to wait before responding to a command.
+        historyRecords : int, amount of records already stored in the PM Detector memory, 5 seconds apart up to now.
+        seed : int, seed for the random generator, for reproducible runs.
+        '''
+        self.pushInterval = pushInterval
+        self.storeInterval = storeInterval
+        self.garbage = garbage
+        self.responseDelay = responseDelay
+        self.random = random.Random(seed)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.sendTime = 0
+        self.storeTime = 0
+        self.pushFlag = False
+        self.clockOffset = timedelta()
+        self.history = [self.dataset(timedelta(seconds=5 * (i - historyRecords))) for i in range(historyRecords)]
+        self.readPoint = 0
+        self.writeLock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.pushEvent = threading.Event()
+        self.threads = []
+        self.commandCount = 0
+        self.pushCount = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        for target in (self.commandLoop, self.pushLoop, self.storeLoop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopEvent.set()
+        self.pushEvent.set()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def writePoint(self):
+        return (self.readPoint + len(self.history)) % HISTORY_SIZE
+
+    def dataset(self, age=timedelta()):
+        '''
+        Parameters
+        ----------
+        age : timedelta, added to the time of the dataset (negative for the past).
+
+        Returns
+        -------
+        dict, one dataset as pushed by the PM Detector (16 items).
+        '''
+        now = datetime.now() + self.clockOffset + age
+        pm2_5 = self.random.randint(0, 60)
+        return {
+            "y": now.strftime("%Y"), "m": now.strftime("%m"), "d": now.strftime("%d"),
+            "h": now.strftime("%H"), "min": now.strftime("%M"), "sec": now.strftime("%S"),
+            "t": "%.1f" % self.random.uniform(15, 30), "r": str(self.random.randint(30, 80)),
+            "cpm2.5": str(pm2_5), "cpm1.0": str(pm2_5 * 2 // 3), "cpm10": str(pm2_5 * 4 // 3),
+            "pm2.5": str(pm2_5), "pm1.0": str(pm2_5 * 2 // 3), "pm10": str(pm2_5 * 4 // 3),
+            "um0.3": str(pm2_5 * 50), "um0.5": str(pm2_5 * 15),
+        }
+
+    def send(self, frame):
+        '''
+        DESCRIPTION:
+            Write a frame (bytes) to the pty, with a chance of garbage in front of it.
+        '''
+        if self.garbage and self.random.random() < self.garbage:
+            frame = bytes(self.random.choice(b'\x00\xf5\xff\r\n abc') for i in range(self.random.randint(1, 8))) + frame
+        with self.writeLock:
+            try:
+                os.write(self.master, frame)
+            except OSError:
+                pass
+
+    def sendDict(self, data_dict):
+        self.send(json.dumps(data_dict, separators=(',', ':')).encode('Ascii') + b'\r\n')
+
+    def point(self, value):
+        point = b'%06d' % value
+        if self.garbage and self.random.random() < self.garbage:
+            point = b'\xf5' + point[1:]
+        return point
+
+    def parameters(self):
+        '''
+        Returns
+        -------
+        bytes, the function 80 response, including the trailing ',}' of the PM Detector.
+        '''
+        return (b'{"res":"80","SendInteralFlag":"%d","SendInteralTime":"%03d","StoreInteralTime":"%03d",'
+                b'"WritePoint":"%s","ReadPoint":"%s",}\r\n'
+                % (self.pushFlag, self.sendTime, self.storeTime, self.point(self.writePoint()), self.point(self.readPoint)))
+
+    def handle(self, command):
+        '''
+        DESCRIPTION:
+            Execute one command and send the response.
+        '''
+        self.commandCount += 1
+        if self.responseDelay:
+            time.sleep(self.responseDelay)
+        fun = int(command['fun'])
+        if fun == 1:
+            self.sendTime = int(command['sendtime'])
+        elif fun == 2:
+            self.storeTime = int(command['storetime'])
+        elif fun == 3:
+            self.clockOffset = datetime.strptime(command['clock'], "%y-%m-%d %H:%M:%S") - datetime.now()
+        elif fun == 4:
+            for record in list(self.history):
+                self.sendDict(record)
+        elif fun == 5:
+            self.pushFlag = command['flag'] == "1"
+            if self.pushFlag:
+                self.sendDict({"res": str(fun)})
+            # There is no confirmation for stopping push mode.
+            self.pushEvent.set()
+            return
+        elif fun == 6:
+            self.history = []
+            self.readPoint = 0
+        elif fun == 80:
+            self.send(self.parameters())
+            return
+        else:
+            return
+        self.sendDict({"res": str(fun)})
+
+    def commandLoop(self):
+        data = b''
+        while not self.stopEvent.is_set():
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data += os.read(self.master, 4096)
+            except OSError:
+                return
+            while b'\n' in data:
+                line, data = data.split(b'\n', 1)
+                try:
+                    command = json.loads(line)
+                except ValueError:
+                    continue
+                self.handle(command)
+
+    def pushLoop(self):
+        while not self.stopEvent.is_set():
+            if not self.pushFlag:
+                self.pushEvent.wait(0.1)
+                self.pushEvent.clear()
+                continue
+            self.sendDict(self.dataset())
+            self.pushCount += 1
+            if self.pushInterval is not None:
+                interval = self.pushInterval
+            elif self.sendTime == 0:
+                # "000" gives one dataset only.
+                self.pushFlag = False
+                continue
+            else:
+                interval = self.sendTime
+            self.pushEvent.wait(interval)
+            self.pushEvent.clear()
+
+    def storeLoop(self):
+        while not self.stopEvent.is_set():
+            interval = self.storeInterval if self.storeInterval is not None else self.storeTime
+            if not interval:
+                self.stopEvent.wait(0.1)
+                continue
+            self.stopEvent.wait(interval)
+            self.history.append(self.dataset())
+            if len(self.history) >= HISTORY_SIZE:
+                del self.history[0]
+                self.readPoint = (self.readPoint + 1) % HISTORY_SIZE
@@ -0,0 +1,136 @@
+from array import array
+import math
+from bisect import bisect_left, bisect_right
+
+# Numeric fields of the sensor records that are kept as history
+HISTORY_FIELDS = ['temperature_C', 'humidity', 'pm2_5', 'pm1_0', 'pm10']
+
+
+class RingBuffer(object):
+    """Fixed capacity ring buffer of numbers, backed by an `array`
+
+    Every sample is written twice, at `i` and `i + capacity`, so the stored samples are
+    always contiguous in memory and can be returned as a memoryview instead of a copy.
+    The memory used is fixed at 2 * capacity * itemsize bytes.
+    """
+    def __init__(self, capacity, typecode='d'):
+        if capacity < 1:
+            raise ValueError("RingBuffer capacity must be at least 1")
+        self.capacity = capacity
+        self.data = array(typecode, [0]) * (2 * capacity)
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        i = self.next
+        self.data[i] = value
+        self.data[i + self.capacity] = value
+        self.next = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def extend(self, values):
+        """Append all `values`, with slice copies instead of a call per value"""
+        values = array(self.data.typecode, values)
+        capacity = self.capacity
+        n = len(values)
+        if n >= capacity:
+            # Only the last `capacity` values are kept
+            values = values[n - capacity:]
+            self.data[:capacity] = values
+            self.data[capacity:] = values
+            self.next = 0
+            self.count = capacity
+            return
+        i = self.next
+        first = min(n, capacity - i)
+        self.data[i:i + first] = values[:first]
+        self.data[i + capacity:i + capacity + first] = values[:first]
+        rest = n - first
+        if rest:
+            self.data[:rest] = values[first:]
+            self.data[capacity:capacity + rest] = values[first:]
+        self.next = (i + n) % capacity
+        self.count = min(self.count + n, capacity)
+
+    def view(self):
+        """Return the stored samples, oldest first, as a memoryview into the buffer
+
+        The view is not a copy: it changes when samples are appended. Use `.tolist()`
+        on it if the values are needed after the next append.
+        """
+        start = (self.next - self.count) % self.capacity
+        return memoryview(self.data)[start:start + self.count]
+
+    def last(self):
+        if self.count == 0:
+            return None
+        return self.data[self.next - 1 + self.capacity]
+
+
+def field_values(records, field):
+    """The values of `field` of the records as floats, NaN if missing or not numeric"""
+    values = []
+    for record in records:
+        try:
+            values.append(float(record[field]))
+        except (KeyError, TypeError, ValueError):
+            values.append(math.nan)
+    return values
+
+
+class SeriesHistory(object):
+    """History of one sensor: int64 timestamps (epoch seconds) plus a float64 ring buffer per field
+
+    Missing or non-numeric values are stored as NaN, so all buffers stay aligned.
+    """
+    def __init__(self, capacity, fields=HISTORY_FIELDS):
+        self.fields = list(fields)
+        self.timestamps = RingBuffer(capacity, 'q')
+        self.values = {f: RingBuffer(capacity, 'd') for f in self.fields}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def nbytes(self):
+        return self.timestamps.data.itemsize * len(self.timestamps.data) + \
+            sum(v.data.itemsize * len(v.data) for v in self.values.values())
+
+    def append(self, timestamp, record):
+        self.timestamps.append(int(timestamp))
+        for f in self.fields:
+            try:
+                value = float(record[f])
+            except (KeyError, TypeError, ValueError):
+                value = float('nan')
+            self.values[f].append(value)
+
+    def extend(self, timestamps, columns):
+        """Append samples in bulk, `columns` has a list of floats (see field_values()) per field"""
+        capacity = self.timestamps.capacity
+        self.timestamps.extend([int(t) for t in timestamps[-capacity:]])
+        for f in self.fields:
+            self.values[f].extend(columns[f][-capacity:])
+
+    def range(self, since=None, until=None, copy=False):
+        """Return the samples with `since <= timestamp <= until` as a dict of memoryviews
+
+        The dict has a 'time' entry with the timestamps and one entry per field.
+        Samples are expected to arrive in time order, the range is found by bisection.
+        With `copy` the entries are arrays copied from the buffers instead of views.
+        """
+        timestamps = self.timestamps.view()
+        lo = 0 if since is None else bisect_left(timestamps, since)
+        hi = len(timestamps) if until is None else bisect_right(timestamps, until)
+        result = {'time': timestamps[lo:hi]}
+        for f in self.fields:
+            result[f] = self.values[f].view()[lo:hi]
+        if copy:
+            for name, view in result.items():
+                values = array(view.format)
+                values.frombytes(view.cast('B'))
+                result[name] = values
+        return result
@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+
+
+class WriteAheadLog(object):
+    """Append-only on-disk log of stored sensor records
+
+    Records are written as compact JSON lines. `append()` only adds the line to an
+    in-memory buffer; a background thread writes the buffer and fsyncs it every
+    `flush_interval` seconds (group commit), so a crash loses at most that interval.
+
+    When the log holds more than `max_records` lines, and more than twice the lines left
+    by the previous compaction, it is compacted: the `compactor` callback (set by the
+    SensorDatabase) returns the records that are still retained in memory, and the log is
+    atomically replaced by just those records. The retained history alone can exceed
+    `max_records` (many sensors), the factor keeps the log, and so the replay at startup,
+    bounded to twice the retained records without compacting on every flush.
+    """
+    def __init__(self, path, flush_interval=1.0, max_records=100000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_records = max_records
+        self.compactor = None
+        # Lines left by the last compaction
+        self.compacted_records = 0
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._file = open(path, 'ab')
+        with open(path, 'rb') as f:
+            self.records = sum(1 for _ in f)
+            # Cut off a partially written last line, so the next append starts on a new line
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(max(0, size - 4096))
+                tail = f.read()
+                if not tail.endswith(b'\n'):
+                    self._file.truncate(size - len(tail) + tail.rfind(b'\n') + 1)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def replay(self):
+        """Yield the records in the log, oldest first
+
+        A partially written last line (crash during a write) is skipped. The lines are
+        decoded in batches as one JSON array, which is much faster than a loads() per line;
+        a batch with an invalid line is decoded again line by line.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                lines = f.readlines(1 << 20)
+                if not lines:
+                    break
+                try:
+                    records = json.loads(b'[' + b','.join(lines) + b']')
+                except ValueError:
+                    records = []
+                    for line in lines:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            continue
+                yield from records
+
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            self._buffer.append(line)
+
+    def discard_pending(self):
+        """Drop the buffered lines, for a compactor that already includes them"""
+        with self._lock:
+            self._buffer = []
+
+    def flush(self):
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+            if not lines:
+                return
+            self._file.write(b''.join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.records += len(lines)
+
+    def compact(self):
+        """Replace the log by the records returned by the compactor"""
+        if self.compactor is None:
+            return
+        records = self.compactor()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'ab')
+            self.records = len(records)
+            self.compacted_records = len(records)
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+                if self.records > max(self.max_records, 2 * self.compacted_records):
+                    self.compact()
+            except Exception as e:
+                print("write-ahead log error:", e)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
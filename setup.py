@@ -15,7 +15,8 @@ setup(name='PM-Monitor',
       install_requires=[
          'python-dateutil',
          'flask',
-         'flask_table'
+         'flask_table',
+         'numpy'
       ],
       include_package_data=True,
       package_data={'': ['*/*.html', '*/*.css']},
@@ -0,0 +1,68 @@
+import math
+from itertools import accumulate
+
+import pytest
+
+from pm_monitor.archive import Archive, encode_chunk, decode_chunk, _encode_ints, _decode_ints
+
+
+@pytest.mark.parametrize("values", [
+    [],
+    [0],
+    [0, 1, -1, 2, -2, 127, -128],
+    [300, -300, 5],                            # 2 byte codes
+    [1 << 20, -(1 << 20), 0],                  # 4 byte codes
+    [(1 << 40), -(1 << 40), (1 << 62) - 1],    # 8 byte codes
+    [-(1 << 62), 1 << 62],
+])
+def test_zigzag_round_trip(values):
+    buf = _encode_ints(values)
+    decoded, offset = _decode_ints(buf, 0, len(values))
+    assert offset == len(buf)
+    assert [int(v) for v in decoded] == list(accumulate(values))
+
+
+def test_chunk_round_trip():
+    # Irregular sampling: negative delta-of-delta and a gap that needs a wider column
+    timestamps = [1000, 1005, 1010, 1012, 1020, 1020 + 100000, 1020 + 100005]
+    columns = {
+        'pm2_5': [8.0, 7.5, 9.25, -3.0, 0.0, 12.5, 8.0],       # scaled, negative deltas
+        'humidity': [math.nan] * 7,                            # empty
+        'temperature_C': [20.1, math.nan, 20.3, 1e300, 0.5, -1.0, 2.0],   # raw
+    }
+    name, decoded_timestamps, decoded = decode_chunk(encode_chunk('s', timestamps, columns), 0)
+    assert name == 's'
+    assert list(decoded_timestamps) == timestamps
+    assert list(decoded['pm2_5']) == columns['pm2_5']
+    assert all(math.isnan(v) for v in decoded['humidity'])
+    assert [v for v in decoded['temperature_C'] if v == v] == [20.1, 20.3, 1e300, 0.5, -1.0, 2.0]
+
+    name, single_timestamps, single = decode_chunk(encode_chunk('s', [7], {'pm2_5': [1.5]}), 0, ('pm2_5',))
+    assert list(single_timestamps) == [7] and list(single['pm2_5']) == [1.5]
+
+
+def test_archive_round_trip(tmp_path):
+    directory = str(tmp_path)
+    archive = Archive(directory, ['pm2_5', 'pm10'], segment_size=1024, chunk_size=100, flush_interval=3600)
+    expected = []
+    timestamp = 1690000000
+    for i in range(1000):
+        timestamp += 5 if i % 50 else 3600
+        record = {'pm2_5': (i % 23) * 0.5 - 3}
+        archive.append('s', timestamp, record)
+        expected.append((timestamp, record['pm2_5']))
+    # Older samples are ignored
+    archive.append('s', expected[0][0], {'pm2_5': 1})
+    archive.close()
+
+    archive = Archive(directory, ['pm2_5', 'pm10'], segment_size=1024, chunk_size=100, flush_interval=3600)
+    assert len(archive.segments) > 1
+    timestamps, values = archive.query('s', 'pm2_5')
+    assert list(zip(timestamps, values)) == expected
+    since, until = expected[123][0], expected[876][0]
+    timestamps, values = archive.query('s', 'pm2_5', since, until)
+    assert list(zip(timestamps, values)) == expected[123:877]
+    timestamps, values = archive.query('s', 'pm10', since, since)
+    assert list(timestamps) == [since] and math.isnan(values[0])
+    assert len(archive.query('unknown', 'pm2_5')[0]) == 0
+    archive.close()
@@ -0,0 +1,26 @@
+import asyncio
+
+from pm_monitor.async_pm_monitor import AsyncPMDcommunicator
+from pm_monitor.simulator import PMDsimulator
+
+
+def test_read_error_stops_the_reader_and_raises():
+    async def main():
+        simulator = PMDsimulator(pushInterval=0.2, seed=1)
+        simulator.start()
+        receiver = AsyncPMDcommunicator(simulator.port, 1)
+        messages = receiver.iter_messages(sendTime="001", timeout=3)
+        message, error_message = await messages.__anext__()
+        assert message['id'] == 1
+        simulator.stop()
+        try:
+            while True:
+                await messages.__anext__()
+        except IOError:
+            pass
+        assert receiver.loop is None
+        response, error_message = await receiver.sendCommand('{"fun":"80"}\n', 1)
+        assert response is None and error_message
+        receiver.closePort()
+
+    asyncio.run(asyncio.wait_for(main(), 30))
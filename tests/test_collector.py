@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from pm_monitor.collector import Collector, PMDetectorCollector, Scheduler
+from pm_monitor.pm_monitor import PMDcommunicator
+from pm_monitor.sensor_database import SensorDatabase
+from pm_monitor.simulator import PMDsimulator
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_collect_must_be_provided():
+    with pytest.raises(RuntimeError):
+        Collector().collect()
+
+
+class HangingCollector(Collector):
+    name = "hanging"
+    interval = 0.05
+    timeout = 0.2
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.interrupts = 0
+
+    def collect(self):
+        self.released.wait()
+        self.released.clear()
+        raise IOError("connection closed")
+
+    def interrupt(self):
+        self.interrupts += 1
+        self.released.set()
+
+
+class CountingCollector(Collector):
+    name = "counting"
+    interval = 0.05
+
+    def collect(self):
+        return []
+
+
+def test_hung_collector_is_interrupted():
+    scheduler = Scheduler(SensorDatabase(), workers=1, tick=0.01)
+    hanging = scheduler.add(HangingCollector())
+    counting = scheduler.add(CountingCollector(), delay=0.1)
+    scheduler.start()
+    try:
+        # The only worker is freed by the interrupt, so the other collector runs as well
+        wait_for(lambda: counting.runs >= 2)
+        assert hanging.collector.interrupts >= 1
+        assert hanging.failures >= 1
+    finally:
+        hanging.collector.released.set()
+        scheduler.stop()
+
+
+def test_interrupted_pm_detector_reopens_the_port():
+    with PMDsimulator(pushInterval=0.05, seed=1) as simulator:
+        db = SensorDatabase()
+        collector = PMDetectorCollector(PMDcommunicator(simulator.port), db, sendTime="001")
+        collector.setup()
+        collector.interrupt()
+        with pytest.raises(Exception):
+            collector.collect()
+        collector.setup()
+        wait_for(lambda: collector.receiver.getReadBuffer())
+        assert collector.collect()
+        collector.close()
+        collector.receiver.closePort()
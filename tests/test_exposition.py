@@ -0,0 +1,52 @@
+import pytest
+
+from pm_monitor import exposition
+from pm_monitor.instrumentation import Instrumentation
+from pm_monitor.metrics import MetricDescription, MetricMaker, Histogram, Summary, Sample, series
+
+parser = pytest.importorskip("prometheus_client.openmetrics.parser")
+
+
+def parse(body):
+    assert body.endswith(b"# EOF\n")
+    return {f.name: f for f in parser.text_string_to_metric_families(body.decode('utf-8'))}
+
+
+def test_openmetrics_is_valid():
+    histogram = Histogram('test_latency_seconds', [0.1, 1])
+    summary = Summary('test_size_bytes', labels={'sensor_id': 'a'})
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+        summary.observe(value)
+    descriptions = [
+        MetricDescription('test_frames_total', 'counter', 'Frames "read"\\ so far'),
+        MetricDescription('test_pm2_5', 'gauge', 'PM2.5'),
+        MetricDescription('test_latency_seconds', 'histogram', 'Latency'),
+        MetricDescription('test_size_bytes', 'summary', 'Size'),
+    ]
+    samples = [Sample(series('test_frames_total', {'sensor_id': 'a'}), 3),
+               Sample(series('test_pm2_5', {'sensor_id': 'a'}), 12.5)]
+    samples += histogram.samples() + summary.samples()
+    families = parse(MetricMaker(descriptions, []).encode(samples, format=exposition.FORMAT_OPENMETRICS))
+
+    assert families['test_frames'].type == 'counter'
+    assert families['test_frames'].samples[0].name == 'test_frames_total'
+    assert families['test_frames'].samples[0].value == 3
+    assert families['test_frames'].documentation == 'Frames "read"\\ so far'
+    assert families['test_pm2_5'].samples[0].value == 12.5
+    assert families['test_latency_seconds'].type == 'histogram'
+    assert [s.value for s in families['test_latency_seconds'].samples if s.name.endswith('_bucket')] == [1, 2, 3]
+    assert families['test_size_bytes'].type == 'summary'
+
+
+def test_openmetrics_with_instrumentation():
+    maker = MetricMaker([MetricDescription('test_stores_total', 'counter', 'Stores')], [])
+    instrumentation = Instrumentation()
+    instrumentation.render_duration.observe(0.01)
+    extra = instrumentation.render(exposition.FORMAT_OPENMETRICS)
+    samples = [Sample(series('test_stores_total'), 1)]
+    for generation in (1, 1):
+        body = maker.encode(samples, generation, exposition.FORMAT_OPENMETRICS, extra=extra)
+        families = parse(body)
+        assert families['test_stores'].samples[0].value == 1
+        assert families['pm_monitor_render_duration_seconds'].samples[-1].value == 1
@@ -0,0 +1,86 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from pm_monitor.sensor_database import SensorDatabase, parse_time
+
+
+def record(id, time, pm2_5=1.0):
+    return {'model': 'PM-Monitor', 'id': id, 'time': time, 'pm2_5': pm2_5}
+
+
+def test_failing_observer_does_not_break_the_store():
+    db = SensorDatabase()
+    seen = []
+
+    def failing(records):
+        raise RuntimeError("faulty filter")
+    db.observers.append(failing)
+    db.observers.append(seen.extend)
+
+    db.store(record(100, "2023-08-01 10:00:00"))
+
+    assert db.generation == 1
+    assert len(db.all()) == 1
+    assert len(seen) == 1
+    assert db.observer_errors == 1
+
+
+def test_invalid_time_is_skipped_before_storing():
+    db = SensorDatabase()
+    db.store_many([record(100, "2023-08-01 10:00:00"), record(101, "not a time"), {'model': 'x', 'id': 1}])
+
+    assert db.generation == 1
+    assert [r['id'] for r in db.all()] == [100]
+    assert db.invalid == 2
+    assert len(db.history(db.keys()[0])['time']) == 1
+
+
+def test_older_records_are_skipped():
+    db = SensorDatabase()
+    db.store(record(100, "2023-08-01 10:00:05", 2.0))
+    db.store_many([record(100, "2023-08-01 10:00:00"), record(100, "2023-08-01 10:00:05"),
+                   record(100, "2023-08-01 10:00:10", 3.0)])
+
+    assert db.skipped == 2
+    history = db.history(db.keys()[0])
+    assert list(history['time']) == sorted(history['time'])
+    assert list(history['pm2_5']) == [2.0, 3.0]
+
+
+@pytest.mark.parametrize("s", ["2023-08-01 10:00:00", "2023-08-01 10:59:59", "2023-03-26 02:30:00",
+                               "2023-10-29 02:30:00", "2024-02-29 23:05:09"])
+def test_parse_time(s):
+    assert parse_time(s) == datetime.strptime(s, "%Y-%m-%d %H:%M:%S").timestamp()
+    # From the cache
+    assert parse_time(s) == datetime.strptime(s, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+def test_parse_time_other_formats():
+    assert parse_time("2023-08-01T10:00:00") == parse_time("2023-08-01 10:00:00")
+    with pytest.raises(ValueError):
+        parse_time("2023-08-01 10:61:00")
+
+
+def test_history_columns_stay_aligned_while_storing():
+    db = SensorDatabase(history_capacity=50, rollup_resolutions={})
+    start = 1690000000
+    done = threading.Event()
+
+    def writer():
+        for i in range(3000):
+            db.store(record(100, datetime.fromtimestamp(start + i * 5).strftime("%Y-%m-%d %H:%M:%S"), i))
+        done.set()
+    thread = threading.Thread(target=writer)
+    thread.start()
+    while db.generation == 0:
+        time.sleep(0.001)
+    key = db.keys()[0]
+    while not done.is_set():
+        history = db.history(key)
+        assert len(history['time']) == len(history['pm2_5'])
+        assert all(t == start + value * 5 for t, value in zip(history['time'], history['pm2_5']))
+    thread.join()
+    assert list(db.history(key)['pm2_5']) == list(range(2950, 3000))
@@ -0,0 +1,25 @@
+import json
+
+from pm_monitor.metrics import MetricMaker
+from pm_monitor.sensor_database import SensorDatabase
+from pm_monitor.server import create_app
+
+
+def client(db):
+    return create_app(db, MetricMaker([], [])).test_client()
+
+
+def test_rollups_resolution():
+    db = SensorDatabase()
+    db.store({'model': 'PM-Monitor', 'id': 100, 'time': "2023-08-01 10:00:00", 'pm2_5': 8})
+    response = client(db).get('/rollups.json?resolution=3600')
+    assert response.status_code == 200
+    assert json.loads(response.data)[0]['fields']['pm2_5']['mean'] == [8]
+
+    for query in ('resolution=120', 'resolution=abc'):
+        response = client(db).get('/rollups.json?' + query)
+        assert response.status_code == 400
+    assert b'60, 3600, 86400' in client(db).get('/rollups.json?resolution=120').data
+
+    response = client(SensorDatabase(rollup_resolutions={})).get('/rollups.json')
+    assert response.status_code == 400
@@ -0,0 +1,149 @@
+"""The PMDcommunicator, backfill, write-ahead log and archive against the PMDsimulator on a pty"""
+import sys
+from datetime import timedelta
+
+import pytest
+
+from pm_monitor.archive import Archive
+from pm_monitor.backfill import backfill, load_checkpoint, save_checkpoint
+from pm_monitor.pm_monitor import PMDcommunicator, PMDframeDecoder, MAX_FRAME_SIZE
+from pm_monitor.sensor_database import SensorDatabase
+from pm_monitor.simulator import PMDsimulator
+from pm_monitor.timeseries import HISTORY_FIELDS
+from pm_monitor.wal import WriteAheadLog
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="the simulator needs a pty")
+
+FRAME = b'{"res":"80","WritePoint":"000001","ReadPoint":"000000",}'
+
+
+@pytest.fixture
+def simulator():
+    simulators = []
+
+    def start(**kwargs):
+        simulator = PMDsimulator(seed=1, **kwargs)
+        simulator.start()
+        simulators.append(simulator)
+        return simulator
+    yield start
+    for simulator in simulators:
+        simulator.stop()
+
+
+def test_decoder_split_frames():
+    decoder = PMDframeDecoder()
+    for i in range(len(FRAME)):
+        decoder.feed(FRAME[i:i + 1])
+    assert list(decoder.frames) == [FRAME.decode()]
+    assert decoder.skippedBytes == 0
+
+
+def test_decoder_garbage():
+    decoder = PMDframeDecoder()
+    decoder.feed(b'\x00\xf5abc' + FRAME[:10] + FRAME + b'\r\n{"WritePoint":"\xf5000001"}')
+    assert list(decoder.frames) == [FRAME.decode(), '{"WritePoint":"000001"}']
+    assert decoder.resyncs == 1
+    assert decoder.skippedBytes == 5 + 10 + 2 + 1
+
+
+def test_decoder_oversized_frames():
+    decoder = PMDframeDecoder()
+    # A '{' without '}' does not buffer everything that follows
+    for i in range(10):
+        decoder.feed(b'{' + b'x' * MAX_FRAME_SIZE)
+    assert len(decoder.buffer) <= MAX_FRAME_SIZE + 1
+    decoder.feed(b'}' + FRAME)
+    # A complete frame that is too long is skipped as well
+    decoder.feed(b'{' + b'"a":"' + b'x' * MAX_FRAME_SIZE + b'"}' + FRAME)
+    assert list(decoder.frames) == [FRAME.decode()] * 2
+    assert decoder.skippedBytes == decoder.bytesFed - 2 * len(FRAME)
+
+
+def test_messages_with_garbage(simulator):
+    receiver = PMDcommunicator(simulator(pushInterval=0.01, garbage=0.3).port, parameterTtl=0)
+    messages = receiver.iter_messages("001", timeout=5)
+    received = [message for message, error_message in (next(messages) for i in range(50)) if message is not None]
+    messages.close()
+    assert len(received) >= 45
+    assert receiver.decoder.skippedBytes > 0
+    receiver.closePort()
+
+
+def test_send_command_while_pushing(simulator):
+    sim = simulator(pushInterval=0.005)
+    receiver = PMDcommunicator(sim.port)
+    result, error_message = receiver.pushStartPMdetector(5)
+    assert result, error_message
+    for i in range(20):
+        response, error_message = receiver.sendCommand('{"fun":"02","storetime":"%03d"}\n' % i, 5)
+        assert error_message is None
+        assert response == {"res": "2"}
+        response, error_message = receiver.sendCommand('{"fun":"80"}\n', 5)
+        assert error_message is None
+        assert response["res"] == "80" and response["StoreInteralTime"] == "%03d" % i
+    assert receiver.pushQueue
+    assert all('res' not in dataset and len(dataset) == 16 for dataset in receiver.pushQueue)
+    assert 'res' not in receiver.readDataset(5)[0]
+    receiver.pushStopPMdetector()
+    receiver.closePort()
+
+
+def test_backfill_with_checkpoint(simulator, tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    sim = simulator(historyRecords=60)
+    receiver = PMDcommunicator(sim.port, parameterTtl=0)
+
+    # An interrupted dump: the first 20 records are stored already
+    save_checkpoint(checkpoint_path, 0, 20)
+    db = SensorDatabase()
+    assert backfill(receiver, db, checkpoint_path, batch_size=25) == 40
+    assert load_checkpoint(checkpoint_path) == {"start": 0, "ReadPoint": 60}
+    assert len(db.history(db.keys()[0])['time']) == 40
+
+    # Nothing new in the PM Detector: no dump
+    def dumpHistory(*args):
+        raise AssertionError("dumped again")
+    receiver.dumpHistory = dumpHistory
+    assert backfill(receiver, db, checkpoint_path) == 0
+
+    # A new record: everything is dumped again, only the new record is stored
+    del receiver.dumpHistory
+    sim.history.append(sim.dataset(timedelta(seconds=5)))
+    assert backfill(receiver, db, checkpoint_path) == 1
+    assert load_checkpoint(checkpoint_path) == {"start": 0, "ReadPoint": 61}
+
+    # Without a checkpoint the SensorDatabase skips what is not newer
+    skipped = db.skipped
+    assert backfill(receiver, db) == 0
+    assert db.skipped - skipped == 61
+    assert len(db.history(db.keys()[0])['time']) == 41
+    receiver.closePort()
+
+
+def test_wal_and_archive(simulator, tmp_path):
+    wal_path = str(tmp_path / 'wal')
+    archive_path = str(tmp_path / 'archive')
+    sim = simulator(historyRecords=300, pushInterval=0.01)
+    receiver = PMDcommunicator(sim.port)
+
+    db = SensorDatabase(wal=WriteAheadLog(wal_path), archive=Archive(archive_path, HISTORY_FIELDS, chunk_size=64))
+    assert backfill(receiver, db) == 300
+    messages = receiver.iter_messages("001", timeout=5)
+    for i in range(20):
+        message, error_message = next(messages)
+        db.store(message)
+    messages.close()
+    receiver.closePort()
+    key = db.keys()[0]
+    latest = db.all()
+    history = db.history(key)
+    db.close()
+
+    db = SensorDatabase(wal=WriteAheadLog(wal_path), archive=Archive(archive_path, HISTORY_FIELDS, chunk_size=64))
+    assert db.all() == latest
+    assert db.history(key) == history
+    timestamps, values = db.archived(key, 'pm2_5')
+    assert list(timestamps) == list(history['time'])
+    assert list(values) == list(history['pm2_5'])
+    db.close()
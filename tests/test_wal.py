@@ -0,0 +1,65 @@
+import math
+from datetime import datetime
+
+from pm_monitor.sensor_database import SensorDatabase
+from pm_monitor.wal import WriteAheadLog
+
+RESOLUTIONS = {60: 50, 3600: 10}
+
+
+def records(count, sensors=3, start=1690000000):
+    result = []
+    for i in range(count):
+        record = {'model': 'PM-Monitor', 'id': 100 + i % sensors,
+                  'time': datetime.fromtimestamp(start + i * 5).strftime("%Y-%m-%d %H:%M:%S"),
+                  'temperature_C': 20 + i % 7, 'humidity': str(40 + i % 11), 'pm2_5': 8.5}
+        if i % 13 == 0:
+            del record['pm2_5']
+        result.append(record)
+    return result
+
+
+def state(db):
+    histories = {key: {f: [v if v == v else None for v in values] for f, values in db.history(key).items()}
+                 for key in db.keys()}
+    rollups = {(key, resolution): db.rollups(key, resolution) for key in db.keys() for resolution in RESOLUTIONS if db.rollup is not None}
+    for windows in rollups.values():
+        for f, aggregates in windows.items():
+            if f != 'time':
+                for a, values in aggregates.items():
+                    aggregates[a] = [None if isinstance(v, float) and math.isnan(v) else round(v, 9) for v in values]
+    return db.all(), db.snapshot().index_keys, histories, rollups
+
+
+def test_replay_rebuilds_the_state(tmp_path):
+    path = str(tmp_path / 'wal')
+    wal = WriteAheadLog(path, flush_interval=3600)
+    db = SensorDatabase(history_capacity=100, wal=wal, rollup_resolutions=RESOLUTIONS)
+    for record in records(1200):
+        db.store(record)
+    expected = state(db)
+    db.close()
+
+    db = SensorDatabase(history_capacity=100, wal=WriteAheadLog(path, flush_interval=3600), rollup_resolutions=RESOLUTIONS)
+    assert state(db) == expected
+    db.close()
+
+
+def test_replay_of_a_compacted_log(tmp_path):
+    path = str(tmp_path / 'wal')
+    wal = WriteAheadLog(path, flush_interval=3600)
+    db = SensorDatabase(history_capacity=100, wal=wal, rollup_resolutions={})
+    for record in records(600):
+        db.store(record)
+    wal.compact()
+    assert wal.records == 300
+    # Appended after the compaction
+    for record in records(30, start=1690000000 + 600 * 5):
+        db.store(record)
+    latest, index_keys, histories, rollups = state(db)
+    db.close()
+
+    db = SensorDatabase(history_capacity=100, wal=WriteAheadLog(path, flush_interval=3600), rollup_resolutions={})
+    assert state(db) == (latest, index_keys, histories, rollups)
+    assert db.skipped == 0 and db.invalid == 0
+    db.close()